@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of cans downloaded from S3
+
+Cans are tracked in a small SQLite index in the cache directory with their
+size and last access time. When the total size exceeds the quota the least
+recently used cans are deleted.
+The index is shared by all the processes using the same cache directory.
+Cans that a process is going to read are pinned and never evicted: pins
+are recorded with the pid and ignored once the process is gone.
+"""
+
+from pathlib import Path
+from typing import Optional, Set
+import logging
+import os
+import sqlite3
+import time
+
+from fastpath.metrics import setup_metrics
+
+DEFAULT_QUOTA = 20 * 1024 * 1024 * 1024
+INDEX_FNAME = "index.sqlite3"
+
+log = logging.getLogger("fastpath.cancache")
+metrics = setup_metrics(name="fastpath.cancache")
+
+
+class CanCache:
+    def __init__(self, cachedir: Path, quota: int = DEFAULT_QUOTA) -> None:
+        self.cachedir = cachedir
+        self.quota = quota
+        self.hits = 0
+        self.misses = 0
+        cachedir.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            (cachedir / INDEX_FNAME).as_posix(), timeout=60, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS cans (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            atime REAL NOT NULL)"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cans_atime ON cans (atime)")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS pins (
+            path TEXT NOT NULL,
+            pid INTEGER NOT NULL)"""
+        )
+        if self._db.execute("SELECT COUNT(*) FROM cans").fetchone()[0] == 0:
+            self._import_existing_files()
+
+    def _import_existing_files(self) -> None:
+        """Index cans cached before the index was created"""
+        rows = []
+        for f in self.cachedir.rglob("*"):
+            if not f.is_file() or f.name.startswith(INDEX_FNAME):
+                continue
+            if f.suffix == ".s3tmp":
+                continue
+            st = f.stat()
+            rows.append((self._relpath(f), st.st_size, st.st_atime))
+        if rows:
+            log.info(f"Indexing {len(rows)} cached files")
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO cans VALUES (?,?,?)", rows)
+
+    def _relpath(self, f: Path) -> str:
+        return f.relative_to(self.cachedir).as_posix()
+
+    def _update_hit_ratio(self) -> None:
+        metrics.gauge("hit_ratio", self.hits / (self.hits + self.misses))
+
+    def lookup(self, f: Path, size: int) -> bool:
+        """Returns True and marks the file as recently used if it is cached
+        with the expected size"""
+        path = self._relpath(f)
+        r = self._db.execute("SELECT size FROM cans WHERE path = ?", (path,))
+        row = r.fetchone()
+        if row is not None and row[0] == size and f.exists():
+            self._db.execute(
+                "UPDATE cans SET atime = ? WHERE path = ?", (time.time(), path)
+            )
+            self.hits += 1
+            self._update_hit_ratio()
+            return True
+
+        if row is not None:
+            self._db.execute("DELETE FROM cans WHERE path = ?", (path,))
+        self.misses += 1
+        self._update_hit_ratio()
+        return False
+
+    def add(self, f: Path, size: int) -> None:
+        """Track a newly downloaded file and evict old ones if needed"""
+        path = self._relpath(f)
+        self._db.execute(
+            "INSERT OR REPLACE INTO cans VALUES (?,?,?)", (path, size, time.time())
+        )
+        self.evict(keep=path)
+
+    def pin(self, f: Path) -> None:
+        """Protect a file from eviction until unpin(). Pins are counted"""
+        path = self._relpath(f)
+        self._db.execute("INSERT INTO pins VALUES (?,?)", (path, os.getpid()))
+
+    def unpin(self, f: Path) -> None:
+        q = """DELETE FROM pins WHERE rowid = (
+            SELECT rowid FROM pins WHERE path = ? AND pid = ? LIMIT 1)"""
+        self._db.execute(q, (self._relpath(f), os.getpid()))
+
+    def pinned(self) -> Set[str]:
+        """Paths pinned by running processes. Drops stale pins"""
+        paths = set()
+        q = "SELECT DISTINCT path, pid FROM pins"
+        for path, pid in self._db.execute(q).fetchall():
+            if _pid_alive(pid):
+                paths.add(path)
+            else:
+                self._db.execute("DELETE FROM pins WHERE pid = ?", (pid,))
+        return paths
+
+    def remove(self, f: Path) -> None:
+        self._db.execute("DELETE FROM cans WHERE path = ?", (self._relpath(f),))
+
+    def total_size(self) -> int:
+        r = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cans")
+        return r.fetchone()[0]
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Delete least recently used files until the cache fits in the
+        quota, skipping pinned files. Returns the number of bytes evicted."""
+        total = self.total_size()
+        evicted = 0
+        if total > self.quota:
+            pinned = self.pinned()
+            q = "SELECT path, size FROM cans ORDER BY atime"
+            for path, size in self._db.execute(q).fetchall():
+                if total - evicted <= self.quota:
+                    break
+                if path == keep or path in pinned:
+                    continue
+                log.debug(f"Evicting {path}")
+                try:
+                    (self.cachedir / path).unlink()
+                except FileNotFoundError:
+                    pass
+                self._db.execute("DELETE FROM cans WHERE path = ?", (path,))
+                evicted += size
+
+            metrics.incr("evicted_bytes", evicted)
+
+        metrics.gauge("size_bytes", total - evicted)
+        return evicted
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_cache: Optional[CanCache] = None
+_cache_pid = 0
+
+
+def get_can_cache(cachedir: Path, quota: int = DEFAULT_QUOTA) -> CanCache:
+    """Returns the CanCache for this process. SQLite connections cannot be
+    shared across fork() so each process opens its own."""
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid() or _cache.cachedir != cachedir:
+        _cache = CanCache(cachedir, quota)
+        _cache_pid = os.getpid()
+    _cache.quota = quota
+    return _cache
@@ -13,21 +13,33 @@ See README.adoc
 
 from argparse import ArgumentParser, Namespace
 from base64 import b64decode
+from collections import OrderedDict
 from configparser import ConfigParser
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, TypedDict
+from queue import Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict
+import atexit
 import binascii
+import hashlib
 import logging
 import multiprocessing as mp
 import os
+import signal
 import sys
+import threading
 import time
 import yaml
 
 from pkg_resources import parse_version
 import ujson  # debdeps: python3-ujson
 
+try:
+    import ahocorasick  # debdeps: python3-ahocorasick
+except ImportError:
+    ahocorasick = None
+
 try:
     from systemd.journal import JournalHandler  # debdeps: python3-systemd
 
@@ -40,12 +52,19 @@ except ImportError:
 import fastpath.s3feeder as s3feeder
 
 # Feeds measurements from a local HTTP API
-from fastpath.localhttpfeeder import start_http_api
+from fastpath.localhttpfeeder import start_http_api, MAX_BACKLOG
+
+from fastpath.cancache import DEFAULT_QUOTA as DEFAULT_CACHE_QUOTA
+from fastpath.yamlcache import get_yaml_cache
 
 # Push measurements into Postgres
 import fastpath.db as db
+import fastpath.lazyjson as lazyjson
+import fastpath.normalize as normalize
 
-from fastpath.metrics import setup_metrics
+from fastpath.metrics import flush_all as flush_metrics, setup_metrics
+from fastpath.profiler import profiler
+from fastpath.snapshot import SharedSnapshot
 import fastpath.portable_queue as queue
 
 from fastpath.utils import dget_or as g_or
@@ -53,12 +72,20 @@ from fastpath.utils import dget_or as g_or
 LOCALITY_VALS = ("general", "global", "country", "isp", "local")
 
 NUM_WORKERS = 3
+# Seconds between liveness checks of S3 workers while waiting for cans
+S3_WORKER_CHECK_INTERVAL_S = 5
+
+# Timers called for each measurement, see --metrics-sample-rate
+HOT_TIMERS = ("full_run", "score_measurement", "match_fingerprints")
 
 log = logging.getLogger("fastpath")
 metrics = setup_metrics(name="fastpath")
 
 conf = Namespace()
 fingerprints_update_time = 0
+FINGERPRINTS_UPDATE_INTERVAL = 3600
+# Fingerprints published by the parent process to the workers
+fingerprints_snapshot: Optional[SharedSnapshot] = None
 
 FINGERPRINT_SCOPE_TO_LOCALITY = {
     "inst": "local",
@@ -79,7 +106,135 @@ class Fingerprint(TypedDict):
     expected_countries: list
 
 
-fingerprints: Dict[str, list[Fingerprint]] = dict(dns=[], http=[])
+class BodyMatcher:
+    """Match all HTTP body fingerprints against a body in a single scan
+    using an Aho-Corasick automaton. Falls back to one find() for each
+    fingerprint if pyahocorasick is not installed.
+    """
+
+    def __init__(self, http_fps: List[Fingerprint]) -> None:
+        self.fps = [fp for fp in http_fps if fp["location_found"] == "body"]
+        self._str_patterns = [fp["pattern"] for fp in self.fps]
+        self._bytes_patterns = [p.encode() for p in self._str_patterns]
+        # find("") returns 0 but empty keys cannot go in the automaton
+        self._empty = [n for n, p in enumerate(self._str_patterns) if p == ""]
+        self._str_automaton = None
+        self._bytes_automaton = None
+        if ahocorasick is None or len(self._empty) == len(self.fps):
+            return
+
+        # Bytes bodies are scanned as latin1 strings (one char per byte)
+        # against the UTF-8 encoded patterns, matching bytes.find() offsets
+        self._str_automaton = self._build_automaton(self._str_patterns)
+        latin1_patterns = [p.decode("latin1") for p in self._bytes_patterns]
+        self._bytes_automaton = self._build_automaton(latin1_patterns)
+
+    @staticmethod
+    def _build_automaton(patterns: List[str]):
+        # value: (pattern length, [fingerprint number, ... ])
+        automaton = ahocorasick.Automaton()
+        for n, pat in enumerate(patterns):
+            if pat == "":
+                continue
+            if pat in automaton:
+                automaton.get(pat)[1].append(n)
+            else:
+                automaton.add_word(pat, (len(pat), [n]))
+        automaton.make_automaton()
+        return automaton
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BodyMatcher) and self.fps == other.fps
+
+    def find_all(self, body) -> List[Tuple[Fingerprint, int]]:
+        """Returns (fingerprint, first match location) for every matching
+        fingerprint, in fingerprint order
+        """
+        is_bytes = isinstance(body, bytes)
+        if self._str_automaton is None:
+            patterns = self._bytes_patterns if is_bytes else self._str_patterns
+            out = []
+            for n, pat in enumerate(patterns):
+                idx = body.find(pat)
+                if idx != -1:
+                    out.append((self.fps[n], idx))
+            return out
+
+        if is_bytes:
+            automaton = self._bytes_automaton
+            body = body.decode("latin1")
+        else:
+            automaton = self._str_automaton
+
+        # Matches are reported by increasing end offset: the first one for
+        # each pattern is the location find() would return
+        found = {n: 0 for n in self._empty}
+        for end, (plen, fp_nums) in automaton.iter(body):
+            for n in fp_nums:
+                if n not in found:
+                    found[n] = end - plen + 1
+
+        return [(self.fps[n], found[n]) for n in sorted(found)]
+
+
+class HeaderMatcher:
+    """Match HTTP header fingerprints grouped by lowercase header name.
+    Full patterns are looked up in a dict, prefix patterns are grouped by
+    length and looked up by slicing the header value.
+    """
+
+    def __init__(self, http_fps: List[Fingerprint]) -> None:
+        self.fps = [fp for fp in http_fps if fp["location_found"].startswith("header.")]
+        # header name -> pattern -> [fingerprint number, ... ]
+        self.full: Dict[str, Dict[str, List[int]]] = {}
+        # header name -> prefix length -> prefix -> [fingerprint number, ... ]
+        self.prefix: Dict[str, Dict[int, Dict[str, List[int]]]] = {}
+        for n, fp in enumerate(self.fps):
+            hname = fp["location_found"][len("header.") :]
+            pat = fp["pattern"]
+            if fp["pattern_type"] == "full":
+                d = self.full.setdefault(hname, {})
+                d.setdefault(pat, []).append(n)
+            elif fp["pattern_type"] == "prefix":
+                d = self.prefix.setdefault(hname, {}).setdefault(len(pat), {})
+                d.setdefault(pat, []).append(n)
+        self.names = set(self.full) | set(self.prefix)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, HeaderMatcher) and self.fps == other.fps
+
+    def find_all(self, headers: dict) -> List[Fingerprint]:
+        """Returns the matching fingerprints in fingerprint order.
+        Header names must be lowercase.
+        """
+        found: List[int] = []
+        for hname, v in headers.items():
+            full = self.full.get(hname)
+            if full and isinstance(v, str):
+                found.extend(full.get(v, ()))
+
+            prefixes = self.prefix.get(hname)
+            if not prefixes:
+                continue
+            if isinstance(v, dict) and v.get("format") == "base64":
+                log.debug("Decoding base64 header")
+                data = b64decode(v.get("data", ""))
+                v = data.decode("latin1")
+            if not isinstance(v, str):
+                continue
+            for plen, d in prefixes.items():
+                found.extend(d.get(v[:plen], ()))
+
+        return [self.fps[n] for n in sorted(found)]
+
+
+fingerprints: Dict[str, Any] = dict(
+    dns=[],
+    dns_index={},
+    http=[],
+    http_body=BodyMatcher([]),
+    http_headers=HeaderMatcher([]),
+)
 
 
 def parse_date(d: str):
@@ -91,6 +246,7 @@ def setup_dirs(conf, root) -> None:
     conf.vardir = root / "var/lib/fastpath"
     conf.cachedir = conf.vardir / "cache"
     conf.s3cachedir = conf.cachedir / "s3"
+    conf.yamlcachedir = conf.cachedir / "yaml"
     # conf.outdir = conf.vardir / "output"
     for p in (
         conf.vardir,
@@ -124,8 +280,33 @@ def setup() -> None:
     ap.add_argument("--ccs", help="Filter comma-separated CCs when feeding from S3")
     h = "Filter comma-separated test names when feeding from S3 (without underscores)"
     ap.add_argument("--testnames", help=h)
+    h = "Max size in bytes of the local cache of cans (see --keep-s3-cache)"
+    d = DEFAULT_CACHE_QUOTA
+    ap.add_argument("--s3-cache-quota", type=int, help=h, default=d)
+    h = "Decode cans while downloading them from S3 instead of storing them on disk"
+    ap.add_argument("--s3-stream", action="store_true", help=h)
+    h = "Number of cans downloaded concurrently ahead of processing"
+    ap.add_argument("--s3-prefetch", type=int, help=h, default=s3feeder.PREFETCH_CANS)
+    h = "Disk space in bytes for cans downloaded ahead of processing"
+    d = s3feeder.PREFETCH_DISK_BUDGET
+    ap.add_argument("--s3-prefetch-budget", type=int, help=h, default=d)
+    h = "Number of worker processes used to process cans from S3 with --noapi"
+    ap.add_argument("--s3-workers", type=int, help=h, default=1)
+    h = "Cache normalized measurements from legacy YAML cans"
+    ap.add_argument("--yaml-cache", action="store_true", help=h)
+    h = "Number of processes used to parse YAML cans, for each S3 worker"
+    ap.add_argument("--yaml-workers", type=int, help=h, default=1)
+    h = "Reject measurements from the HTTP API when the queue is longer than this"
+    ap.add_argument("--max-backlog", type=int, help=h, default=MAX_BACKLOG)
+
+    h = "Profile processing stages by test name. Dump at exit or on SIGUSR1"
+    ap.add_argument("--profile", action="store_true", help=h)
+    h = "Fraction of calls recorded for the hot path timers"
+    ap.add_argument("--metrics-sample-rate", type=float, help=h, default=1.0)
 
     conf = ap.parse_args()
+    setup_metrics_sampling(conf.metrics_sample_rate)
+    normalize.set_yaml_workers(conf.yaml_workers)
 
     if conf.devel or conf.stdout or no_journal_handler:
         format = "%(relativeCreated)d %(process)d %(levelname)s %(name)s %(message)s"
@@ -157,6 +338,31 @@ def setup() -> None:
             conf.clickhouse_url = cp["DEFAULT"]["clickhouse_url"].strip()
 
     setup_dirs(conf, root)
+    if conf.profile:
+        setup_profiler()
+
+
+def setup_metrics_sampling(rate: float) -> None:
+    """Sample the timers called for each measurement"""
+    for stat in HOT_TIMERS + tuple(s.metric for s in scorers.values()):
+        metrics.set_sample_rate(stat, rate)
+
+
+def write_profile(*a) -> None:
+    """Write the profile of this process and of its worker processes.
+    Also used as SIGUSR1 handler."""
+    if not profiler.enabled:
+        return
+    for p in mp.active_children():
+        os.kill(p.pid, signal.SIGUSR1)
+    profiler.dump(conf.vardir / "profile")
+
+
+def setup_profiler() -> None:
+    # The handler is inherited by the worker processes
+    profiler.enabled = True
+    signal.signal(signal.SIGUSR1, write_profile)
+    atexit.register(write_profile)
 
 
 def per_s(name, item_count, t0) -> None:
@@ -168,19 +374,9 @@ def per_s(name, item_count, t0) -> None:
 
 @metrics.timer("clean_caches")
 def clean_caches() -> None:
-    """Cleanup local caches."""
-    # Access times are updated on file load.
-    # FIXME: use cache locations correctly
-    now = time.time()
-    threshold = 3600 * 24 * 3
-    for f in conf.s3cachedir.iterdir():
-        if not f.is_file():
-            continue
-        age_s = now - f.stat().st_atime
-        if age_s > threshold:
-            log.debug("Deleting %s", f)
-            metrics.gauge("deleted_cache_file_age", age_s)
-            # TODO: delete
+    """Evict least recently used cans beyond the cache quota.
+    Eviction also runs whenever a can is added to the cache."""
+    s3feeder.get_cache(conf).evict()
 
 
 # Currently unused: we could warn on missing / unexpected cols
@@ -297,10 +493,147 @@ def process_measurements_from_s3() -> None:
         assert msm_jstr is None or isinstance(msm_jstr, (str, bytes)), type(msm_jstr)
         assert msm is None or isinstance(msm, dict)
         process_measurement(measurement_tup)
+        db.flush_inserts_if_needed()
         if conf.stop_after:
             msmt_cnt += 1
             if msmt_cnt >= conf.stop_after:
-                return
+                break
+
+    db.flush_inserts()
+
+
+def _s3_stop_after_reached(msmt_cnt) -> bool:
+    return bool(conf.stop_after) and msmt_cnt.value >= conf.stop_after
+
+
+def _claim_s3_msmt(msmt_cnt) -> bool:
+    """Count a measurement against --stop-after across S3 workers.
+    Returns False when the limit is reached"""
+    if not conf.stop_after:
+        return True
+    with msmt_cnt.get_lock():
+        if msmt_cnt.value >= conf.stop_after:
+            return False
+        msmt_cnt.value += 1
+        return True
+
+
+def _process_s3_msmts(msmts, msmt_cnt) -> None:
+    for measurement_tup in msmts:
+        if not _claim_s3_msmt(msmt_cnt):
+            break
+        process_measurement(measurement_tup)
+        db.flush_inserts_if_needed()
+
+
+def s3_backfill_worker(work_q, done_q, msmt_cnt) -> None:
+    """S3 worker: fetch, score and write whole cans from the work queue"""
+    db.setup_clickhouse(conf)
+    load_published_fingerprints()
+    s3 = s3feeder.create_s3_client()
+    while True:
+        item = work_q.get()
+        if item is None:
+            break
+
+        day, s3fname, size = item
+        if _s3_stop_after_reached(msmt_cnt):
+            done_q.put(day)  # drain the work queue without downloading
+            continue
+
+        try:
+            ycache = get_yaml_cache(conf)
+            if conf.s3_stream or (ycache and ycache.has(s3fname, size)):
+                msmts = s3feeder.stream_can(s3, conf, s3fname, size)
+                _process_s3_msmts(msmts, msmt_cnt)
+            else:
+                for can_f in s3feeder.fetch_cans(s3, conf, [(s3fname, size)]):
+                    flt = s3feeder.MsmtFilter.from_conf(conf)
+                    fn = can_f.as_posix()
+                    msmts = s3feeder.load_multiple(fn, None, flt, ycache, size)
+                    _process_s3_msmts(msmts, msmt_cnt)
+                    s3feeder.discard_can(conf, can_f)
+        except Exception as e:
+            log.error(str(e), exc_info=True)
+
+        done_q.put(day)
+        load_published_fingerprints()
+
+    db.flush_inserts()
+    flush_metrics()
+    write_profile()
+
+
+def _check_s3_workers(workers) -> None:
+    """Stop all the workers and raise if any of them died"""
+    dead = [w for w in workers if w.exitcode not in (None, 0)]
+    if not dead:
+        return
+    for w in workers:
+        if w.is_alive():
+            w.terminate()
+    [w.join() for w in workers]
+    codes = ", ".join(f"{w.pid}: {w.exitcode}" for w in dead)
+    log.error(f"S3 workers died, exit codes {codes}")
+    metrics.incr("s3_worker_died", len(dead))
+    raise RuntimeError(f"S3 workers died, exit codes {codes}")
+
+
+def _wait_s3_done(done_q, workers):
+    """Wait for a can to be processed, checking that workers are alive.
+    Returns its day"""
+    while True:
+        try:
+            return done_q.get(timeout=S3_WORKER_CHECK_INTERVAL_S)
+        except Empty:
+            _check_s3_workers(workers)
+
+
+def process_measurements_from_s3_parallel() -> None:
+    """Pull measurements from S3 and process them using conf.s3_workers
+    processes. Each can is processed by one worker.
+    Raises RuntimeError if a worker dies: its can would be lost."""
+    stop_day = s3feeder.get_stop_day(conf.start_day, conf.end_day)
+    if stop_day is None:
+        return
+
+    work_q: mp.Queue = mp.Queue()
+    done_q: mp.Queue = mp.Queue()
+    msmt_cnt = mp.Value("Q", 0)
+    setup_fingerprints_snapshot()
+    workers = [
+        mp.Process(target=s3_backfill_worker, args=(work_q, done_q, msmt_cnt))
+        for n in range(conf.s3_workers)
+    ]
+    [w.start() for w in workers]
+    start_fingerprints_publisher()
+
+    t0 = time.time()
+    cans_per_day: Dict[Any, int] = {}
+    done_per_day: Dict[Any, int] = {}
+
+    def track_done(day) -> None:
+        done_per_day[day] = done_per_day.get(day, 0) + 1
+        cn = done_per_day[day] - 1
+        s3feeder._update_eta(t0, conf.start_day, day, stop_day, cn, cans_per_day[day])
+
+    s3 = s3feeder.create_s3_client()
+    days = s3feeder.list_cans_by_day(s3, conf, conf.start_day, stop_day)
+    for day, cans_fns in days:
+        if _s3_stop_after_reached(msmt_cnt):
+            break
+        cans_per_day[day] = len(cans_fns)
+        for s3fname, size in cans_fns:
+            work_q.put((day, s3fname, size))
+        while not done_q.empty():
+            track_done(done_q.get())
+        _check_s3_workers(workers)
+
+    [work_q.put(None) for w in workers]
+    for n in range(sum(cans_per_day.values()) - sum(done_per_day.values())):
+        track_done(_wait_s3_done(done_q, workers))
+    [w.join() for w in workers]
+    _check_s3_workers(workers)
 
 
 def minifp(fp: Fingerprint) -> Dict[str, Any]:
@@ -314,69 +647,120 @@ def minifp(fp: Fingerprint) -> Dict[str, Any]:
     return {k: v for k, v in fp.items() if k in fields}
 
 
-def match_http_body_fingerprints(resp, matches) -> None:
-    # Match HTTP body if found
+def _extract_body(resp):
+    """Returns the HTTP body as str or bytes, or None"""
     body = resp.get("body")
     if isinstance(body, dict):
         if "data" in body and body.get("format", "") == "base64":
             log.debug("Decoding base64 body")
             body = b64decode(body["data"])
-            # returns bytes. bm.encode() below is faster that decoding it
+            # returns bytes, matched against the UTF-8 encoded patterns
         else:
             logbug(2, "incorrect body of type dict", {})
-            return
+            return None
 
-    if body is None:
-        return
+    return body
 
-    for fp in fingerprints["http"]:
-        if fp["location_found"] != "body":
-            continue
-        tb = time.time()
-        bm = fp["pattern"]
-        if isinstance(body, bytes):
-            idx = body.find(bm.encode())
-        else:
-            idx = body.find(bm)
 
-        if idx != -1:
-            matches.append(minifp(fp))
-            log.debug("matched body fp %s", fp["name"])
-            # Used for statistics
-            metrics.gauge("fingerprint_body_match_location", idx)
+class MatchCache:
+    """LRU cache of fingerprint matches for HTTP responses, keyed by a
+    digest of the body and of the headers that have fingerprints.
+    Blockpages are very repetitive and often hit the cache.
+    Cleared when the fingerprints are replaced.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._d: OrderedDict = OrderedDict()
+        self._fingerprints = None  # the fingerprint set the entries refer to
+
+    def check_fingerprints(self, fps) -> None:
+        """Clear the cache if the fingerprints have been replaced"""
+        if self._fingerprints is not fps:
+            self._d.clear()
+            self._fingerprints = fps
+
+    def get(self, key: bytes):
+        v = self._d.get(key)
+        if v is None:
+            metrics.incr("fingerprint_cache_miss")
+            return None
+        metrics.incr("fingerprint_cache_hit")
+        self._d.move_to_end(key)
+        return v
+
+    def put(self, key: bytes, v) -> None:
+        self._d[key] = v
+        if len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._d)
+
 
-        per_s("fingerprints_bytes", len(body), tb)
+# Entries hold a 16 bytes key and references to fingerprints
+MATCH_CACHE_SIZE = 50_000
+match_cache = MatchCache(MATCH_CACHE_SIZE)
 
 
-def match_http_headers_fingerprints(resp, matches) -> None:
-    # Match HTTP headers if found
+def _response_digest(body, headers: dict) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    if body is None:
+        h.update(b"n")
+    elif isinstance(body, bytes):
+        h.update(b"b%d:" % len(body))
+        h.update(body)
+    else:
+        b = body.encode("utf-8", "surrogatepass")
+        h.update(b"s%d:" % len(b))
+        h.update(b)
+
+    for k, v in sorted(headers.items()):
+        if not isinstance(v, str):
+            v = repr(v)
+        kv = f"{k}:{v}".encode("utf-8", "surrogatepass")
+        h.update(b"h%d:" % len(kv))
+        h.update(kv)
+
+    return h.digest()
+
+
+def match_http_fingerprints(resp, matches) -> None:
+    """Match HTTP body and header fingerprints using match_cache"""
+    body = _extract_body(resp)
     headers = g_or(resp, "headers", {})
-    if not headers:
-        return
+    hnames = fingerprints["http_headers"].names
     headers = {h.lower(): v for h, v in headers.items()}
-    for fp in fingerprints["http"]:
-        loc_found = fp["location_found"]
-        if not loc_found.startswith("header."):
-            continue
-        pat_type = fp["pattern_type"]
-        hname = loc_found[8:]
-        if pat_type == "full":
-            if headers.get(hname) == fp["pattern"]:
-                matches.append(minifp(fp))
-                log.debug("matched header full %s", fp["name"])
-
-        elif pat_type == "prefix":
-            prefix = fp["pattern"]
-            v = headers.get(hname)
-            if isinstance(v, dict) and v.get("format") == "base64":
-                log.debug("Decoding base64 header")
-                data = b64decode(v.get("data", ""))
-                v = data.decode("latin1")
-            if isinstance(v, str) and v.startswith(prefix):
-                matches.append(minifp(fp))
-                log.debug("matched header prefix %s", fp["name"])
-
+    headers = {h: v for h, v in headers.items() if h in hnames}
+    if body is None and not headers:
+        return
 
+    match_cache.check_fingerprints(fingerprints)
+    key = _response_digest(body, headers)
+    cached = match_cache.get(key)
+    if cached is None:
+        tb = time.time()
+        body_matches = []
+        if body is not None:
+            body_matches = fingerprints["http_body"].find_all(body)
+            per_s("fingerprints_bytes", len(body), tb)
+        hdr_matches = fingerprints["http_headers"].find_all(headers)
+        cached = (body_matches, hdr_matches)
+        match_cache.put(key, cached)
+
+    body_matches, hdr_matches = cached
+    for fp, idx in body_matches:
+        matches.append(minifp(fp))
+        log.debug("matched body fp %s", fp["name"])
+        # Used for statistics
+        metrics.gauge("fingerprint_body_match_location", idx)
+
+    for fp in hdr_matches:
+        matches.append(minifp(fp))
+        log.debug("matched header %s %s", fp["pattern_type"], fp["name"])
+
+
+@profiler.profile("match_fingerprints")
 @metrics.timer("match_fingerprints")
 def match_fingerprints(measurement) -> list:
     """Match fingerprints against HTTP headers, bodies and DNS.
@@ -389,19 +773,18 @@ def match_fingerprints(measurement) -> list:
         return []
 
     matches = []
+    dns_index = fingerprints["dns_index"]
     queries = g_or(test_keys, "queries", ())
     for q in queries:
         for answer in g_or(q, "answers", ()):
-            for fp in fingerprints["dns"]:
-                addr = ""
-                if "ipv4" in answer:
-                    addr = answer["ipv4"]
-                elif "hostname" in answer:
-                    addr = answer["hostname"]
-                elif "ipv6" in answer:
-                    addr = answer["ipv6"]
-                if addr == fp["pattern"]:
-                    matches.append(fp)
+            addr = ""
+            if "ipv4" in answer:
+                addr = answer["ipv4"]
+            elif "hostname" in answer:
+                addr = answer["hostname"]
+            elif "ipv6" in answer:
+                addr = answer["ipv6"]
+            matches.extend(dns_index.get(addr, ()))
 
     requests = g_or(test_keys, "requests", ())
     for req in requests:
@@ -409,8 +792,7 @@ def match_fingerprints(measurement) -> list:
         if resp is None:
             continue
 
-        match_http_body_fingerprints(resp, matches)
-        match_http_headers_fingerprints(resp, matches)
+        match_http_fingerprints(resp, matches)
 
     return matches
 
@@ -496,7 +878,59 @@ def init_scores() -> dict:
     return {f"blocking_{lv}": 0.0 for lv in LOCALITY_VALS}
 
 
-@metrics.timer("score_measurement_facebook_messenger")
+@dataclass
+class Scorer:
+    func: Callable[[dict], dict]
+    # test_keys fields read by the scorer. None means any field can be read
+    test_keys: Optional[Tuple[str, ...]]
+    # Timer metric name
+    metric: str
+
+
+# test_name -> Scorer, populated by @register_scorer
+scorers: Dict[str, Scorer] = {}
+
+
+def register_scorer(
+    test_name: str,
+    test_keys: Optional[Tuple[str, ...]] = None,
+    metric: Optional[str] = None,
+):
+    """Decorator registering a scoring function for a test_name.
+    Declare the test_keys fields the function reads, if known.
+    The scorer is timed as score_<test_name> unless metric is set.
+    """
+
+    def decorator(func):
+        assert test_name not in scorers, f"Duplicate scorer for {test_name}"
+        m = metric or f"score_{test_name}"
+        scorers[test_name] = Scorer(func=func, test_keys=test_keys, metric=m)
+        return func
+
+    return decorator
+
+
+@register_scorer(
+    "facebook_messenger",
+    test_keys=(
+        "facebook_b_api_dns_consistent",
+        "facebook_b_api_reachable",
+        "facebook_b_graph_dns_consistent",
+        "facebook_b_graph_reachable",
+        "facebook_dns_blocking",
+        "facebook_edge_dns_consistent",
+        "facebook_edge_reachable",
+        "facebook_external_cdn_dns_consistent",
+        "facebook_external_cdn_reachable",
+        "facebook_scontent_cdn_dns_consistent",
+        "facebook_scontent_cdn_reachable",
+        "facebook_star_dns_consistent",
+        "facebook_star_reachable",
+        "facebook_stun_dns_consistent",
+        "facebook_tcp_blocking",
+    ),
+    metric="score_measurement_facebook_messenger",
+)
 def score_measurement_facebook_messenger(msm: dict) -> dict:
     tk = g_or(msm, "test_keys", {})
     del msm
@@ -578,7 +1012,11 @@ def _extract_tcp_connect(tk: dict) -> tuple:
     return accessible_endpoints, unreachable_endpoints
 
 
-@metrics.timer("score_measurement_telegram")
+@register_scorer(
+    "telegram",
+    test_keys=("telegram_web_status", "tcp_connect", "requests"),
+    metric="score_measurement_telegram",
+)
 def score_measurement_telegram(msm: dict) -> dict:
     """Calculate measurement scoring for Telegram.
     Returns a scores dict
@@ -657,7 +1095,11 @@ def score_measurement_telegram(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_measurement_hhfm")
+@register_scorer(
+    "http_header_field_manipulation",
+    test_keys=("requests",),
+    metric="score_measurement_hhfm",
+)
 def score_measurement_hhfm(msm: dict) -> dict:
     """Calculate http_header_field_manipulation"""
     tk = g_or(msm, "test_keys", {})
@@ -729,7 +1171,7 @@ def score_measurement_hhfm(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_http_invalid_request_line")
+@register_scorer("http_invalid_request_line", test_keys=("sent", "received"))
 def score_http_invalid_request_line(msm: dict) -> dict:
     """Calculate measurement scoring for http_invalid_request_line"""
     # https://github.com/ooni/spec/blob/master/nettests/ts-007-http-invalid-request-line.md
@@ -794,7 +1236,7 @@ def get_http_header(resp, header_name, case_sensitive=False):
     return values
 
 
-@metrics.timer("score_measurement_whatsapp")
+@register_scorer("whatsapp", metric="score_measurement_whatsapp")
 def score_measurement_whatsapp(msm: dict) -> dict:
     """Calculate measurement scoring for Whatsapp.
     Returns a scores dict
@@ -905,7 +1347,17 @@ def score_measurement_whatsapp(msm: dict) -> dict:
     return scores
 
 
-@metrics.timer("score_vanilla_tor")
+@register_scorer(
+    "vanilla_tor",
+    test_keys=(
+        "error",
+        "success",
+        "tor_log",
+        "tor_progress",
+        "tor_progress_summary",
+        "tor_progress_tag",
+    ),
+)
 def score_vanilla_tor(msm: dict) -> dict:
     """Calculate measurement scoring for Tor (test_name: vanilla_tor)
     Returns a scores dict
@@ -954,7 +1406,6 @@ def is_confirmed(probe_cc: str, fp: Fingerprint) -> bool:
     return False
 
 
-@metrics.timer("score_web_connectivity")
 def score_web_connectivity(msm: dict, matches: list) -> dict:
     """Calculate measurement scoring for web connectivity
     Returns a scores dict
@@ -1041,6 +1492,7 @@ def score_web_connectivity(msm: dict, matches: list) -> dict:
     return scores
 
 
+@register_scorer("web_connectivity")
 def score_web_connectivity_full(msm: dict) -> dict:
     try:
         matches = match_fingerprints(msm)
@@ -1052,7 +1504,7 @@ def score_web_connectivity_full(msm: dict) -> dict:
     return score_web_connectivity(msm, matches)
 
 
-@metrics.timer("score_ndt")
+@register_scorer("ndt", test_keys=())
 def score_ndt(msm: dict) -> dict:
     """Calculate measurement scoring for NDT
     Returns a scores dict
@@ -1061,7 +1513,7 @@ def score_ndt(msm: dict) -> dict:
     return {}
 
 
-@metrics.timer("score_tcp_connect")
+@register_scorer("tcp_connect", test_keys=("connection",))
 def score_tcp_connect(msm: dict) -> dict:
     """Calculate measurement scoring for tcp connect
     Returns a scores dict
@@ -1098,6 +1550,7 @@ def score_tcp_connect(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("dash")
 def score_dash(msm: dict) -> dict:
     """Calculate measurement scoring for DASH
     (Dynamic Adaptive Streaming over HTTP)
@@ -1151,6 +1604,7 @@ def score_dash(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("meek_fronted_requests_test", test_keys=("requests", "success"))
 def score_meek_fronted_requests_test(msm: dict) -> dict:
     """Calculate measurement scoring for Meek
     Returns a scores dict
@@ -1194,6 +1648,7 @@ def score_meek_fronted_requests_test(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("psiphon", test_keys=("failure", "bootstrap_time"))
 def score_psiphon(msm: dict) -> dict:
     """Calculate measurement scoring for Psiphon
     Returns a scores dict
@@ -1230,6 +1685,7 @@ def score_psiphon(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("tor", test_keys=("targets",))
 def score_tor(msm: dict) -> dict:
     """Calculate measurement scoring for Tor (test_name: tor)
     https://github.com/ooni/spec/blob/master/nettests/ts-023-tor.md
@@ -1284,6 +1740,9 @@ def score_tor(msm: dict) -> dict:
     return scores
 
 
+@register_scorer(
+    "http_requests", test_keys=("body_length_match", "headers_match", "requests")
+)
 def score_http_requests(msm: dict) -> dict:
     """Calculates measurement scoring for legacy test http_requests
     Returns a scores dict
@@ -1315,8 +1774,7 @@ def score_http_requests(msm: dict) -> dict:
         if is_tor:
             continue
         resp = g_or(req, "response", {})
-        match_http_body_fingerprints(resp, matches)
-        match_http_headers_fingerprints(resp, matches)
+        match_http_fingerprints(resp, matches)
 
     if matches:
         scores["fingerprints"] = [minifp(fp) for fp in matches]
@@ -1332,6 +1790,7 @@ def score_http_requests(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("dns_consistency", test_keys=())
 def score_dns_consistency(msm: dict) -> dict:
     """Calculates measurement scoring for legacy test dns_consistency
     Returns a scores dict
@@ -1341,6 +1800,15 @@ def score_dns_consistency(msm: dict) -> dict:
     return scores
 
 
+@register_scorer(
+    "signal",
+    test_keys=(
+        "failed_operation",
+        "failure",
+        "signal_backend_status",
+        "signal_backend_failure",
+    ),
+)
 def score_signal(msm: dict) -> dict:
     """Calculates measurement scoring for Signal test
     Returns a scores dict
@@ -1378,6 +1846,7 @@ def score_signal(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("stunreachability", test_keys=("endpoint", "failure"))
 def score_stunreachability(msm: dict) -> dict:
     """Calculate measurement scoring for STUN reachability
     Returns a scores dict
@@ -1394,6 +1863,7 @@ def score_stunreachability(msm: dict) -> dict:
     return scores
 
 
+@register_scorer("torsf", test_keys=("failure", "bootstrap_time"))
 def score_torsf(msm: dict) -> dict:
     """Calculate measurement scoring for Tor Snowflake
     Returns a scores dict
@@ -1412,6 +1882,9 @@ def score_torsf(msm: dict) -> dict:
     return scores
 
 
+@register_scorer(
+    "riseupvpn", test_keys=("transport_status", "api_status", "ca_cert_status")
+)
 def score_riseupvpn(msm: dict) -> dict:
     """Calculate measurement scoring for RiseUp VPN
     Returns a scores dict
@@ -1435,6 +1908,8 @@ def score_riseupvpn(msm: dict) -> dict:
     return scores
 
 
+# clickhouse_upsert_openvpn_obs reads many more test_keys fields
+@register_scorer("openvpn")
 def score_openvpn(msm: dict) -> dict:
     # Based on discussion with Ain on 2022-11-09. We are going to implement
     # more complex scoring when the test is stable
@@ -1457,50 +1932,18 @@ def score_measurement(msm: dict) -> dict:
 
     tn = msm["test_name"]
     try:
-        if tn == "telegram":
-            return score_measurement_telegram(msm)
-        if tn == "facebook_messenger":
-            return score_measurement_facebook_messenger(msm)
-        if tn == "http_header_field_manipulation":
-            return score_measurement_hhfm(msm)
-        if tn == "http_invalid_request_line":
-            return score_http_invalid_request_line(msm)
-        if tn == "whatsapp":
-            return score_measurement_whatsapp(msm)
-        if tn == "vanilla_tor":
-            return score_vanilla_tor(msm)
-        if tn == "web_connectivity":
-            return score_web_connectivity_full(msm)
-        if tn == "ndt":
-            return score_ndt(msm)
-        if tn == "tcp_connect":
-            return score_tcp_connect(msm)
-        if tn == "dash":
-            return score_dash(msm)
-        if tn == "meek_fronted_requests_test":
-            return score_meek_fronted_requests_test(msm)
-        if tn == "psiphon":
-            return score_psiphon(msm)
-        if tn == "tor":
-            return score_tor(msm)
-        if tn == "http_requests":
-            return score_http_requests(msm)
-        if tn == "dns_consistency":
-            return score_dns_consistency(msm)
-        if tn == "signal":
-            return score_signal(msm)
-        if tn == "stunreachability":
-            return score_stunreachability(msm)
-        if tn == "torsf":
-            return score_torsf(msm)
-        if tn == "riseupvpn":
-            return score_riseupvpn(msm)
-        if tn == "openvpn":
-            return score_openvpn(msm)
-
-        log.debug("Unsupported test name %s", tn)
-        scores = init_scores()
-        scores["accuracy"] = 0.0
+        scorer = scorers.get(tn)
+        if scorer is None:
+            log.debug("Unsupported test name %s", tn)
+            metrics.incr("score_unsupported")
+            scores = init_scores()
+            scores["accuracy"] = 0.0
+            return scores
+
+        t0 = time.time()
+        scores = scorer.func(msm)
+        # Call count and timing for each scorer
+        metrics.timing(scorer.metric, (time.time() - t0) * 1000)
         return scores
 
     except AssertionError as e:
@@ -1526,16 +1969,26 @@ def msm_processor(queue):
     """Measurement processor worker"""
     # Each spawned worker process has its own clickhouse connection
     db.setup_clickhouse(conf)
-    update_fingerprints_if_needed()
+    load_published_fingerprints()
 
     while True:
-        msm_tup = queue.get()
+        try:
+            msm_tup = queue.get(timeout=db.INSERT_BATCH_MAX_AGE_S)
+        except Empty:
+            # Idle: do not keep buffered rows around for too long
+            db.flush_inserts_if_needed()
+            continue
+
         if msm_tup is None:
+            db.flush_inserts()
+            flush_metrics()
+            write_profile()
             log.info("Worker with PID %d exiting", os.getpid())
             return
 
         process_measurement(msm_tup)
-        update_fingerprints_if_needed()
+        db.flush_inserts_if_needed()
+        load_published_fingerprints()
 
 
 def flag_measurements_with_wrong_date(msm: dict, msmt_uid: str, scores: dict) -> None:
@@ -1559,21 +2012,26 @@ def flag_measurements_with_wrong_date(msm: dict, msmt_uid: str, scores: dict) ->
         scores["msg"] = "Measurement start time too old"
 
 
+@profiler.profile("process_measurement")
 @metrics.timer("full_run")
 def process_measurement(msm_tup) -> None:
     """Process a measurement:
-    - Parse JSON if needed
+    - Parse JSON if needed, decoding test_keys only after the envelope checks
     - Unwrap "content" key if needed
     - Score it
-    - Upsert to fastpath table unless no_write_to_db is set
+    - Buffer upsert to fastpath table unless no_write_to_db is set
     """
     try:
         msm_jstr, measurement, msmt_uid = msm_tup
         assert msmt_uid
+        load_test_keys = None
         if measurement is None:
-            measurement = ujson.loads(msm_jstr)
+            with profiler.stage("parse"):
+                measurement, load_test_keys = lazyjson.load_envelope(msm_jstr)
         if sorted(measurement.keys()) == ["content", "format"]:
-            measurement = unwrap_msmt(measurement)
+            with profiler.stage("unwrap"):
+                measurement = unwrap_msmt(measurement)
+        profiler.set_test_name(measurement.get("test_name"))
         rid = measurement.get("report_id")
         inp = measurement.get("input")
         log.debug(f"Processing {msmt_uid} {rid} {inp}")
@@ -1592,7 +2050,14 @@ def process_measurement(msm_tup) -> None:
             metrics.incr("discarded_measurement")
             return
 
-        scores = score_measurement(measurement)
+        if load_test_keys is not None:
+            with profiler.stage("parse_test_keys"):
+                scorer = scorers.get(measurement.get("test_name"))
+                # Decode only the test_keys fields read by the scorer
+                load_test_keys(scorer.test_keys if scorer else ())
+
+        with profiler.stage("score"):
+            scores = score_measurement(measurement)
         flag_measurements_with_wrong_date(measurement, msmt_uid, scores)
 
         # Generate anomaly, confirmed and failure to keep consistency
@@ -1624,27 +2089,28 @@ def process_measurement(msm_tup) -> None:
         engine_version = g_or(annot, "engine_version", "")
         blocking_type = g(scores, "analysis", "blocking_type", default="")
 
-        db.clickhouse_upsert_summary(
-            measurement,
-            scores,
-            anomaly,
-            confirmed,
-            failure,
-            blocking_type,
-            msmt_uid,
-            sw_name,
-            sw_version,
-            platform,
-            test_version,
-            test_runtime,
-            architecture,
-            engine_name,
-            engine_version,
-        )
-
-        tn = measurement.get("test_name")
-        if tn == "openvpn":
-            db.clickhouse_upsert_openvpn_obs(measurement, scores, msmt_uid)
+        with profiler.stage("db_insert"):
+            db.clickhouse_upsert_summary(
+                measurement,
+                scores,
+                anomaly,
+                confirmed,
+                failure,
+                blocking_type,
+                msmt_uid,
+                sw_name,
+                sw_version,
+                platform,
+                test_version,
+                test_runtime,
+                architecture,
+                engine_name,
+                engine_version,
+            )
+
+            tn = measurement.get("test_name")
+            if tn == "openvpn":
+                db.clickhouse_upsert_openvpn_obs(measurement, scores, msmt_uid)
 
     except Exception as e:
         log.exception(e)
@@ -1668,19 +2134,25 @@ def core():
 
     if conf.noapi:
         # Process measurements from S3
-        process_measurements_from_s3()
+        if conf.s3_workers > 1:
+            process_measurements_from_s3_parallel()
+        else:
+            process_measurements_from_s3()
         return
 
     # Spawn worker processes
     # 'queue' is a singleton from the portable_queue module
+    queue.setup()
+    setup_fingerprints_snapshot()
     workers = [
         mp.Process(target=msm_processor, args=(queue,)) for n in range(NUM_WORKERS)
     ]
     try:
         [t.start() for t in workers]
+        start_fingerprints_publisher()
         # Start HTTP API
         log.info("Starting HTTP API")
-        start_http_api(queue)
+        start_http_api(queue, conf.max_backlog)
 
     except Exception as e:
         log.exception(e)
@@ -1704,15 +2176,32 @@ def extract_expected_countries(ec):
     return sorted(ecs)
 
 
+def build_dns_index(dns: List[Fingerprint]) -> Dict[str, List[Fingerprint]]:
+    """Map each DNS pattern to its fingerprints, in fingerprint order"""
+    index: Dict[str, List[Fingerprint]] = {}
+    for fp in dns:
+        index.setdefault(fp["pattern"], []).append(fp)
+    return index
+
+
 @metrics.timer("prepare_fingerprints")
 def prepare_fingerprints(dns_fp, http_fp):
+    """Prepare fingerprints and lookup structures. The structures are built
+    together with the fingerprints list and replaced on each update.
+    """
     for fp in dns_fp + http_fp:
         exp = extract_expected_countries(fp["expected_countries"])
         fp["expected_countries"] = exp
 
     dns = [Fingerprint(**fp) for fp in dns_fp]
     http = [Fingerprint(**fp) for fp in http_fp]
-    return dict(dns=dns, http=http)
+    return dict(
+        dns=dns,
+        dns_index=build_dns_index(dns),
+        http=http,
+        http_body=BodyMatcher(http),
+        http_headers=HeaderMatcher(http),
+    )
 
 
 def update_fingerprints_if_needed() -> None:
@@ -1739,6 +2228,61 @@ def update_fingerprints_if_needed() -> None:
     log.info("Updating fingerprints")
     dns_fp, http_fp = db.fetch_fingerprints()
     fingerprints = prepare_fingerprints(dns_fp, http_fp)
+    match_cache.check_fingerprints(fingerprints)
+
+
+def publish_fingerprints() -> None:
+    """Fetch and prepare the fingerprints and publish them to the workers.
+    The connection is closed after the query: it must not be inherited by
+    workers forked later."""
+    global fingerprints
+    log.info("Updating fingerprints")
+    db.setup_clickhouse(conf)
+    try:
+        dns_fp, http_fp = db.fetch_fingerprints()
+    finally:
+        db.close_clickhouse()
+    fingerprints = prepare_fingerprints(dns_fp, http_fp)
+    match_cache.check_fingerprints(fingerprints)
+    version = fingerprints_snapshot.publish(fingerprints)
+    log.info(f"Published fingerprints version {version}")
+
+
+def setup_fingerprints_snapshot() -> None:
+    """Load the fingerprints in the parent process before forking workers.
+    The workers inherit them and then unpickle each update from the snapshot
+    without querying the database or preparing the matchers."""
+    global fingerprints_snapshot
+    fingerprints_snapshot = SharedSnapshot()
+    publish_fingerprints()
+
+
+def fingerprints_publisher() -> None:
+    while True:
+        time.sleep(FINGERPRINTS_UPDATE_INTERVAL)
+        try:
+            publish_fingerprints()
+        except Exception as e:
+            log.exception(e)
+
+
+def start_fingerprints_publisher() -> None:
+    """Refresh the fingerprints snapshot periodically from a parent thread.
+    Call after forking the workers."""
+    t = threading.Thread(target=fingerprints_publisher, daemon=True)
+    t.start()
+
+
+def load_published_fingerprints() -> None:
+    """Switch to the latest fingerprints published by the parent process.
+    Each worker unpickles its own copy of the update: the query and the
+    preparation are done once, but the memory is not shared."""
+    global fingerprints
+    new = fingerprints_snapshot.load_if_changed()
+    if new is not None:
+        fingerprints = new
+        match_cache.check_fingerprints(fingerprints)
+        metrics.incr("fingerprints_reloaded")
 
 
 def main():
@@ -7,11 +7,13 @@ See ../../oometa/017-fastpath.install.sql for the tables structure
 
 """
 
+from dataclasses import dataclass, field
 from datetime import datetime
 from textwrap import dedent
 from urllib.parse import urlparse
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import logging
+import time
 
 try:
     # debdeps: python3-clickhouse-driver
@@ -21,6 +23,7 @@ except ImportError:
 import ujson
 
 from fastpath.metrics import setup_metrics
+from fastpath.profiler import profiler
 from fastpath.utils import dget_or
 
 log = logging.getLogger("fastpath.db")
@@ -28,6 +31,24 @@ metrics = setup_metrics(name="fastpath.db")
 
 click_client: Clickhouse
 
+# Rows are buffered per table and inserted in batches to avoid one round trip
+# and one tiny ClickHouse part for each measurement.
+# A table is flushed when it reaches INSERT_BATCH_MAX_ROWS rows or when its
+# oldest row is older than INSERT_BATCH_MAX_AGE_S seconds.
+INSERT_BATCH_MAX_ROWS = 1000
+INSERT_BATCH_MAX_AGE_S = 5.0
+
+
+@dataclass
+class InsertBuffer:
+    sql_insert: str
+    rows: list = field(default_factory=list)
+    t0: float = 0.0  # arrival time of the oldest buffered row
+
+
+# Each worker process has its own buffers, like its own click_client
+insert_buffers: Dict[str, InsertBuffer] = {}
+
 
 def extract_input_domain(msm: dict, test_name: str) -> Tuple[str, str]:
     """Extract domain and handle special case meek_fronted_requests_test"""
@@ -139,6 +160,82 @@ def setup_clickhouse(conf) -> None:
     # FIXME _click_create_table_fastpath()
 
 
+def close_clickhouse() -> None:
+    """Disconnect, e.g. before forking processes that would share the socket"""
+    client = globals().get("click_client")
+    if client is not None:
+        client.disconnect()
+
+
+def _update_pending_rows_metric() -> None:
+    pending = sum(len(buf.rows) for buf in insert_buffers.values())
+    metrics.gauge("insert_rows_pending", pending)
+
+
+def _flush_table(table: str, buf: InsertBuffer) -> None:
+    """Insert all buffered rows for a table in one query"""
+    if not buf.rows:
+        return
+    rows, buf.rows = buf.rows, []
+    metrics.gauge(f"flush_{table}_size", len(rows))
+    settings = {"priority": 5}
+    with metrics.timer(f"flush_{table}"), profiler.stage("db_flush"):
+        _insert_rows(table, buf.sql_insert, rows, settings)
+
+
+def _insert_rows(table: str, sql_insert: str, rows: list, settings: dict) -> None:
+    """Insert rows. On failure split the batch in halves and retry so that
+    only the rows that cannot be inserted are dropped
+    """
+    try:
+        click_client.execute(sql_insert, rows, settings=settings)
+        return
+    except Exception:
+        if len(rows) == 1:
+            uid = rows[0].get("measurement_uid")
+            log.error(f"Failed Clickhouse insert into {table} {uid}", exc_info=True)
+            metrics.incr("dropped_rows")
+            return
+
+    log.info(f"Failed Clickhouse insert of {len(rows)} rows, retrying in halves")
+    half = len(rows) // 2
+    _insert_rows(table, sql_insert, rows[:half], settings)
+    _insert_rows(table, sql_insert, rows[half:], settings)
+
+
+def buffer_insert(table: str, sql_insert: str, row: dict) -> None:
+    """Buffer a row for insertion. Flush the table if it's full"""
+    buf = insert_buffers.get(table)
+    if buf is None:
+        buf = InsertBuffer(sql_insert=sql_insert)
+        insert_buffers[table] = buf
+    if not buf.rows:
+        buf.t0 = time.time()
+    buf.rows.append(row)
+    if len(buf.rows) >= INSERT_BATCH_MAX_ROWS:
+        _flush_table(table, buf)
+    _update_pending_rows_metric()
+
+
+def flush_inserts_if_needed() -> None:
+    """Flush tables where the oldest buffered row is too old"""
+    now = time.time()
+    flushed = False
+    for table, buf in insert_buffers.items():
+        if buf.rows and now - buf.t0 >= INSERT_BATCH_MAX_AGE_S:
+            _flush_table(table, buf)
+            flushed = True
+    if flushed:
+        _update_pending_rows_metric()
+
+
+def flush_inserts() -> None:
+    """Flush all buffered rows. Call before exiting"""
+    for table, buf in insert_buffers.items():
+        _flush_table(table, buf)
+    _update_pending_rows_metric()
+
+
 @metrics.timer("clickhouse_upsert_summary")
 def clickhouse_upsert_summary(
     msm,
@@ -157,7 +254,7 @@ def clickhouse_upsert_summary(
     engine_name: str,
     engine_version: str,
 ) -> None:
-    """Insert a row in the fastpath table. Overwrite an existing one."""
+    """Buffer a row for the fastpath table. Overwrite an existing one."""
     sql_insert = dedent(
         """\
     INSERT INTO fastpath (
@@ -229,11 +326,7 @@ def clickhouse_upsert_summary(
         engine_version=engine_version,
     )
 
-    settings = {"priority": 5}
-    try:
-        click_client.execute(sql_insert, [row], settings=settings)
-    except Exception:
-        log.error("Failed Clickhouse insert", exc_info=True)
+    buffer_insert("fastpath", sql_insert, row)
 
     # Future feature extraction:
     # def getint(features: dict, k: str, default: int) -> int:
@@ -365,11 +458,7 @@ def clickhouse_upsert_openvpn_obs(
         transport=nn(tk, "transport"),
     )
 
-    settings = {"priority": 5}
-    try:
-        click_client.execute(sql_insert, [row], settings=settings)
-    except Exception:
-        log.error("Failed Clickhouse insert", exc_info=True)
+    buffer_insert("obs_openvpn", sql_insert, row)
 
 
 def query(query: str, query_params: dict, query_prio=5):
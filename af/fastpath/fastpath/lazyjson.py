@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy, field-selective measurement parsing
+
+The envelope of a measurement (all the top level fields but test_keys) is
+decoded first. test_keys, usually the largest part of the body, is decoded
+later and only for the fields needed by the scorer, or not at all for
+measurements that are discarded.
+
+Uses simdjson, parsing on demand, if available. Otherwise falls back to
+decoding the whole body with ujson.
+"""
+
+from typing import Callable, Optional, Tuple
+
+import ujson
+
+try:
+    import simdjson  # debdeps: python3-simdjson
+except ImportError:
+    simdjson = None
+
+# Decodes test_keys into the measurement. Called with None decodes all
+# the fields, with a tuple only the given fields.
+TestKeysLoader = Callable[[Optional[Tuple[str, ...]]], None]
+
+_parser = None
+
+
+def _noop_loader(fields) -> None:
+    pass
+
+
+def _parse(raw: bytes):
+    global _parser
+    if _parser is None:
+        _parser = simdjson.Parser()
+    try:
+        return _parser.parse(raw)
+    except RuntimeError:
+        # The previous document is still referenced, e.g. by a traceback
+        _parser = simdjson.Parser()
+        return _parser.parse(raw)
+
+
+def _py(v):
+    """Convert simdjson proxies to Python objects"""
+    if isinstance(v, simdjson.Object):
+        return v.as_dict()
+    if isinstance(v, simdjson.Array):
+        return v.as_list()
+    return v
+
+
+def load_envelope(raw) -> Tuple[dict, TestKeysLoader]:
+    """Parse a measurement without decoding test_keys.
+    Returns the measurement and a function to decode test_keys into it.
+    Call the function, or drop it, before parsing another measurement.
+    Posts wrapped in {"format": "json", "content": ...} are unwrapped.
+    """
+    if simdjson is None:
+        return ujson.loads(raw), _noop_loader
+
+    if isinstance(raw, str):
+        raw = raw.encode()
+    doc = _parse(raw)
+    if not isinstance(doc, simdjson.Object):
+        return _py(doc), _noop_loader
+
+    if sorted(doc.keys()) == ["content", "format"]:
+        fmt = doc["format"]
+        content = doc["content"]
+        if not isinstance(fmt, str) or fmt.lower() != "json":
+            return doc.as_dict(), _noop_loader  # unwrapped by the caller
+        if not isinstance(content, simdjson.Object):
+            return doc.as_dict(), _noop_loader
+        doc = content
+
+    msm = {k: _py(doc[k]) for k in doc.keys() if k != "test_keys"}
+    if "test_keys" not in doc:
+        return msm, _noop_loader
+
+    def load_test_keys(fields: Optional[Tuple[str, ...]]) -> None:
+        nonlocal doc
+        if doc is None:
+            return
+        tk = doc["test_keys"]
+        if fields is None or not isinstance(tk, simdjson.Object):
+            msm["test_keys"] = _py(tk)
+        else:
+            msm["test_keys"] = {f: _py(tk[f]) for f in fields if f in tk}
+        doc = None  # release the parser
+
+    return msm, load_test_keys
@@ -3,44 +3,220 @@
 
 """
 Receive measurements by listening on localhost
+
+POST /<msmt_uid> with the measurement as body
+Returns 200 when the measurement is enqueued, 429 when the backlog is above
+the limit and 503 when the queue is full. Clients should retry on 429/503.
+
+POST /batch with a sequence of records, each one being:
+    <msmt_uid> <body length>\n<body>
+Returns 200 and a JSON list with one HTTP status for each record, in order.
+Accepted records are enqueued in one operation. Malformed batches get 400.
 """
 
+from queue import Full
+from typing import List, Optional, Tuple
+import asyncio
+import logging
 import time
-from gunicorn.app.base import BaseApplication
+
+import ujson
+
+from fastpath.metrics import setup_metrics
 
 API_PORT = 8472
+MAX_BACKLOG = 5000
+MAX_BODY_SIZE = 64 * 1024 * 1024
+RETRY_AFTER_S = 1
+
+log = logging.getLogger("fastpath.localhttpfeeder")
+metrics = setup_metrics(name="fastpath.localhttpfeeder")
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    411: "Length Required",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    503: "Service Unavailable",
+}
+
+
+def _response(status: int, keep_alive: bool, body: bytes = b"") -> bytes:
+    hdrs = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Length: {len(body)}"]
+    if body:
+        hdrs.append("Content-Type: application/json")
+    if status in (429, 503):
+        hdrs.append(f"Retry-After: {RETRY_AFTER_S}")
+    if not keep_alive:
+        hdrs.append("Connection: close")
+    return ("\r\n".join(hdrs) + "\r\n\r\n").encode() + body
+
+
+async def _read_request(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[str, str, dict, Optional[int]]]:
+    """Read request line and headers. Returns None on EOF"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, version = line.decode("latin1").split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, v = line.decode("latin1").split(":", 1)
+        headers[k.strip().lower()] = v.strip()
+
+    cl = headers.get("content-length")
+    length = int(cl) if cl is not None else None
+    if length is not None and length < 0:
+        raise ValueError(f"Invalid Content-Length {cl}")
+    if version == "HTTP/1.0":
+        headers.setdefault("connection", "close")
+    return method, path, headers, length
+
+
+def handle_post(queue, max_backlog: int, path: str, data: bytes, t0: float) -> int:
+    """Enqueue a measurement. Returns the HTTP status"""
+    if not path.startswith("/2"):
+        return 404
+    msmt_uid = path[1:]
+
+    depth = queue.qsize()
+    metrics.gauge("queue_depth", depth)
+    if depth >= max_backlog:
+        metrics.incr("rejected_backlog")
+        return 429
+
+    try:
+        queue.put((data, None, msmt_uid), block=False)
+    except Full:
+        metrics.incr("rejected_queue_full")
+        return 503
+    except ValueError:  # larger than the whole queue
+        return 413
+
+    metrics.timing("accept_to_enqueue", (time.time() - t0) * 1000)
+    metrics.incr("accepted")
+    return 200
+
+
+def parse_batch(data: bytes) -> List[Tuple[str, bytes]]:
+    """Split a batch into (msmt_uid, body) records. Raises ValueError"""
+    records = []
+    mv = memoryview(data)
+    pos = 0
+    while pos < len(data):
+        eol = data.index(b"\n", pos)
+        uid, length = data[pos:eol].decode().split(" ")
+        if not length.isdigit():
+            raise ValueError("Invalid record length")
+        end = eol + 1 + int(length)
+        if end > len(data):
+            raise ValueError("Truncated record")
+        records.append((uid, bytes(mv[eol + 1 : end])))
+        pos = end
+    return records
+
+
+def handle_batch_post(queue, max_backlog: int, data: bytes, t0: float) -> bytes:
+    """Enqueue a batch of measurements in one operation.
+    Returns the JSON encoded list of per-record statuses
+    """
+    records = parse_batch(data)
+    statuses = [200 if uid.startswith("2") else 400 for uid, _ in records]
+
+    depth = queue.qsize()
+    metrics.gauge("queue_depth", depth)
+    room = max(max_backlog - depth, 0)
+    items = []
+    for n, (uid, body) in enumerate(records):
+        if statuses[n] != 200:
+            continue
+        if len(items) >= room:
+            statuses[n] = 429
+            continue
+        items.append((body, None, uid))
+
+    try:
+        queue.put_many(items, block=False)
+    except Full:
+        metrics.incr("rejected_queue_full", len(items))
+        statuses = [503 if s == 200 else s for s in statuses]
+        items = []
+    except ValueError:  # larger than the whole queue
+        statuses = [413 if s == 200 else s for s in statuses]
+        items = []
+
+    metrics.incr("rejected_backlog", statuses.count(429))
+    # statsd timers double as histograms: percentiles of the batch size
+    metrics.timing("batch_size", len(records))
+    if items:
+        metrics.timing("accept_to_enqueue", (time.time() - t0) * 1000)
+        metrics.incr("accepted", len(items))
+    return ujson.dumps(statuses).encode()
+
 
+def make_connection_handler(queue, max_backlog: int):
+    async def handle_connection(reader, writer) -> None:
+        try:
+            while True:
+                try:
+                    req = await _read_request(reader)
+                except ValueError:
+                    writer.write(_response(400, False))
+                    break
+                if req is None:
+                    break
 
-class MsmtFeeder(BaseApplication):
-    def __init__(self, app, conf):
-        self._conf = conf
-        self.application = app
-        super().__init__()
+                t0 = time.time()
+                body = b""
+                method, path, headers, length = req
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if method != "POST":
+                    status = 200  # can be used as health check
+                elif length is None:
+                    status = 411
+                    keep_alive = False
+                elif length > MAX_BODY_SIZE:
+                    status = 413
+                    keep_alive = False
+                else:
+                    data = await reader.readexactly(length)
+                    if path == "/batch":
+                        try:
+                            body = handle_batch_post(queue, max_backlog, data, t0)
+                            status = 200
+                        except ValueError:
+                            status = 400
+                    else:
+                        status = handle_post(queue, max_backlog, path, data, t0)
 
-    def load_config(self):
-        for key, value in self._conf.items():
-            assert key in self.cfg.settings
-            self.cfg.set(key, value)
+                writer.write(_response(status, keep_alive, body))
+                await writer.drain()
+                if not keep_alive:
+                    break
 
-    def load(self):
-        return self.application
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            log.exception(e)
+        finally:
+            writer.close()
 
+    return handle_connection
 
-def start_http_api(queue):
 
-    def handler_app(environ, start_response):
-        if environ["REQUEST_METHOD"] == "POST":
-            # TODO:pass msmt_uid
-            path = environ["PATH_INFO"]
-            assert path.startswith("/2")
-            msmt_uid = path[1:]
-            data = environ["wsgi.input"].read()
-            while queue.qsize() >= 5000:
-                time.sleep(0.1)
-            queue.put((data, None, msmt_uid))
+async def serve(queue, max_backlog: int, host="127.0.0.1", port=API_PORT) -> None:
+    handler = make_connection_handler(queue, max_backlog)
+    server = await asyncio.start_server(handler, host, port, limit=2**16)
+    log.info(f"Listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
 
-        start_response("200 OK", [])
-        return [b""]
 
-    options = {"bind": f"127.0.0.1:{API_PORT}"}
-    MsmtFeeder(handler_app, options).run()
+def start_http_api(queue, max_backlog: int = MAX_BACKLOG) -> None:
+    asyncio.run(serve(queue, max_backlog))
@@ -2,14 +2,204 @@
 
 """
 Metric generation
+
+Counters, gauges and timers are aggregated in process memory and sent to
+statsd in batches every FLUSH_INTERVAL_S seconds, instead of one UDP packet
+for each call:
+ - counters are summed
+ - gauges keep the last value, delta gauges are summed and sent with a sign
+ - timers keep a uniform random sample of up to MAX_TIMER_SAMPLES values
+   for each interval, sent with a sample rate so that statsd computes
+   correct counts and rates
+Hot timers can also be sampled at call time with set_sample_rate()
+A daemon thread in each process flushes metrics that are not updated.
+Packets in the statsd protocol are built here: the statsd client would drop
+timer samples at random when given a sample rate.
 """
 
 from os.path import basename, splitext
+from typing import Dict, Iterable, List, Optional
+import atexit
+import functools
+import os
+import random
+import socket
+import threading
+import time
+
+FLUSH_INTERVAL_S = 10
+MAX_TIMER_SAMPLES = 256
+# Seconds between checks of the flushing thread
+FLUSHER_TICK_S = 1
+# Same as the statsd client: avoid fragmentation
+MAX_UDP_SIZE = 512
+
+_clients: List["AggregatingStatsClient"] = []
+_flusher_started = False
+
+
+class Timer:
+    """Timer usable as decorator or context manager"""
+
+    def __init__(self, client, stat: str, rate: float = 1) -> None:
+        self.client = client
+        self.stat = stat
+        self.rate = rate
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def wrapper(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return f(*a, **kw)
+            finally:
+                delta = (time.perf_counter() - t0) * 1000
+                self.client.timing(self.stat, delta, self.rate)
+
+        return wrapper
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        delta = (time.perf_counter() - self._t0) * 1000
+        self.client.timing(self.stat, delta, self.rate)
+
+
+class AggregatingStatsClient:
+    """Drop-in replacement for statsd.StatsClient aggregating metrics
+    in memory"""
+
+    def __init__(
+        self, host: str, port: int, prefix: str, flush_interval=FLUSH_INTERVAL_S
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.prefix = f"{prefix}." if prefix else ""
+        self.flush_interval = flush_interval
+        self._sock: Optional[socket.socket] = None
+        self._addr = None
+        self.sample_rates: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._gauge_deltas: Dict[str, float] = {}
+        self._timers: Dict[str, List[float]] = {}
+        self._timer_counts: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+
+    def set_sample_rate(self, stat: str, rate: float) -> None:
+        """Record only a random fraction of the calls for a timer"""
+        self.sample_rates[stat] = rate
+
+    def incr(self, stat: str, count=1, rate=1) -> None:
+        if rate < 1:
+            if random.random() > rate:
+                return
+            count /= rate
+        with self._lock:
+            self._counters[stat] = self._counters.get(stat, 0) + count
+        self.flush_if_needed()
+
+    def decr(self, stat: str, count=1, rate=1) -> None:
+        self.incr(stat, -count, rate)
+
+    def gauge(self, stat: str, value, rate=1, delta=False) -> None:
+        with self._lock:
+            if not delta:
+                self._gauges[stat] = value
+                self._gauge_deltas.pop(stat, None)
+            elif stat in self._gauges:
+                self._gauges[stat] += value
+            else:
+                self._gauge_deltas[stat] = self._gauge_deltas.get(stat, 0) + value
+        self.flush_if_needed()
 
-import statsd  # debdeps: python3-statsd
+    def timing(self, stat: str, delta, rate=1) -> None:
+        """Record a timing in milliseconds"""
+        rate = min(rate, self.sample_rates.get(stat, 1))
+        if rate < 1 and random.random() > rate:
+            return
+        if not isinstance(delta, (int, float)):
+            delta = delta.total_seconds() * 1000.0  # timedelta
+        with self._lock:
+            seen = self._timer_counts.get(stat, 0) + 1 / rate
+            self._timer_counts[stat] = seen
+            samples = self._timers.setdefault(stat, [])
+            if len(samples) < MAX_TIMER_SAMPLES:
+                samples.append(delta)
+            else:
+                # reservoir sampling
+                n = random.randrange(int(seen))
+                if n < MAX_TIMER_SAMPLES:
+                    samples[n] = delta
+        self.flush_if_needed()
 
+    def timer(self, stat: str, rate=1) -> Timer:
+        return Timer(self, stat, rate)
 
-def setup_metrics(host="localhost", name=None):
+    def flush_if_needed(self) -> None:
+        if not _flusher_started:
+            _start_flusher()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send aggregated metrics to statsd"""
+        with self._lock:
+            counters, gauges = self._counters, self._gauges
+            gauge_deltas = self._gauge_deltas
+            timers, timer_counts = self._timers, self._timer_counts
+            self._reset()
+
+        p = self.prefix
+        lines = [f"{p}{stat}:{count}|c" for stat, count in counters.items()]
+        for stat, value in gauges.items():
+            if value < 0:
+                lines.append(f"{p}{stat}:0|g")  # negative values are deltas
+            lines.append(f"{p}{stat}:{value}|g")
+        for stat, value in gauge_deltas.items():
+            if value:
+                lines.append(f"{p}{stat}:{value:+}|g")
+        for stat, samples in timers.items():
+            rate = len(samples) / timer_counts[stat]
+            suffix = "" if rate >= 1 else f"|@{rate:.6f}"
+            lines.extend(f"{p}{stat}:{v:0.6f}|ms{suffix}" for v in samples)
+        self._send(lines)
+
+    def _send(self, lines: Iterable[str]) -> None:
+        """Send lines in packets of up to MAX_UDP_SIZE bytes.
+        Errors are ignored as in the statsd client"""
+        packet = ""
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > MAX_UDP_SIZE:
+                self._send_packet(packet)
+                packet = ""
+            packet = f"{packet}\n{line}" if packet else line
+        if packet:
+            self._send_packet(packet)
+
+    def _send_packet(self, packet: str) -> None:
+        try:
+            if self._sock is None:
+                ai = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)
+                family, _, _, _, self._addr = ai[0]
+                self._sock = socket.socket(family, socket.SOCK_DGRAM)
+            self._sock.sendto(packet.encode("ascii"), self._addr)
+        except (OSError, RuntimeError):
+            pass
+
+    def _after_fork(self) -> None:
+        # Do not send again the values collected by the parent
+        self._lock = threading.Lock()
+        self._reset()
+
+
+def setup_metrics(host="localhost", name=None, flush_interval=FLUSH_INTERVAL_S):
     """Setup metric generation. Use dotted namespaces e.g.
     "pipeline.centrifugation"
     """
@@ -21,4 +211,39 @@ def setup_metrics(host="localhost", name=None):
         prefix = name
 
     prefix = prefix.strip(".")
-    return statsd.StatsClient(host, 8125, prefix=prefix)
+    c = AggregatingStatsClient(host, 8125, prefix, flush_interval)
+    _clients.append(c)
+    return c
+
+
+def flush_all() -> None:
+    """Flush all metrics of this process. Call before a worker exits."""
+    for c in _clients:
+        c.flush()
+
+
+def _flush_periodically() -> None:
+    """Flush metrics of idle code, e.g. workers waiting on a queue"""
+    while True:
+        time.sleep(FLUSHER_TICK_S)
+        for c in list(_clients):
+            c.flush_if_needed()
+
+
+def _start_flusher() -> None:
+    """Start the flushing thread of this process"""
+    global _flusher_started
+    _flusher_started = True
+    t = threading.Thread(target=_flush_periodically, name="metrics", daemon=True)
+    t.start()
+
+
+def _after_fork_in_child() -> None:
+    global _flusher_started
+    _flusher_started = False  # threads do not survive fork()
+    for c in _clients:
+        c._after_fork()
+
+
+atexit.register(flush_all)
+os.register_at_fork(after_in_child=_after_fork_in_child)
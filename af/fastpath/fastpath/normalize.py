@@ -2,21 +2,51 @@
 # Normalize YAML reports
 #
 
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
-from itertools import groupby
+from typing import Dict, List, Optional
 import functools
 import hashlib
+import io
 import logging
+import mmap
+import multiprocessing as mp
+import os
 import re
+import shutil
 import string
+import tempfile
 import uuid
 
 import yaml
 
+try:
+    import numpy as np  # debdeps: python3-numpy
+except ImportError:
+    np = None
+
+from fastpath.metrics import flush_all as flush_metrics
 from fastpath.utils import trivial_id
 
 log = logging.getLogger("normalize")
 
+# libyaml is much faster than the pure-Python loader
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Number of processes used to parse and normalize YAML entries
+yaml_workers = 1
+# Entries sent to the pool at once: one batch is processed while the
+# previous one is consumed
+YAML_BATCH_SIZE = 512
+_yaml_pool = None
+_yaml_pool_pid = 0
+_yaml_pool_size = 0
+
+
+def load_yaml(blob):
+    return yaml.load(blob, Loader=SafeLoader)
+
 
 class UnsupportedTestError(Exception):
     pass
@@ -138,17 +168,28 @@ regexps = dict(
 simhash_re = re.compile(r"[\w\u4e00-\u9fcc]+")
 
 
-def gen_simhash(s):
+def _simhash_features(s) -> Dict[str, int]:
+    """4-grams of the words in s with their count"""
     content = s.lower()
     content = "".join(re.findall(simhash_re, content))
     mx = max(len(content) - 4 + 1, 1)
-    features = [content[i : i + 4] for i in range(mx)]
-    features = ((k, sum(1 for _ in g)) for k, g in groupby(sorted(features)))
+    # Slicing and counting run in C
+    slices = map(slice, range(mx), range(4, mx + 4))
+    return Counter(map(content.__getitem__, slices))
+
+
+def _feature_hash(f: str) -> bytes:
+    # The lower 64 bits of the MD5 digest, big endian
+    return hashlib.md5(f.encode("utf-8")).digest()[8:]
+
+
+def _gen_simhash_py(s):
+    """Pure Python implementation, used if NumPy is not available"""
+    features = _simhash_features(s).items()
     v = [0] * 64
     masks = [1 << i for i in range(64)]
     for h, w in features:
-        h = h.encode("utf-8")
-        h = int(hashlib.md5(h).hexdigest(), 16)
+        h = int.from_bytes(_feature_hash(h), "big")
         for i in range(64):
             v[i] += w if h & masks[i] else -w
     ans = 0
@@ -158,6 +199,50 @@ def gen_simhash(s):
     return ans
 
 
+def _hash_signs(features) -> "np.ndarray":
+    """Returns a (len(features), 64) array of +1/-1 for each hash bit,
+    least significant bit first"""
+    digests = b"".join(_feature_hash(f) for f in features)
+    # Reverse the bytes to little endian, then unpack the bits LSB first
+    a = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8)[:, ::-1]
+    bits = np.unpackbits(a, axis=1, bitorder="little").astype(np.int64)
+    return bits * 2 - 1
+
+
+def _votes_to_int(votes) -> int:
+    packed = np.packbits(votes > 0, bitorder="little")
+    return int.from_bytes(packed.tobytes(), "little")
+
+
+def gen_simhash(s):
+    """64-bit simhash of the 4-grams of the words in s"""
+    if np is None:
+        return _gen_simhash_py(s)
+    features = _simhash_features(s)
+    weights = np.fromiter(features.values(), dtype=np.int64, count=len(features))
+    return _votes_to_int(weights @ _hash_signs(features))
+
+
+def gen_simhashes(bodies) -> List[int]:
+    """Simhash many strings at once. 4-grams shared across the strings are
+    hashed only once. Returns the same values as gen_simhash"""
+    if np is None:
+        return [_gen_simhash_py(s) for s in bodies]
+    index: Dict[str, int] = {}  # unique feature -> row in the signs array
+    per_body = []
+    for s in bodies:
+        features = _simhash_features(s)
+        rows = [index.setdefault(f, len(index)) for f in features]
+        per_body.append((rows, list(features.values())))
+
+    signs = _hash_signs(index)
+    out = []
+    for rows, weights in per_body:
+        votes = np.asarray(weights, dtype=np.int64) @ signs[rows]
+        out.append(_votes_to_int(votes))
+    return out
+
+
 ### Normalize entries across format versions ###
 
 
@@ -565,6 +650,76 @@ def stream_yaml_blobs(fd):
         log.error("Truncated YAML report")
 
 
+def slice_yaml_blobs(buf, start: int = 0):
+    """Detects YAML objects in a bytes-like object, e.g. a mmap, without
+    copying them. Same framing as stream_yaml_blobs.
+    Returns an iterator of (offset, memoryview)
+    """
+    mv = memoryview(buf)
+    end_of_buf = len(buf)
+    while start < end_of_buf:
+        prefix = buf[start : start + 4]
+        if prefix == b"---\n":  # ordinary preamble
+            end = buf.find(b"\n...\n", start)
+            if end == -1:
+                break  # truncated
+            yield start, mv[start : end + 5]
+            start = end + 5
+        elif prefix == b"...\n":  # duplicate trailer
+            start += 4
+        elif len(prefix) < 4:
+            break  # truncated
+        elif prefix[0] == ord("#"):  # comment
+            end = buf.find(b"\n", start)
+            if end == -1:
+                break  # truncated
+            start = end + 1
+        else:
+            log.error("Broken frame. Ignoring the remaining YAML")
+            return
+
+    if start < end_of_buf:
+        log.error("Truncated YAML report")
+
+
+@contextmanager
+def map_yaml_report(data):
+    """Map a YAML report in memory as a bytes-like object.
+    data can be bytes-like, a regular file or a stream e.g. lz4 or a tar
+    member: streams are decompressed into a temporary file first.
+    Returns (buffer, offset of the current position of data)
+    """
+    if isinstance(data, (bytes, bytearray, mmap.mmap)):
+        yield data, 0
+        return
+
+    # Exact type check: e.g. tar members are BufferedReader subclasses
+    if type(data) in (io.BufferedReader, io.FileIO):
+        base = data.tell()
+        f = data
+    else:
+        base = 0
+        f = tempfile.TemporaryFile()
+        shutil.copyfileobj(data, f, 1048576)
+        f.flush()
+
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b"", 0
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm, base
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                pass  # slices are still referenced: closed when collected
+    finally:
+        if f is not data:
+            f.close()
+
+
 def generate_report_id(header):
     # TODO: test
     start_time = datetime.fromtimestamp(header.get("start_time", 0))
@@ -593,18 +748,129 @@ def generate_report_id(header):
 ## Entry points
 
 
-def iter_yaml_msmt_normalized(data, bucket_tstamp: str, report_fn: str):
-    """Yields normalized measurements from a YAML bytestream"""
+def set_yaml_workers(n: int) -> None:
+    """Parse and normalize YAML entries using n processes"""
+    global yaml_workers
+    yaml_workers = n
+
+
+def get_yaml_pool():
+    """Returns the process pool for YAML normalization or None.
+    The pool is created on first use in each process."""
+    global _yaml_pool, _yaml_pool_pid, _yaml_pool_size
+    if yaml_workers <= 1:
+        return None
+    if _yaml_pool is None or _yaml_pool_pid != os.getpid():
+        _yaml_pool = mp.Pool(yaml_workers)
+        _yaml_pool_pid = os.getpid()
+        _yaml_pool_size = yaml_workers
+    return _yaml_pool
+
+
+def _pool_size(pool) -> int:
+    """Processes in the pool. Pools not created by get_yaml_pool are assumed
+    to have the mp.Pool default of one process per CPU"""
+    if pool is _yaml_pool:
+        return _yaml_pool_size
+    return os.cpu_count() or 1
+
+
+def _normalize_blob(header: dict, bucket_tstamp: str, report_fn: str, item):
+    """Parse and normalize an entry. Runs in the pool workers.
+    Returns (entry or None, tst, (log level, message) or None) where tst
+    tells if test_start_time came from the "entry", the "header" or neither
+    """
+    raw_entry, esha_d = item
+    rid = header["report_id"]
+    try:
+        entry = load_yaml(raw_entry)
+    except yaml.constructor.ConstructorError:
+        return None, None, (logging.INFO, f"YAML construction error {rid}")
+    except yaml.parser.ParserError:
+        return None, None, (logging.INFO, f"YAML parsing error {rid}")
+
+    if not entry:  # e.g. '---\nnull\n...\n'
+        return None, None, None
+    tst = None
+    if "test_start_time" in entry:
+        tst = "entry"
+        if "test_start_time" in header:
+            header = header.copy()
+            header.pop("test_start_time")
+    elif "test_start_time" in header:
+        tst = "header"
+    entry.update(header)
+    try:
+        d = normalize_entry(entry, bucket_tstamp, report_fn, esha_d)
+        return d, tst, None
+    except Exception as e:
+        return None, tst, (logging.ERROR, f"Skipping measurement: {e}")
+
+
+def _run_in_pool(f, item):
+    """Runs f(item) in a pool worker. Pool workers are terminated without
+    running atexit: send their metrics now"""
+    try:
+        return f(item)
+    finally:
+        flush_metrics()
+
+
+def _iter_batches(blobgen, headsha, size: int):
+    batch = []
+    for off, raw_entry in blobgen:
+        esha = headsha.copy()
+        esha.update(raw_entry)
+        batch.append((bytes(raw_entry), esha.digest()))
+        raw_entry.release()
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _map_batches(pool, norm, blobgen, headsha):
+    """Yields (batch, results). With a pool the next batch is processed
+    while the current one is consumed."""
+    if pool is None:
+        for batch in _iter_batches(blobgen, headsha, YAML_BATCH_SIZE):
+            yield batch, map(norm, batch)
+        return
+
+    pending: Optional[tuple] = None
+    workers = _pool_size(pool)
+    norm = functools.partial(_run_in_pool, norm)
+    for batch in _iter_batches(blobgen, headsha, YAML_BATCH_SIZE):
+        chunksize = max(1, len(batch) // (workers * 4))
+        res = pool.map_async(norm, batch, chunksize)
+        if pending is not None:
+            yield pending[0], pending[1].get()
+        pending = (batch, res)
+    if pending is not None:
+        yield pending[0], pending[1].get()
+
+
+def iter_yaml_msmt_normalized(data, bucket_tstamp: str, report_fn: str, pool=None):
+    """Yields normalized measurements from a YAML bytestream
+    If a multiprocessing pool is given the entries are parsed and normalized
+    by the pool. The output is identical and in the same order.
+    """
     assert bucket_tstamp.startswith("20")
     assert len(bucket_tstamp) == 10
     assert len(report_fn.split("/")) == 2, report_fn
+    with map_yaml_report(data) as (buf, base):
+        yield from _iter_yaml_msmt_normalized(buf, base, bucket_tstamp, report_fn, pool)
+
+
+def _iter_yaml_msmt_normalized(buf, base, bucket_tstamp, report_fn, pool):
     # Taken from autoclaving.py stream_yaml_reports
-    blobgen = stream_yaml_blobs(data)
+    blobgen = slice_yaml_blobs(buf, base)
 
     off, header = next(blobgen)
     headsha = hashlib.sha1(header)
     # XXX: bad header kills whole bucket
-    header = yaml.safe_load(header)
+    header = load_yaml(bytes(header))
     if isinstance(header.get("probe_city"), bytes):
         header["probe_city"] = header["probe_city"].decode(errors="ignore")
 
@@ -612,43 +878,19 @@ def iter_yaml_msmt_normalized(data, bucket_tstamp: str, report_fn: str):
     if not header.get("report_id"):
         header["report_id"] = generate_report_id(header)
 
-    for off, raw_entry in blobgen:
-        esha = headsha.copy()
-        esha.update(raw_entry)
-        esha_d = esha.digest()
-        try:
-            entry = yaml.safe_load(raw_entry)
-        except yaml.constructor.ConstructorError:
-            rid = header["report_id"]
-            log.info(f"YAML construction error {rid}")
-            entry = None
-        except yaml.parser.ParserError:
-            rid = header["report_id"]
-            log.info(f"YAML parsing error {rid}")
-            entry = None
-
-        if not entry:  # e.g. '---\nnull\n...\n'
-            continue
-        if "test_start_time" in entry and "test_start_time" in header:
-            header.pop("test_start_time")
-        entry.update(header)
-        try:
-            d = normalize_entry(entry, bucket_tstamp, report_fn, esha_d)
-            msmt_uid = trivial_id(raw_entry, d)
-            d["measurement_uid"] = msmt_uid
+    # Once an entry has its own test_start_time the one in the header is
+    # dropped for all the following entries
+    norm = functools.partial(_normalize_blob, header, bucket_tstamp, report_fn)
+    for batch, results in _map_batches(pool, norm, blobgen, headsha):
+        for item, (d, tst, msg) in zip(batch, results):
+            if tst == "header" and "test_start_time" not in header:
+                # Normalized by the pool with a stale header: redo
+                d, tst, msg = norm(item)
+            if tst == "entry":
+                header.pop("test_start_time", None)
+            if msg is not None:
+                log.log(*msg)
+            if d is None:
+                continue
+            d["measurement_uid"] = trivial_id(item[0], d)
             yield d
-        except Exception as e:
-            log.error(f"Skipping measurement: {e}")
-            continue
-
-        # try:
-        #    if not entry:  # e.g. '---\nnull\n...\n'
-        #        continue
-        #    if "test_start_time" in entry and "test_start_time" in header:
-        #        header.pop("test_start_time")
-        #    entry.update(header)
-        #    out = normalize_entry(entry, bucket_tstamp, report_fn, esha)
-        #    yield out
-        # except Exception as exc:
-        #    out = normalize_entry(entry, bucket_tstamp, report_fn, esha)
-        #    yield out
@@ -1,35 +1,233 @@
 # -*- coding: utf-8 -*-
 """
-Portable multiprocessing queue singleton
+Portable multiprocessing queue singleton. Call setup() before forking.
+
+Items are framed and copied into a ring buffer of raw bytes in anonymous
+shared memory, inherited by the worker processes on fork.
+put_many() and get_many() take the shared lock once for each batch of items.
+Measurements from the HTTP API are framed as raw bytes, not pickled.
+
+Frame format: <payload length: uint32> <kind: uint8> <payload>
 """
 
+from collections import deque
+from queue import Empty, Full
+from typing import Deque, List, Optional
+import mmap
 import multiprocessing as mp
+import pickle
+import struct
+
+# High-water mark: put() blocks (or raises Full) when the ring is full
+DEFAULT_CAPACITY = 256 * 1024 * 1024
+# Max number of items get_many() moves from the ring to a consumer by default
+GET_BATCH_SIZE = 32
+
+_HDR = struct.Struct("=QQQQ")  # head, tail, used bytes, item count
+_WAITING = struct.Struct("=Q")  # producers waiting for space, after _HDR
+_FRAME = struct.Struct("=IB")  # payload length, kind
+_UIDLEN = struct.Struct("=H")
+
+KIND_SENTINEL = 0  # None, used to stop workers
+KIND_MSMT = 1  # (bytes, None, str) from the HTTP API
+KIND_PICKLE = 2  # anything else
+
+
+def encode(item) -> bytes:
+    if item is None:
+        return _FRAME.pack(0, KIND_SENTINEL)
+
+    if (
+        isinstance(item, tuple)
+        and len(item) == 3
+        and isinstance(item[0], bytes)
+        and item[1] is None
+        and isinstance(item[2], str)
+    ):
+        uid = item[2].encode()
+        hdr = _FRAME.pack(_UIDLEN.size + len(uid) + len(item[0]), KIND_MSMT)
+        return b"".join((hdr, _UIDLEN.pack(len(uid)), uid, item[0]))
+
+    payload = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+    return _FRAME.pack(len(payload), KIND_PICKLE) + payload
+
+
+def decode(kind: int, payload: bytes):
+    if kind == KIND_SENTINEL:
+        return None
+    if kind == KIND_MSMT:
+        (uidlen,) = _UIDLEN.unpack_from(payload)
+        uid_end = _UIDLEN.size + uidlen
+        return (payload[uid_end:], None, payload[_UIDLEN.size : uid_end].decode())
+    return pickle.loads(payload)
+
+
+class RingQueue:
+    """Multi-producer, multi-consumer queue on a shared memory ring buffer.
+    Must be created before forking the producers and consumers.
+    With get_batch > 1 get() moves up to get_batch items at a time to a
+    local buffer: they are not counted by qsize() and are lost if the
+    consumer dies.
+    """
+
+    _OFFSET = _HDR.size + _WAITING.size  # start of the ring
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, get_batch: int = 1) -> None:
+        self.capacity = capacity
+        self.get_batch = get_batch
+        # Anonymous shared mapping: pages are allocated only when used
+        self._mm = mmap.mmap(-1, self._OFFSET + capacity)
+        self._lock = mp.Lock()
+        self._not_full = mp.Condition(self._lock)
+        # One permit for each item in the ring not yet claimed by a consumer
+        self._items = mp.Semaphore(0)
+        self._local: Deque = deque()  # items fetched by this process
+
+    # The following methods must be called holding the lock
+
+    def _read_hdr(self):
+        return _HDR.unpack_from(self._mm, 0)
+
+    def _add_waiting(self, n: int) -> int:
+        (w,) = _WAITING.unpack_from(self._mm, _HDR.size)
+        _WAITING.pack_into(self._mm, _HDR.size, w + n)
+        return w + n
+
+    def _write(self, pos: int, data: bytes) -> None:
+        off = self._OFFSET
+        first = min(len(data), self.capacity - pos)
+        mv = memoryview(data)
+        self._mm[off + pos : off + pos + first] = mv[:first]
+        if first < len(data):
+            self._mm[off : off + len(data) - first] = mv[first:]
+
+    def _read(self, pos: int, n: int) -> bytes:
+        off = self._OFFSET
+        first = min(n, self.capacity - pos)
+        data = self._mm[off + pos : off + pos + first]
+        if first < n:
+            data += self._mm[off : off + n - first]
+        return data
+
+    # Public API
+
+    def put_many(self, items: list, block=True, timeout=None) -> None:
+        """Enqueue items atomically. Raises Full if there is not enough
+        space after timeout or immediately if block is False
+        """
+        if not items:
+            return
+        blob = b"".join(encode(i) for i in items)
+        if len(blob) > self.capacity:
+            raise ValueError("Items larger than the queue capacity")
+
+        with self._not_full:
+
+            def has_space() -> bool:
+                return self.capacity - self._read_hdr()[2] >= len(blob)
+
+            if not has_space():
+                if not block:
+                    raise Full
+                self._add_waiting(1)
+                ok = self._not_full.wait_for(has_space, timeout)
+                self._add_waiting(-1)
+                if not ok:
+                    raise Full
+
+            head, tail, used, count = self._read_hdr()
+            self._write(tail, blob)
+            tail = (tail + len(blob)) % self.capacity
+            _HDR.pack_into(self._mm, 0, head, tail, used + len(blob), count + len(items))
+
+        for _ in items:
+            self._items.release()
+
+    def put(self, item, block=True, timeout=None) -> None:
+        self.put_many([item], block=block, timeout=timeout)
+
+    def get_many(self, max_items: int = GET_BATCH_SIZE, timeout=None) -> list:
+        """Dequeue up to max_items. A batch ends after a sentinel so that
+        each worker receives one. Raises Empty on timeout.
+        """
+        if not self._items.acquire(timeout=timeout):
+            raise Empty
+        claimed = 1
+        while claimed < max_items and self._items.acquire(False):
+            claimed += 1
+
+        frames = []
+        with self._not_full:
+            head, tail, used, count = self._read_hdr()
+            while len(frames) < claimed:
+                plen, kind = _FRAME.unpack(self._read(head, _FRAME.size))
+                payload = self._read((head + _FRAME.size) % self.capacity, plen)
+                head = (head + _FRAME.size + plen) % self.capacity
+                used -= _FRAME.size + plen
+                count -= 1
+                frames.append((kind, payload))
+                if kind == KIND_SENTINEL:
+                    break
+
+            _HDR.pack_into(self._mm, 0, head, tail, used, count)
+            if self._add_waiting(0):
+                self._not_full.notify_all()
+
+        # Give back the permits for items left in the ring after a sentinel
+        for _ in range(claimed - len(frames)):
+            self._items.release()
+
+        return [decode(kind, payload) for kind, payload in frames]
+
+    def get(self, timeout=None):
+        """Returns one item. With get_batch > 1 fetches a batch when the
+        local buffer is empty. Raises Empty on timeout.
+        """
+        if self.get_batch == 1:
+            return self.get_many(1, timeout)[0]
+        if not self._local:
+            self._local.extend(self.get_many(self.get_batch, timeout))
+        return self._local.popleft()
+
+    def qsize(self) -> int:
+        """Number of items in the ring. Items in the local buffer of
+        consumers using get_batch > 1 are not counted
+        """
+        with self._lock:
+            return self._read_hdr()[3]
+
+    def nbytes(self) -> int:
+        """Bytes used in the ring"""
+        with self._lock:
+            return self._read_hdr()[2]
+
+
+_q: Optional[RingQueue] = None
+
+
+def setup(capacity: int = DEFAULT_CAPACITY) -> None:
+    """Create the queue. Call before forking the workers"""
+    global _q
+    _q = RingQueue(capacity)
+
+
+def put(val, block=True) -> None:
+    # Raises queue.Full if block is False and the queue is full
+    _q.put(val, block=block)
 
-# Queue.qsize() is not reliable - and absent under OSX
-# Implement a queue as a singleton with locking around the queue size
 
-_q = mp.Queue()  # type: mp.queues.Queue
-_size = mp.Value("i", 0)
+def put_many(vals: List, block=True) -> None:
+    _q.put_many(vals, block=block)
 
 
-def put(val):
-    with _size.get_lock():
-        _size.value += 1
-        _q.put(val)
+def get(timeout=None):
+    # Raises queue.Empty on timeout
+    return _q.get(timeout=timeout)
 
 
-def get():
-    # get() blocks until a message arrives and cannot be done in the lock
-    # otherwise a reader can block any writer
-    # Warning: race condition. After the get() the real queue is smaller than
-    # qsize() but this is OK as we only check "if qsize() > threshold" to
-    # throttle the writer
-    v = _q.get()
-    with _size.get_lock():
-        _size.value -= 1
-    return v
+def qsize() -> int:
+    return _q.qsize()
 
 
-def qsize():
-    with _size.get_lock():
-        return _size.value
+def nbytes() -> int:
+    return _q.nbytes()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Pre-warm the cache of normalized measurements from legacy YAML cans
+
+Streams the legacy cans for a date range from S3, normalizes the YAML
+reports and writes them in the cache used by fastpath --yaml-cache
+Cans already in the cache are skipped.
+
+Usage:
+PYTHONPATH=. ./fastpath/prewarm_yaml_cache.py --start-day 2013-09-12 \\
+  --end-day 2013-09-13 --cachedir var/lib/fastpath/cache/yaml --workers 4
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from pathlib import Path
+import logging
+import multiprocessing as mp
+import os
+
+import fastpath.s3feeder as s3f
+from fastpath.yamlcache import YamlCache, is_cacheable
+
+log = logging.getLogger("fastpath.prewarm_yaml_cache")
+
+_s3 = None  # S3 client for each worker process
+
+
+def parse_date(d):
+    return datetime.strptime(d, "%Y-%m-%d").date()
+
+
+def parse_args():
+    os.environ["TZ"] = "UTC"
+    ap = ArgumentParser(__doc__)
+    ap.add_argument("--start-day", type=parse_date, required=True)
+    ap.add_argument("--end-day", type=parse_date, required=True, help="Excluded")
+    h = "Cache directory, as conf.yamlcachedir in fastpath"
+    d = Path("/var/lib/fastpath/cache/yaml")
+    ap.add_argument("--cachedir", type=Path, help=h, default=d)
+    ap.add_argument("--workers", type=int, help="Worker processes", default=1)
+    return ap.parse_args()
+
+
+def prewarm_can(cachedir: Path, s3fname: str, size: int) -> int:
+    """Normalize a can into the cache. Returns the number of measurements"""
+    global _s3
+    if _s3 is None:
+        _s3 = s3f.create_s3_client()
+    ycache = YamlCache(cachedir)
+    if ycache.has(s3fname, size):
+        return 0
+    s3f.log_download(s3fname, size)
+    body = _s3.get_object(Bucket=s3f.CAN_BUCKET_NAME, Key=s3fname)["Body"]
+    try:
+        msmts = s3f.load_multiple(s3fname, body, None, ycache, size)
+        return sum(1 for _ in msmts)
+    finally:
+        body.close()
+
+
+def _prewarm_can(args) -> int:
+    try:
+        return prewarm_can(*args)
+    except Exception as e:
+        log.error(f"{args[1]}: {e}", exc_info=True)
+        return 0
+
+
+def list_cans(start_day, end_day):
+    s3 = s3f.create_s3_client()
+    day = start_day
+    while day < end_day:
+        for s3fname, size in sorted(s3f.list_cans_on_s3_for_a_day(s3, day)):
+            if is_cacheable(s3fname):
+                yield s3fname, size
+        day += timedelta(days=1)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    conf = parse_args()
+    cans = list_cans(conf.start_day, conf.end_day)
+    cans = ((conf.cachedir, fn, size) for fn, size in cans)
+    with mp.Pool(conf.workers) as pool:
+        cnt = sum(pool.imap_unordered(_prewarm_can, cans))
+    log.info(f"{cnt} measurements cached")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage profiling broken down by test_name
+
+Enabled with --profile. Stages are nested: each stage records its wall
+time, CPU time and self time (wall time minus nested stages). The stages
+of a measurement are attributed to its test_name once it is known.
+
+Outputs, for each process:
+ - <pid>.txt summary table
+ - <pid>.folded stack dump in the format used by flamegraph.pl and
+   speedscope, with self time in microseconds as value
+"""
+
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, List, Tuple
+import functools
+import logging
+import os
+import time
+
+log = logging.getLogger("fastpath.profiler")
+
+_NULL = nullcontext()
+
+
+class _Stage:
+    __slots__ = ("prof", "name")
+
+    def __init__(self, prof, name: str) -> None:
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        frame = [self.name, time.perf_counter(), time.thread_time(), 0.0]
+        self.prof._stack.append(frame)
+
+    def __exit__(self, typ, value, tb):
+        self.prof._exit()
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        # (test_name, stage, ...) -> [count, wall, cpu, self wall]
+        self.stats: Dict[Tuple[str, ...], List[float]] = {}
+        self._stack: List[list] = []  # [name, wall start, cpu start, nested wall]
+        self._pending: List[tuple] = []  # stages waiting for the test_name
+        self._test_name = "-"
+
+    def stage(self, name: str):
+        """Context manager measuring a stage"""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def profile(self, name: str):
+        """Decorator measuring a function as a stage"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*a, **kw):
+                if not self.enabled:
+                    return func(*a, **kw)
+                with _Stage(self, name):
+                    return func(*a, **kw)
+
+            return wrapper
+
+        return decorator
+
+    def set_test_name(self, tn) -> None:
+        """Attribute the current outermost stage to a test_name"""
+        self._test_name = tn if isinstance(tn, str) and tn else "-"
+
+    def _exit(self) -> None:
+        name, w0, c0, nested = self._stack.pop()
+        wall = time.perf_counter() - w0
+        cpu = time.thread_time() - c0
+        path = tuple(f[0] for f in self._stack) + (name,)
+        self._pending.append((path, wall, cpu, wall - nested))
+        if self._stack:
+            self._stack[-1][3] += wall
+            return
+
+        tn = self._test_name
+        self._test_name = "-"
+        for path, wall, cpu, self_wall in self._pending:
+            s = self.stats.setdefault((tn,) + path, [0, 0.0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += wall
+            s[2] += cpu
+            s[3] += self_wall
+        self._pending.clear()
+
+    def summary(self) -> str:
+        """Summary table sorted by total wall time"""
+        hdr = f"{'test_name':<30} {'stage':<45} {'count':>9} {'wall_s':>9} "
+        hdr += f"{'cpu_s':>9} {'self_s':>9} {'avg_ms':>9}"
+        lines = [hdr]
+        rows = sorted(self.stats.items(), key=lambda i: i[1][1], reverse=True)
+        for key, (count, wall, cpu, self_wall) in rows:
+            stage = "/".join(key[1:])
+            avg = wall / count * 1000
+            lines.append(
+                f"{key[0]:<30} {stage:<45} {count:>9} {wall:>9.3f} "
+                f"{cpu:>9.3f} {self_wall:>9.3f} {avg:>9.3f}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def folded(self) -> str:
+        """Folded stacks with self time in microseconds"""
+        lines = []
+        for key, (count, wall, cpu, self_wall) in sorted(self.stats.items()):
+            us = int(self_wall * 1_000_000)
+            if us > 0:
+                lines.append(";".join(("fastpath",) + key) + f" {us}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, outdir: Path) -> None:
+        """Write the summary and folded stacks for this process"""
+        outdir.mkdir(parents=True, exist_ok=True)
+        pid = os.getpid()
+        (outdir / f"{pid}.txt").write_text(self.summary())
+        (outdir / f"{pid}.folded").write_text(self.folded())
+        log.info(f"Profile written to {outdir}/{pid}.*")
+
+
+profiler = Profiler()
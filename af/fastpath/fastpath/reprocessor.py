@@ -20,6 +20,24 @@ PYTHONPATH=. ./fastpath/reprocessor.py ooni-data ooni-data-eu-fra-test --day 201
 
 Note: the bundling of measurements into jsonl gz files has to remain deterministic
 
+With --workers N the day is processed in two parallel phases:
+ - cans are downloaded and parsed by N processes and their measurements are
+   split by "<cc> <testname>" into files in a work directory.
+   The parent finds duplicate measurement_uids across all the shards in can
+   order: YAML entries with the same uid can have different cc/testname
+   coming from different report headers
+ - each "<cc> <testname>" shard is bundled into jsonl files by one of N
+   processes, reading the measurements in the same order as a serial run
+   and skipping the duplicates
+The jsonl files are identical to the ones from a serial run.
+
+Cans are processed in a pipeline of stages connected by bounded queues:
+ - a thread downloads cans, up to --prefetch cans ahead
+ - the main thread parses cans and bundles measurements into jsonl files
+ - a pool of --upload-workers threads uploads the complete jsonl files to
+   S3 and updates the jsonl table
+Bundling happens only in the main thread: the jsonl files are the same.
+
 DB update:
 
 BEGIN;
@@ -33,17 +51,25 @@ CREATE INDEX CONCURRENTLY jsonl_measurement_uid ON jsonl (measurement_uid);
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from os import getenv
 from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple
 import gzip
 import hashlib
 import logging
+import multiprocessing as mp
 import os
+import queue
+import shutil
+import threading
 import time
 
 import json
+import lz4.frame as lz4frame  # debdeps: python3-lz4
 import psycopg2  # debdeps: python3-psycopg2
 from psycopg2.extras import execute_values
 import statsd  # debdeps: python3-statsd
@@ -51,7 +77,11 @@ import statsd  # debdeps: python3-statsd
 import fastpath.db as db
 import fastpath.s3feeder as s3f
 from fastpath.db import extract_input_domain
-from fastpath.core import score_measurement, setup_fingerprints, unwrap_msmt
+from fastpath.core import score_measurement, unwrap_msmt
+from fastpath.core import update_fingerprints_if_needed
+from fastpath.metrics import flush_all as flush_metrics
+from fastpath.uidset import UidSet
+from fastpath.yamlcache import YamlCache
 
 metrics = statsd.StatsClient("127.0.0.1", 8125, prefix="reprocessor")
 log = logging.getLogger("reprocessor")
@@ -63,7 +93,20 @@ for lo in ("urllib3", "botocore", "s3transfer", "boto"):
 import boto3
 import botocore.exceptions
 
-stats = dict(files_uploaded=0, files_size_mismatch=0, files_generated=0, t0=0)
+stats = dict(
+    files_uploaded=0,
+    files_size_mismatch=0,
+    files_generated=0,
+    dedup_duplicates=0,
+    t0=0,
+)
+# Summed across shards in parallel mode
+SHARD_STATS = ("files_uploaded", "files_size_mismatch", "files_generated")
+# Updated by the upload threads
+stats_lock = threading.Lock()
+
+# Uncompressed size of a jsonl file
+JSONL_THRESHOLD = 20 * 1024 * 1024
 
 
 def create_s3_client(conf):
@@ -113,7 +156,8 @@ def upload_to_s3(s3, bucket_name: str, tarf: Path, s3path: str) -> None:
     obj = s3.Object(bucket_name, s3path)
     log.info(f"Uploading {tarf} to {s3path}")
     obj.put(Body=tarf.read_bytes())
-    stats["files_uploaded"] += 1
+    with stats_lock:
+        stats["files_uploaded"] += 1
 
 
 def s3_check(s3, bucket_name, local_file, s3path) -> str:
@@ -130,7 +174,8 @@ def s3_check(s3, bucket_name, local_file, s3path) -> str:
     disk_size = local_file.stat().st_size
     if disk_size != size:
         log.info(f"Size difference: {size} {disk_size} {size - disk_size}")
-        stats["files_size_mismatch"] += 1
+        with stats_lock:
+            stats["files_size_mismatch"] += 1
         return "different"
 
     log.info("File found")
@@ -167,6 +212,35 @@ def parse_args():
     )
     ap.add_argument("--db-uri")
     ap.add_argument("--clickhouse-url")
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes. Output is the same as with 1",
+    )
+    ap.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of cans downloaded ahead of processing",
+    )
+    ap.add_argument(
+        "--upload-workers",
+        type=int,
+        default=4,
+        help="Threads uploading jsonl files and updating the DB. 0: inline",
+    )
+    ap.add_argument(
+        "--lossy-dedup",
+        action="store_true",
+        help="Store only 64-bit fingerprints of measurement_uids: a collision "
+        "drops a measurement as duplicate",
+    )
+    ap.add_argument(
+        "--yaml-cache-dir",
+        type=Path,
+        help="Cache of normalized measurements from YAML cans (see prewarm_yaml_cache)",
+    )
     c = ap.parse_args()
 
     return c
@@ -205,15 +279,19 @@ class Entity:
     lookup_list: list
 
 
-@metrics.timer("finalize_jsonl")
-def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
-    """For each JSONL file we do one upload to S3 and one
-    INSERT query with many rows
-    """
+def close_jsonl(e: Entity) -> None:
+    """Close a complete JSONL file. No more msmts are added to it"""
     jsize = int(e.fd.offset / 1024)
     log.info(f"Closing and preparing {e.jsonlf} Size: {jsize} KB")
     e.fd.close()
+    stats["files_generated"] += 1
 
+
+@metrics.timer("finalize_jsonl")
+def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
+    """For each closed JSONL file we do one upload to S3 and one
+    INSERT query with many rows
+    """
     # Calculate unique hash
     # update e.lookup_list
     # change e.jsonl_s3path
@@ -228,7 +306,6 @@ def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
     for n, table_row in enumerate(e.lookup_list):
         e.lookup_list[n][3] = jsonl_s3path
 
-    stats["files_generated"] += 1
     if conf.s3mode == "create":
         upload_to_s3(s3sig, conf.dst_bucket, e.jsonlf, jsonl_s3path)
     elif conf.s3mode == "check":
@@ -243,50 +320,66 @@ def finalize_jsonl(s3sig, db_conn, conf, e: Entity) -> None:
     e.jsonlf.unlink()
 
 
+def parse_msmt(msm_tup) -> Tuple[dict, str, str, str]:
+    """Unwrap a msmt and extract the fields used for bundling.
+    Returns (msm, input, cc, tn). Raises an exception on broken msmts.
+    """
+    msm_jstr, msm, msmt_uid = msm_tup
+    if msm is None:
+        msm = json.loads(msm_jstr)
+    if sorted(msm.keys()) == ["content", "format"]:
+        msm = unwrap_msmt(msm)
+
+    test_name = msm.get("test_name")
+    input_, domain = extract_input_domain(msm, test_name)
+    assert not isinstance(input_, list)
+    tn = test_name.replace("_", "")
+    cc = msm.get("probe_cc").upper()
+    return msm, input_, cc, tn
+
+
+def discard_reason(msm: dict) -> Optional[str]:
+    """Returns why a parsed msmt is not bundled, before duplicate detection"""
+    if msm.get("report_id") is None:
+        return "without report_id"
+    if msm.get("probe_cc", "").upper() == "ZZ":
+        return "with probe_cc=ZZ"
+    if msm.get("probe_asn", "").upper() == "AS0":
+        return "with ASN 0"
+    return None
+
+
+def is_bundled(msm: dict) -> bool:
+    """True if a parsed msmt is bundled unless it's a duplicate"""
+    return discard_reason(msm) is None and bool(msm.get("measurement_start_time"))
+
+
 @metrics.timer("process_measurement")
-def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
+def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, uploader):
     """Process a msmt
     If needed: create a new Entity tracking a jsonl file,
-      close and upload jsonl to S3 and upsert db
+      close it and submit it for upload to S3 and db update
     """
-    THRESHOLD = 20 * 1024 * 1024
     msm_jstr, msm, msmt_uid = msm_tup
-    if msm is None:
-        msm = json.loads(msm_jstr)
     try:
-        if sorted(msm.keys()) == ["content", "format"]:
-            msm = unwrap_msmt(msm)
-
+        msm, input_, cc, tn = parse_msmt(msm_tup)
         rid = msm.get("report_id")
-        test_name = msm.get("test_name")
-        input_, domain = extract_input_domain(msm, test_name)
-        assert not isinstance(input_, list)
-        tn = test_name.replace("_", "")
-        cc = msm.get("probe_cc").upper()
         desc = f"{msmt_uid} {tn} {cc} {rid} {input_}"
     except Exception as e:
-        log.info(f"Ignoring broken measurement {rid}")
+        log.info(f"Ignoring broken measurement {msmt_uid}")
         metrics.incr("broken_measurement")
         return
 
-    if msm.get("report_id") is None:
-        log.debug(f"Ignoring measurement without report_id")
-        metrics.incr("discarded_measurement")
-        return
-
-    if msm.get("probe_cc", "").upper() == "ZZ":
-        log.debug(f"Ignoring measurement with probe_cc=ZZ {desc}")
-        metrics.incr("discarded_measurement")
-        return
-
-    if msm.get("probe_asn", "").upper() == "AS0":
-        log.debug(f"Ignoring measurement with ASN 0  {desc}")
+    reason = discard_reason(msm)
+    if reason:
+        log.debug(f"Ignoring measurement {reason} {desc}")
         metrics.incr("discarded_measurement")
         return
 
     if msmt_uid in seen_uids:
         log.info(f"Ignoring DUPLICATE {desc}")
         metrics.incr("duplicate_measurement")
+        stats["dedup_duplicates"] += 1
         return
 
     if not msm.get("measurement_start_time"):
@@ -339,9 +432,9 @@ def process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn):
     i = [rid, input_, msmt_uid, None, len(en.lookup_list), date, source]
     en.lookup_list.append(i)
 
-    if en.fd.offset > THRESHOLD:
+    if en.fd.offset > JSONL_THRESHOLD:
         # The jsonlf is big enough
-        finalize_jsonl(s3sig, db_conn, conf, en)
+        uploader.submit(en)
 
     if conf.fastpathmode in ("insert", "upsert"):
         update = conf.fastpathmode == "upsert"
@@ -358,35 +451,344 @@ def progress(t0, processed_size, tot_size):
     log.info(f"Processed percentage: {100 * p} Remaining time: {rem} {stats}")
 
 
-@metrics.timer("process_can")
-def process_can(db_conn, s3uns, s3sig, can_fn, can_size, conf, buf, seen_uids):
+def get_ycache(conf):
+    return YamlCache(conf.yaml_cache_dir) if conf.yaml_cache_dir else None
+
+
+@metrics.timer("fetch_can")
+def fetch_can(s3uns, can_fn, can_size, conf) -> bool:
+    """Download a can unless it's in the YAML cache.
+    Returns True if downloaded"""
+    ycache = get_ycache(conf)
+    if ycache and ycache.has(can_fn, can_size):
+        log.info(f"Loading can {can_fn} from the YAML cache")
+        return False
+
     Path(can_fn).parent.mkdir(parents=True, exist_ok=True)
     log.info(f"Fetching can {can_fn}")
     s3uns.download_file(conf.src_bucket, can_fn, can_fn)
-    for msm_tup in s3f.load_multiple(can_fn):
-        process_measurement(can_fn, msm_tup, buf, seen_uids, conf, s3sig, db_conn)
-    Path(can_fn).unlink()
+    return True
 
 
-@metrics.timer("total_run_time")
-def main():
-    conf = parse_args()
-    log.info(f"From bucket {conf.src_bucket} to {conf.dst_bucket}")
-    s3sig = create_s3_client(conf)  # signed client for writing
+def read_can(can_fn, can_size, conf, downloaded: bool):
+    """Yields the msmts of a can fetched by fetch_can. Deletes the
+    downloaded can when done or closed"""
+    ycache = get_ycache(conf)
+    try:
+        yield from s3f.load_multiple(can_fn, None, None, ycache, can_size)
+    finally:
+        if downloaded:
+            Path(can_fn).unlink()
+
+
+def load_can(s3uns, can_fn, can_size, conf):
+    """Yields the msmts of a can, from the YAML cache or downloading it"""
+    downloaded = fetch_can(s3uns, can_fn, can_size, conf)
+    yield from read_can(can_fn, can_size, conf, downloaded)
+
+
+def prefetch_cans(s3uns, cans_fns, conf) -> Generator[Tuple, None, None]:
+    """Download cans in a thread, up to conf.prefetch cans ahead.
+    Yields (can_fn, size, downloaded) in order as the cans are ready.
+    """
+    q: queue.Queue = queue.Queue(maxsize=max(conf.prefetch, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def downloader() -> None:
+        try:
+            for can_fn, size in cans_fns:
+                if stop.is_set():
+                    return
+                downloaded = fetch_can(s3uns, can_fn, size, conf)
+                if not put((can_fn, size, downloaded)):
+                    if downloaded:
+                        Path(can_fn).unlink()
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    t = threading.Thread(target=downloader, name="downloader", daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        t.join()
+        # Delete the cans downloaded but not processed, e.g. on errors
+        while not q.empty():
+            item = q.get()
+            if isinstance(item, tuple) and item[2]:
+                Path(item[0]).unlink()
+
+
+@metrics.timer("process_can")
+def process_can(can_fn, can_size, downloaded, conf, buf, seen_uids, uploader):
+    with closing(read_can(can_fn, can_size, conf, downloaded)) as msmts:
+        for msm_tup in msmts:
+            process_measurement(can_fn, msm_tup, buf, seen_uids, conf, uploader)
+
+
+def finalize_open_jsonl(uploader, buf) -> None:
+    for json_entities in buf.values():
+        for e in json_entities:
+            if e.fd.closed:
+                continue
+            uploader.submit(e)
+
+
+def connect_db(conf):
     if conf.db_uri:
         log.info(f"Connecting to PG at {conf.db_uri}")
         db_conn = psycopg2.connect(conf.db_uri)
         db.setup(conf)  # setup db conn inside db module
+        return db_conn
     elif conf.clickhouse_url:
         log.info(f"Connecting to CH at {conf.clickhouse_url}")
         db.setup_clickhouse(conf)
-        db_conn = db.click_client
-    setup_fingerprints()
+        return db.click_client
+
+
+def connect_jsonl_db(conf):
+    """Connection used only to update the jsonl table from a thread"""
+    if conf.db_uri:
+        return psycopg2.connect(conf.db_uri)
+    elif conf.clickhouse_url:
+        return db.Clickhouse.from_url(conf.clickhouse_url)
+
+
+class Uploader:
+    """Upload and DB update stage: finalizes closed jsonl files in a pool of
+    threads, each with its own S3 and DB clients. At most 2 files for each
+    thread are waiting on disk: submit() blocks when the pool is behind.
+    With 0 workers files are finalized inline.
+    """
+
+    def __init__(self, conf, s3sig, db_conn) -> None:
+        self.conf = conf
+        self.s3sig = s3sig
+        self.db_conn = db_conn
+        self._futures: List[Future] = []
+        self._local = threading.local()
+        self._pool = None
+        if conf.upload_workers > 0:
+            n = conf.upload_workers
+            self._pool = ThreadPoolExecutor(n, thread_name_prefix="uploader")
+            self._slots = threading.BoundedSemaphore(2 * n)
+
+    def submit(self, e: Entity) -> None:
+        close_jsonl(e)
+        if self._pool is None:
+            finalize_jsonl(self.s3sig, self.db_conn, self.conf, e)
+            return
+
+        self._slots.acquire()
+        fut = self._pool.submit(self._finalize, e)
+        fut.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(fut)
+        self._check_done()
+
+    def _finalize(self, e: Entity) -> None:
+        loc = self._local
+        if not hasattr(loc, "s3sig"):
+            loc.s3sig = create_s3_client(self.conf)
+            loc.db_conn = connect_jsonl_db(self.conf)
+        finalize_jsonl(loc.s3sig, loc.db_conn, self.conf, e)
+
+    def _check_done(self) -> None:
+        """Raise errors from finished uploads"""
+        pending = []
+        for fut in self._futures:
+            if fut.done():
+                fut.result()
+            else:
+                pending.append(fut)
+        self._futures = pending
+
+    def close(self) -> None:
+        """Wait for all uploads. Raises the first error"""
+        if self._pool is None:
+            return
+        try:
+            for fut in self._futures:
+                fut.result()
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+## Parallel processing
+
+# Clients for each worker process
+_worker: dict = {}
+
+
+def _init_worker(conf) -> None:
+    # Connections are not shared with the parent across fork()
+    _worker["conf"] = conf
+    _worker["s3uns"] = s3f.create_s3_client()
+    _worker["s3sig"] = create_s3_client(conf)
+    _worker["db_conn"] = connect_db(conf)
+
+
+def shard_dir(workdir: Path, key: str) -> Path:
+    """Directory for the msmts with bundle key "<cc> <testname>" """
+    return workdir / hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+@metrics.timer("shard_can")
+def shard_can(
+    workdir: Path, can_num: int, can_fn: str, size: int
+) -> Tuple[Dict[str, int], List[Tuple[int, str, str]]]:
+    """Load a can and split its msmts by bundle key into
+    <shard dir>/<can_num>.jsonl.lz4 files as [position, uid, msm].
+    Broken msmts are dropped.
+    Returns the bytes written for each key and (position, uid, key) for
+    the msmts that are bundled unless duplicate.
+    """
+    conf = _worker["conf"]
+    fds: Dict[str, Any] = {}
+    written: Dict[str, int] = {}
+    bundled: List[Tuple[int, str, str]] = []
+    msmts = load_can(_worker["s3uns"], can_fn, size, conf)
+    for pos, msm_tup in enumerate(msmts):
+        try:
+            msm, input_, cc, tn = parse_msmt(msm_tup)
+        except Exception:
+            log.info(f"Ignoring broken measurement {msm_tup[2]}")
+            metrics.incr("broken_measurement")
+            continue
+
+        key = f"{cc} {tn}"
+        if key not in fds:
+            d = shard_dir(workdir, key)
+            d.mkdir(parents=True, exist_ok=True)
+            fds[key] = lz4frame.open(d / f"{can_num:06}.jsonl.lz4", "wt")
+            written[key] = 0
+        line = json.dumps([pos, msm_tup[2], msm]) + "\n"
+        fds[key].write(line)
+        written[key] += len(line)
+        if is_bundled(msm):
+            bundled.append((pos, msm_tup[2], key))
+
+    for fd in fds.values():
+        fd.close()
+    flush_metrics()  # atexit does not run in pool workers
+    return written, bundled
+
+
+def _shard_can(args) -> Tuple[Dict[str, int], List[Tuple[int, str, str]]]:
+    return shard_can(*args)
+
+
+@metrics.timer("process_shard")
+def process_shard(
+    workdir: Path, key: str, cans_fns: List[str], dups: Set[Tuple[int, int]]
+) -> dict:
+    """Bundle the msmts of a "<cc> <testname>" shard in can order, as the
+    serial processing does. Returns the stats of the shard.
+    Duplicates are found across shards by the parent: dups holds their
+    (can number, position)
+    """
+    conf = _worker["conf"]
+    uploader = Uploader(conf, _worker["s3sig"], _worker["db_conn"])
+    for k in SHARD_STATS:
+        stats[k] = 0
+    buf: dict = {}
+    no_uids = UidSet()  # always empty: duplicates are skipped here
+    d = shard_dir(workdir, key)
+    for f in sorted(d.iterdir()):
+        can_num = int(f.name.split(".")[0])
+        can_fn = cans_fns[can_num]
+        with lz4frame.open(f, "rt") as fd:
+            for line in fd:
+                pos, msmt_uid, msm = json.loads(line)
+                if (can_num, pos) in dups:
+                    log.info(f"Ignoring DUPLICATE {msmt_uid} {key}")
+                    metrics.incr("duplicate_measurement")
+                    continue
+                msm_tup = (None, msm, msmt_uid)
+                process_measurement(can_fn, msm_tup, buf, no_uids, conf, uploader)
+        f.unlink()
+
+    finalize_open_jsonl(uploader, buf)
+    uploader.close()
+    db.flush_inserts()
+    flush_metrics()  # atexit does not run in pool workers
+    d.rmdir()
+    return dict(stats)
+
+
+def _process_shard(args) -> dict:
+    return process_shard(*args)
+
+
+def process_day_parallel(conf, cans_fns) -> None:
+    """Split the msmts by bundle key, then bundle each key in parallel"""
+    workdir = Path(f"reprocessor_{conf.day.strftime('%Y%m%d')}")
+    shutil.rmtree(workdir, ignore_errors=True)
+    workdir.mkdir()
+    tot_size = sum(size for _, size in cans_fns)
+    processed_size = 0
+    shard_sizes: Dict[str, int] = {}
+    # Same dedup as a serial run: the first bundled msmt for each uid wins
+    seen_uids = UidSet(exact=not conf.lossy_dedup)
+    dups: Dict[str, Set[Tuple[int, int]]] = {}  # key -> (can_num, position)
+    with mp.Pool(conf.workers, _init_worker, (conf,)) as pool:
+        jobs = [(workdir, n, fn, size) for n, (fn, size) in enumerate(cans_fns)]
+        results = zip(jobs, pool.imap(_shard_can, jobs))
+        for (_, can_num, _, size), (written, bundled) in results:
+            for key, cnt in written.items():
+                shard_sizes[key] = shard_sizes.get(key, 0) + cnt
+            for pos, msmt_uid, key in bundled:
+                if msmt_uid in seen_uids:
+                    dups.setdefault(key, set()).add((can_num, pos))
+                    stats["dedup_duplicates"] += 1
+                else:
+                    seen_uids.add(msmt_uid)
+            processed_size += size
+            stats.update(seen_uids.stats())
+            progress(stats["t0"], processed_size, tot_size)
+
+        log.info(f"Bundling {len(shard_sizes)} shards")
+        # Largest first to balance the workers
+        keys = sorted(shard_sizes, key=lambda k: (-shard_sizes[k], k))
+        fns = [fn for fn, _ in cans_fns]
+        jobs = [(workdir, key, fns, dups.get(key, set())) for key in keys]
+        for shard_stats in pool.imap_unordered(_process_shard, jobs):
+            for k in SHARD_STATS:
+                stats[k] += shard_stats[k]
+            log.info(f"Shard done {stats}")
+
+    workdir.rmdir()
+
+
+@metrics.timer("total_run_time")
+def main():
+    conf = parse_args()
+    log.info(f"From bucket {conf.src_bucket} to {conf.dst_bucket}")
+    s3sig = create_s3_client(conf)  # signed client for writing
+    db_conn = connect_db(conf)
+    update_fingerprints_if_needed()
 
     # s3_check(s3sig, "ooni-data-eu-fra", "none", "jsonl/tor/VE/20200827/00/20200827_VE_tor.l.0.jsonl.gz")
     # Fetch msmts for one day
     buf = {}  # "<cc> <testname>" -> jsonlf / fd / jsonl_s3path
-    seen_uids = set()  # Avoid uploading duplicates
+    seen_uids = UidSet(exact=not conf.lossy_dedup)  # Avoid uploading duplicates
 
     # raw/20210601/00/SA/webconnectivity/2021060100_SA_webconnectivity.n0.0.jsonl.gz
     # jsonl_s3path = f"raw/{ts}/00/{cc}/{testname}/{jsonlf.name}"
@@ -401,22 +803,26 @@ def main():
     log.info(f"{tot_size/1024/1024/1024} GB to process")
     log.info(f"{len(cans_fns)} cans to process")
     stats["t0"] = time.time()
+    if conf.workers > 1:
+        process_day_parallel(conf, cans_fns)
+        log.info(f"Exiting {stats}")
+        return
+
     #  TODO make assertions on msmt
     #  TODO add consistency check on trivial id found in fastpath table
-    for can in cans_fns:
-        can_fn, size = can
-        process_can(db_conn, s3uns, s3sig, can_fn, size, conf, buf, seen_uids)
+    uploader = Uploader(conf, s3sig, db_conn)
+    for can_fn, size, downloaded in prefetch_cans(s3uns, cans_fns, conf):
+        process_can(can_fn, size, downloaded, conf, buf, seen_uids, uploader)
         processed_size += size
+        stats.update(seen_uids.stats())
         progress(stats["t0"], processed_size, tot_size)
 
     log.info("Finish jsonl files still open")
-    for json_entities in buf.values():
-        for e in json_entities:
-            if e.fd.closed:
-                continue
-            finalize_jsonl(s3sig, db_conn, conf, e)
+    finalize_open_jsonl(uploader, buf)
+    uploader.close()
 
-    log.info("Exiting")
+    db.flush_inserts()
+    log.info(f"Exiting {stats}")
 
 
 if __name__ == "__main__":
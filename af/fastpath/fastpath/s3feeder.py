@@ -9,11 +9,15 @@ AWS_PROFILE=ooni-data aws s3 ls s3://ooni-data/canned/2019-07-16/
 
 """
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date, timedelta
-from typing import Generator, Set
+from typing import Deque, Generator, Optional, Set, Tuple
 from pathlib import Path
 import logging
 import os
+import re
+import threading
 import time
 import tarfile
 
@@ -26,14 +30,22 @@ import boto3  # debdeps: python3-boto3
 from botocore import UNSIGNED as botoSigUNSIGNED
 from botocore.config import Config as botoConfig
 
+from fastpath.cancache import CanCache, get_can_cache
 from fastpath.metrics import setup_metrics
 from fastpath.mytypes import MsmtTup  # msmt bytes, msmt dict, uid
-from fastpath.normalize import iter_yaml_msmt_normalized
+from fastpath.normalize import iter_yaml_msmt_normalized, get_yaml_pool
+from fastpath.normalize import test_name_mappings
 from fastpath.utils import trivial_id
+from fastpath.yamlcache import YamlCache, get_yaml_cache, is_cacheable
 
 CAN_BUCKET_NAME = "ooni-data"
 MC_BUCKET_NAME = "ooni-data-eu-fra"
 
+# Max number of cans downloaded ahead of the consumer
+PREFETCH_CANS = 4
+# Max bytes of cans downloaded and not yet consumed
+PREFETCH_DISK_BUDGET = 2 * 1024 * 1024 * 1024
+
 log = logging.getLogger("fastpath")
 metrics = setup_metrics(name="fastpath.s3feeder")
 
@@ -42,74 +54,224 @@ for x in ("urllib3", "botocore", "s3transfer"):
     logging.getLogger(x).setLevel(logging.INFO)
 
 
-def load_multiple(fn: str) -> Generator[MsmtTup, None, None]:
+class MsmtFilter:
+    """Filter by probe_cc and test_name applied at each layer, as early as
+    possible: can filenames, tar members, raw JSON bytes and parsed
+    measurements. Test names are compared without underscores, after
+    mapping legacy names e.g. dnstamper as the YAML normalizer does.
+    Discards are counted for each layer in the filtered_<layer> metrics.
+    """
+
+    _cc_re = re.compile(rb'"probe_cc":\s*"([^"]*)"')
+    _tn_re = re.compile(rb'"test_name":\s*"([^"]*)"')
+
+    def __init__(self, ccs: Optional[Set[str]], testnames: Optional[Set[str]]):
+        self.ccs = set(ccs) if ccs else None
+        self.testnames = None
+        if testnames:
+            self.testnames = set(t.replace("_", "") for t in testnames)
+
+    @classmethod
+    def from_conf(cls, conf) -> Optional["MsmtFilter"]:
+        if not conf.ccs and not conf.testnames:
+            return None
+        return cls(conf.ccs, conf.testnames)
+
+    def _accept(self, cc, tn) -> bool:
+        """None values are unknown and accepted"""
+        if self.ccs is not None and cc is not None and cc not in self.ccs:
+            return False
+        if self.testnames is not None and tn is not None:
+            tn = test_name_mappings.get(tn, tn.lower())
+            if tn.replace("_", "") not in self.testnames:
+                return False
+        return True
+
+    def _discard(self, layer: str) -> bool:
+        metrics.incr(f"filtered_{layer}")
+        return False
+
+    def accept_filename(self, fn: str, layer: str) -> bool:
+        """Check legacy can, report file and post filenames e.g.:
+        web_connectivity.00.tar.lz4
+        20180501T071932Z-IT-AS198471-web_connectivity-<report id>-probe.json
+        20210614004521.999962_JO_signal_68eb19b439326d60.post
+        """
+        name = fn.rsplit("/", 1)[-1]
+        cc = tn = None
+        if name.endswith(".post"):
+            parts = name.split("_")
+            if len(parts) == 4:
+                cc, tn = parts[1], parts[2]
+        elif "-" in name:
+            parts = name.split("-")
+            if len(parts) > 4 and parts[2].startswith("AS"):
+                cc, tn = parts[1], parts[3]
+        elif name.endswith(".tar.lz4"):
+            tn = name.split(".", 1)[0]
+        return self._accept(cc, tn) or self._discard(layer)
+
+    @staticmethod
+    def _probe(regex, raw: bytes) -> Optional[str]:
+        """Returns the value of a key or None if unknown. The key can also
+        appear nested e.g. in test_keys, before the top level one: values
+        are ambiguous if they differ
+        """
+        values = set(m.group(1) for m in regex.finditer(raw))
+        if len(values) != 1:
+            return None
+        return values.pop().decode("utf-8", "replace")
+
+    def accept_raw(self, raw: bytes) -> bool:
+        """Cheap byte-level probe before JSON decoding"""
+        cc = self._probe(self._cc_re, raw) if self.ccs is not None else None
+        tn = self._probe(self._tn_re, raw) if self.testnames is not None else None
+        return self._accept(cc, tn) or self._discard("raw")
+
+    def accept_msm(self, msm: dict) -> bool:
+        cc = msm.get("probe_cc")
+        tn = msm.get("test_name")
+        return self._accept(cc, tn) or self._discard("msmt")
+
+
+def load_multiple(
+    fn: str,
+    fileobj=None,
+    flt: Optional[MsmtFilter] = None,
+    ycache: Optional[YamlCache] = None,
+    size: Optional[int] = None,
+) -> Generator[MsmtTup, None, None]:
     """Load contents of legacy cans and minicans.
     Decompress tar archives if found.
     Yields measurements one by one as:
         (string of JSON, None, uid) or (None, msmt dict, uid)
     The uid is either taken from the filename or generated by trivial_id for
     legacy cans
+    If fileobj is set the can is read sequentially from it, e.g. from a
+    S3 response body, and fn is used only to detect the format.
+    If flt is set measurements are filtered as early as possible.
+    If ycache is set legacy cans with YAML reports are loaded from the cache
+    of normalized measurements, or added to it when loaded without filters.
+    size is the can size, required with fileobj.
     """
+    if ycache is None or not is_cacheable(fn):
+        yield from _load_multiple(fn, fileobj, flt)
+        return
+
+    if size is None:
+        size = os.path.getsize(fn)
+    cached = ycache.load(fn, size)
+    if cached is not None:
+        for msm in cached:
+            if flt and not flt.accept_msm(msm):
+                continue
+            yield (None, msm, msm["measurement_uid"])
+        return
+
+    if flt:
+        # Filtered output would be incomplete
+        yield from _load_multiple(fn, fileobj, flt)
+        return
+
+    w = ycache.writer(fn, size)
+    try:
+        for msmt_tup in _load_multiple(fn, fileobj, None, w.mark_yaml):
+            w.write(msmt_tup[1])
+            yield msmt_tup
+        w.commit()
+    finally:
+        w.discard()
+
+
+def _load_multiple(
+    fn: str, fileobj=None, flt: Optional[MsmtFilter] = None, on_yaml=None
+) -> Generator[MsmtTup, None, None]:
+    """Load a can. on_yaml is called when YAML reports are found"""
     # TODO: split this and handle legacy cans and post/minicans independently
+    src = fn if fileobj is None else fileobj
     if fn.endswith(".tar.lz4"):
         # Legacy lz4 cans
-        with lz4frame.open(fn) as f:
-            tf = tarfile.TarFile(fileobj=f)
+        with lz4frame.open(src) as f:
+            tf = tarfile.open(fileobj=f, mode="r|")
             while True:
                 m = tf.next()
                 if m is None:
                     # end of tarball
                     break
+                if flt and not flt.accept_filename(m.name, "tar_member"):
+                    continue
                 log.debug("Loading nested %s", m.name)
                 k = tf.extractfile(m)
                 assert k is not None
                 if m.name.endswith(".json"):
                     for line in k:
+                        if flt and not flt.accept_raw(line):
+                            continue
                         try:
                             msm = ujson.loads(line)
                         except ValueError:
                             log.info("Unable to parse measurement")
                             continue
 
+                        if flt and not flt.accept_msm(msm):
+                            continue
                         msmt_uid = trivial_id(line, msm)
                         msm["measurement_uid"] = msmt_uid
                         yield (None, msm, msmt_uid)
 
                 elif m.name.endswith(".yaml"):
+                    if on_yaml:
+                        on_yaml()
                     bucket_tstamp = fn.split("/")[-2]
                     rfn = f"{bucket_tstamp}/" + fn.split("/")[-1]
-                    for msm in iter_yaml_msmt_normalized(k, bucket_tstamp, rfn):
+                    # The pool is forked only when a can has YAML reports
+                    pool = get_yaml_pool()
+                    for msm in iter_yaml_msmt_normalized(k, bucket_tstamp, rfn, pool):
                         metrics.incr("yaml_normalization")
+                        if flt and not flt.accept_msm(msm):
+                            continue
                         msmt_uid = msm["measurement_uid"]
                         yield (None, msm, msmt_uid)
 
     elif fn.endswith(".json.lz4"):
         # Legacy lz4 json files
-        with lz4frame.open(fn) as f:
+        with lz4frame.open(src) as f:
             for line in f:
+                if flt and not flt.accept_raw(line):
+                    continue
                 try:
                     msm = ujson.loads(line)
                 except ValueError:
                     log.info("Unable to parse measurement")
                     continue
 
+                if flt and not flt.accept_msm(msm):
+                    continue
                 msmt_uid = trivial_id(line, msm)
                 msm["measurement_uid"] = msmt_uid
                 yield (None, msm, msmt_uid)
 
     elif fn.endswith(".yaml.lz4"):
         # Legacy lz4 yaml files
-        with lz4frame.open(fn) as f:
+        if on_yaml:
+            on_yaml()
+        with lz4frame.open(src) as f:
             bucket_tstamp = fn.split("/")[-2]
             rfn = f"{bucket_tstamp}/" + fn.split("/")[-1]
-            for msm in iter_yaml_msmt_normalized(f, bucket_tstamp, rfn):
+            pool = get_yaml_pool()
+            for msm in iter_yaml_msmt_normalized(f, bucket_tstamp, rfn, pool):
                 metrics.incr("yaml_normalization")
+                if flt and not flt.accept_msm(msm):
+                    continue
                 msmt_uid = msm["measurement_uid"]
                 yield (None, msm, msmt_uid)
 
     elif fn.endswith(".tar.gz"):
         # minican with missing gzipping :(
-        tf = tarfile.open(fn)
+        if fileobj is None:
+            tf = tarfile.open(fn)
+        else:
+            tf = tarfile.open(fileobj=fileobj, mode="r|*")
         while True:
             m = tf.next()
             if m is None:
@@ -117,14 +279,18 @@ def load_multiple(fn: str) -> Generator[MsmtTup, None, None]:
                 tf.close()
                 break
             log.debug("Loading %s", m.name)
-            k = tf.extractfile(m)
-            assert k is not None
             if not m.name.endswith(".post"):
                 log.error("Unexpected filename")
                 continue
 
+            if flt and not flt.accept_filename(m.name, "tar_member"):
+                continue
+            k = tf.extractfile(m)
+            assert k is not None
             try:
                 raw = k.read()  # type: bytes
+                if flt and not flt.accept_raw(raw):
+                    continue
                 j = ujson.loads(raw)
             except Exception:
                 log.error(repr(k)[:100], exc_info=True)
@@ -133,6 +299,8 @@ def load_multiple(fn: str) -> Generator[MsmtTup, None, None]:
             fmt = j.get("format", "")
             if fmt == "json":
                 msm = j.get("content", {})
+                if flt and not flt.accept_msm(msm):
+                    continue
                 # extract msmt_uid from filename e.g:
                 # ... /20210614004521.999962_JO_signal_68eb19b439326d60.post
                 msmt_uid = m.name.rsplit("/", 1)[1]
@@ -220,6 +388,10 @@ def list_minicans_on_s3_for_a_day(
     assert False
 
 
+def get_cache(conf) -> CanCache:
+    return get_can_cache(conf.s3cachedir, conf.s3_cache_quota)
+
+
 def log_download(s3fname, size) -> None:
     s = size / 1024 / 1024
     d = "M"
@@ -229,66 +401,177 @@ def log_download(s3fname, size) -> None:
     log.info(f"Downloading can {s3fname} size {s:.1f} {d}B")
 
 
+class DownloadProgress:
+    """Download metrics aggregated across concurrent downloads"""
+
+    def __init__(self, total_size: int) -> None:
+        self.total_size = total_size
+        self.total_count = 0
+        self.start_time: Optional[float] = None
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_count: int) -> None:
+        with self.lock:
+            now = time.time()
+            if self.start_time is None:
+                self.start_time = now
+            self.total_count += bytes_count
+            count = self.total_count
+            elapsed = now - self.start_time
+
+        if self.total_size:
+            metrics.gauge("s3_download_percentage", count / self.total_size * 100)
+        if elapsed > 0:
+            metrics.gauge("s3_download_speed_avg_Mbps", count / 131_072 / elapsed)
+
+    def set_active(self, delta: int) -> None:
+        with self.lock:
+            self.active += delta
+            metrics.gauge("fetching", self.active)
+
+
+def _download_can(s3, s3fname: str, diskf: Path, size: int, progress) -> Path:
+    log_download(s3fname, size)
+    diskf.parent.mkdir(parents=True, exist_ok=True)
+    tmpf = diskf.with_suffix(".s3tmp")
+    progress.set_active(1)
+    try:
+        with tmpf.open("wb") as f:
+            bucket_name = CAN_BUCKET_NAME if "canned/" in s3fname else MC_BUCKET_NAME
+            s3.download_fileobj(bucket_name, s3fname, f, Callback=progress)
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        progress.set_active(-1)
+    tmpf.rename(diskf)
+    assert size == diskf.stat().st_size
+    return diskf
+
+
 @metrics.timer("fetch_cans")
-def fetch_cans(s3, conf, files) -> Generator[Path, None, None]:
+def fetch_cans(
+    s3, conf, files, prefetch=PREFETCH_CANS, disk_budget=PREFETCH_DISK_BUDGET
+) -> Generator[Path, None, None]:
     """
     Download cans to a local directory
     fnames = [("2013-09-12/20130912T150305Z-MD-AS1547-http_", size), ... ]
-    yield each can file Path
+    yield each can file Path, sorted by s3fname
+    Up to `prefetch` cans are downloaded concurrently ahead of the consumer
+    as long as the cans downloaded and not yet consumed fit in disk_budget
+    bytes. A can is consumed when the next one is requested.
+    Cans are pinned in the cache until consumed: downloads of other cans
+    cannot evict them.
     """
     # fn: can filename without path
     # diskf: File in the s3cachedir directory
+    cache = get_cache(conf)
     cans = []  # (s3fname, filename on disk, size, download required)
-    for s3fname, size in files:
+    pinned = set()
+    for s3fname, size in sorted(set(files)):
         diskf = conf.s3cachedir / s3fname.split("/", 1)[1]
-        if diskf.exists() and size == diskf.stat().st_size:
+        cache.pin(diskf)
+        pinned.add(diskf)
+        if cache.lookup(diskf, size):
             metrics.incr("cache_hit")
-            diskf.touch(exist_ok=True)
             cans.append((s3fname, diskf, size, False))
         else:
             metrics.incr("cache_miss")
             cans.append((s3fname, diskf, size, True))
 
-    def _cb(bytes_count):
-        if _cb.start_time is None:
-            _cb.start_time = time.time()
-            _cb.count = bytes_count
-            return
-        _cb.count += bytes_count
-        _cb.total_count += bytes_count
-        metrics.gauge("s3_download_percentage", _cb.total_count / _cb.total_size * 100)
-        try:
-            speed = _cb.count / 131_072 / (time.time() - _cb.start_time)
-            metrics.gauge("s3_download_speed_avg_Mbps", speed)
-        except ZeroDivisionError:
-            pass
-
     cans = sorted(set(cans))
-    _cb.total_size = sum(t[2] for t in cans if t[3])
-    _cb.total_count = 0
-
-    for s3fname, diskf, size, dload_required in cans:
-        if not dload_required:
-            yield diskf  # already in local cache
-            continue
-
-        # TODO: handle missing file
-        log_download(s3fname, size)
-        diskf.parent.mkdir(parents=True, exist_ok=True)
-        tmpf = diskf.with_suffix(".s3tmp")
-        metrics.gauge("fetching", 1)
-        _cb.start_time = None
-        with tmpf.open("wb") as f:
-            bucket_name = CAN_BUCKET_NAME if "canned/" in s3fname else MC_BUCKET_NAME
-            s3.download_fileobj(bucket_name, s3fname, f, Callback=_cb)
-            f.flush()
-            os.fsync(f.fileno())
-        metrics.gauge("fetching", 0)
-        tmpf.rename(diskf)
-        assert size == diskf.stat().st_size
-        yield diskf
+    progress = DownloadProgress(sum(t[2] for t in cans if t[3]))
+    prefetch = max(prefetch, 1)
+    todo = deque(cans)
+    pending: Deque[Tuple[Optional[Future], Path, int]] = deque()
+    pending_bytes = 0  # downloaded or being downloaded, not consumed yet
+    ex = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="s3fetch")
+    try:
+        while todo or pending:
+            while todo and len(pending) < prefetch:
+                s3fname, diskf, size, dload_required = todo[0]
+                if not dload_required:
+                    pending.append((None, diskf, 0))  # already in local cache
+                elif pending_bytes + size <= disk_budget or not pending_bytes:
+                    fut = ex.submit(_download_can, s3, s3fname, diskf, size, progress)
+                    pending.append((fut, diskf, size))
+                    pending_bytes += size
+                else:
+                    break  # over budget
+                todo.popleft()
+
+            metrics.gauge("prefetch_depth", len(pending))
+            metrics.gauge("prefetch_bytes", pending_bytes)
+            fut, diskf, size = pending.popleft()
+            if fut is not None:
+                # TODO: handle missing file
+                fut.result()
+                cache.add(diskf, size)
+            yield diskf
+            pending_bytes -= size
+            cache.unpin(diskf)
+            pinned.discard(diskf)
+
+    finally:
+        for fut, _, _ in pending:
+            if fut is not None:
+                fut.cancel()
+        ex.shutdown(wait=True)
+        for diskf in pinned:
+            cache.unpin(diskf)
+        metrics.gauge("prefetch_depth", 0)
+        metrics.gauge("s3_download_speed_avg_Mbps", 0)
+
+
+class MeteredReader:
+    """Wraps a file-like object and reports bytes read to a callback"""
+
+    def __init__(self, f, callback) -> None:
+        self._f = f
+        self._callback = callback
+
+    def read(self, n=-1) -> bytes:
+        data = self._f.read(n)
+        self._callback(len(data))
+        return data
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def stream_can(s3, conf, s3fname: str, size: int) -> Generator[MsmtTup, None, None]:
+    """Load a can while downloading it, without writing it to disk.
+    Cans already in the local cache are loaded from disk.
+    """
+    flt = MsmtFilter.from_conf(conf)
+    ycache = get_yaml_cache(conf)
+    if ycache and ycache.has(s3fname, size):
+        yield from load_multiple(s3fname, None, flt, ycache, size)
+        return
 
-    metrics.gauge("s3_download_speed_avg_Mbps", 0)
+    diskf = conf.s3cachedir / s3fname.split("/", 1)[1]
+    cache = get_cache(conf)
+    cache.pin(diskf)
+    try:
+        if cache.lookup(diskf, size):
+            metrics.incr("cache_hit")
+            yield from load_multiple(diskf.as_posix(), None, flt, ycache, size)
+            return
+    finally:
+        cache.unpin(diskf)
+
+    metrics.incr("stream_can")
+    log_download(s3fname, size)
+    bucket_name = CAN_BUCKET_NAME if "canned/" in s3fname else MC_BUCKET_NAME
+    body = s3.get_object(Bucket=bucket_name, Key=s3fname)["Body"]
+    progress = DownloadProgress(size)
+    progress.set_active(1)
+    try:
+        reader = MeteredReader(body, progress)
+        yield from load_multiple(s3fname, reader, flt, ycache, size)
+    finally:
+        progress.set_active(-1)
+        body.close()
 
 
 # TODO: merge with stream_daily_cans, add caching to the latter to be used
@@ -323,39 +606,95 @@ def _update_eta(t0, start_day, day, stop_day, can_num, can_tot_count):
         pass
 
 
-def stream_cans(conf, start_day: date, end_day: date) -> Generator[MsmtTup, None, None]:
-    """Stream cans from S3"""
+def get_stop_day(start_day: date, end_day: date) -> Optional[date]:
+    """Returns the day when S3 feeding stops (not included) or None if
+    there is nothing to feed"""
     today = date.today()
     if not start_day or start_day >= today:
-        return
+        return None
+    return end_day if end_day < today else today
 
-    log.info("Fetching older cans from S3")
-    t0 = time.time()
+
+def list_cans_by_day(
+    s3, conf, start_day: date, stop_day: date
+) -> Generator[Tuple[date, list], None, None]:
+    """Yields (day, [(s3fname, size), ... ]) for cans and minicans.
+    Cans and minicans are filtered by conf.ccs and conf.testnames when
+    possible from the filename
+    """
     day = start_day
-    s3 = create_s3_client()
-    # the last day is not included
-    stop_day = end_day if end_day < today else today
     while day < stop_day:
         log.info("Processing day %s", day)
         cans_fns = list_cans_on_s3_for_a_day(s3, day)
+        flt = MsmtFilter.from_conf(conf)
+        if flt:
+            cans_fns = [c for c in cans_fns if flt.accept_filename(c[0], "can")]
         minicans_fns = list_minicans_on_s3_for_a_day(s3, day, conf.ccs, conf.testnames)
         cans_fns.extend(minicans_fns)
-        for cn, can_f in enumerate(fetch_cans(s3, conf, cans_fns)):
+        yield day, cans_fns
+        day += timedelta(days=1)
+
+
+def discard_can(conf, can_f: Path) -> None:
+    """Delete a processed can from disk unless keep_s3_cache is set"""
+    if conf.keep_s3_cache:
+        return
+    get_cache(conf).remove(can_f)
+    try:
+        can_f.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def stream_cans(conf, start_day: date, end_day: date) -> Generator[MsmtTup, None, None]:
+    """Stream cans from S3"""
+    # the last day is not included
+    stop_day = get_stop_day(start_day, end_day)
+    if stop_day is None:
+        return
+
+    log.info("Fetching older cans from S3")
+    t0 = time.time()
+    flt = MsmtFilter.from_conf(conf)
+    ycache = get_yaml_cache(conf)
+    s3 = create_s3_client()
+    for day, cans_fns in list_cans_by_day(s3, conf, start_day, stop_day):
+        cans_fns = sorted(set(cans_fns))
+        if conf.s3_stream:
+            # stream_can loads cans in the YAML cache from the cache
+            for cn, (s3fname, size) in enumerate(cans_fns):
+                try:
+                    _update_eta(t0, start_day, day, stop_day, cn, len(cans_fns))
+                    yield from stream_can(s3, conf, s3fname, size)
+                except Exception as e:
+                    log.error(str(e), exc_info=True)
+            continue
+
+        # Cans in the YAML cache do not need to be downloaded. The other
+        # cans are prefetched and all are yielded in listing order
+        cached = set(c for c in cans_fns if ycache and ycache.has(*c))
+        budget = conf.s3_prefetch_budget
+        to_fetch = [c for c in cans_fns if c not in cached]
+        downloads = fetch_cans(s3, conf, to_fetch, conf.s3_prefetch, budget)
+        for cn, (s3fname, size) in enumerate(cans_fns):
+            if (s3fname, size) in cached:
+                try:
+                    _update_eta(t0, start_day, day, stop_day, cn, len(cans_fns))
+                    yield from load_multiple(s3fname, None, flt, ycache, size)
+                except Exception as e:
+                    log.error(str(e), exc_info=True)
+                continue
+
+            can_f = next(downloads)
             try:
                 _update_eta(t0, start_day, day, stop_day, cn, len(cans_fns))
                 # log.info("can %s ready", can_f.name)
-                for msmt_tup in load_multiple(can_f.as_posix()):
+                for msmt_tup in load_multiple(can_f.as_posix(), None, flt, ycache):
                     yield msmt_tup
             except Exception as e:
                 log.error(str(e), exc_info=True)
 
-            if not conf.keep_s3_cache:
-                try:
-                    can_f.unlink()
-                except FileNotFoundError:
-                    pass
-
-        day += timedelta(days=1)
+            discard_can(conf, can_f)
 
     if end_day:
         log.info(f"Reached {end_day}, streaming cans from S3 finished")
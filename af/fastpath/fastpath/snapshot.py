@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned snapshot of a Python object published to worker processes
+
+The parent process builds the object once and publishes it pickled into
+anonymous shared memory, inherited by the workers on fork. Each publish
+bumps the version. Workers check the version cheaply and unpickle the
+object only when it changes.
+
+This saves the workers from building the object. It does not save memory:
+only the pickled bytes are shared and each worker holds its own unpickled
+copy of every update. The version published before forking is inherited
+copy-on-write, until its pages are written e.g. by reference count updates.
+"""
+
+from typing import Any, Optional
+import mmap
+import multiprocessing as mp
+import pickle
+import struct
+
+DEFAULT_CAPACITY = 128 * 1024 * 1024
+
+_HDR = struct.Struct("=QQ")  # version, payload length
+
+
+class SharedSnapshot:
+    """Pickled object in shared memory, unpickled by each process.
+    Must be created before forking the workers"""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity = capacity
+        # Anonymous shared mapping: pages are allocated only when used
+        self._mm = mmap.mmap(-1, _HDR.size + capacity)
+        self._lock = mp.Lock()
+        self._loaded_version = 0  # version seen by this process
+
+    def publish(self, obj: Any) -> int:
+        """Publish a new version of obj. Returns the version number.
+        The publishing process does not need to load it back.
+        """
+        blob = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.capacity:
+            raise ValueError("Snapshot larger than the shared memory capacity")
+        with self._lock:
+            version, _ = _HDR.unpack_from(self._mm, 0)
+            version += 1
+            self._mm[_HDR.size : _HDR.size + len(blob)] = blob
+            _HDR.pack_into(self._mm, 0, version, len(blob))
+        self._loaded_version = version
+        return version
+
+    @property
+    def version(self) -> int:
+        return _HDR.unpack_from(self._mm, 0)[0]
+
+    def load_if_changed(self) -> Optional[Any]:
+        """Returns the object if a newer version has been published since the
+        last call in this process, otherwise None"""
+        if self.version == self._loaded_version:
+            return None
+        with self._lock:
+            version, length = _HDR.unpack_from(self._mm, 0)
+            blob = self._mm[_HDR.size : _HDR.size + length]
+        self._loaded_version = version
+        return pickle.loads(blob)
@@ -676,6 +676,57 @@ def test_score_http_requests():
 ## test_name: web_connectivity
 
 
+def _http_bodies(cans) -> list:
+    """HTTP response bodies from real web_connectivity measurements"""
+    bodies = []
+    for can_name in ("web_conn_it", "web_conn_cn", "web_conn_30", "big2858"):
+        can = cans[can_name].as_posix()
+        for msm_jstr, msm, msm_uid in s3feeder.load_multiple(can):
+            msm = msm or ujson.loads(msm_jstr)
+            for req in core.g(msm, "test_keys", "requests", default=()):
+                body = core.gn(req, "response", "body")
+                if isinstance(body, dict) and body.get("format") == "base64":
+                    body = core.b64decode(body["data"])
+                if isinstance(body, (str, bytes)):
+                    bodies.append(body)
+    return bodies
+
+
+def _match_body_loop(body) -> list:
+    """Loop over the fingerprints as done before BodyMatcher"""
+    out = []
+    for f in core.fingerprints["http"]:
+        if f["location_found"] != "body":
+            continue
+        bmatch = f["pattern"]
+        if isinstance(body, bytes):
+            idx = body.find(bmatch.encode())
+        else:
+            idx = body.find(bmatch)
+        if idx != -1:
+            out.append((f, idx))
+    return out
+
+
+def test_match_http_body_fingerprints(cans):
+    """BodyMatcher finds the same fingerprints as a loop on real bodies"""
+    bodies = _http_bodies(cans)
+    assert bodies
+    bm = core.fingerprints["http_body"]
+    assert [bm.find_all(b) for b in bodies] == [_match_body_loop(b) for b in bodies]
+
+
+def benchmark_match_http_body_fingerprints_loop(benchmark, cans):
+    bodies = _http_bodies(cans)
+    benchmark(lambda: [_match_body_loop(b) for b in bodies])
+
+
+def benchmark_match_http_body_fingerprints(benchmark, cans):
+    bodies = _http_bodies(cans)
+    bm = core.fingerprints["http_body"]
+    benchmark(lambda: [bm.find_all(b) for b in bodies])
+
+
 def test_score_web_connectivity_simple(cans):
     # (rid, inp) -> scores: exact match on scores
     expected = {
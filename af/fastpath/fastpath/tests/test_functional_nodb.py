@@ -2,13 +2,23 @@
 Functional tests with a mocked-out Clickhouse database
 """
 
+from pathlib import Path
 from unittest.mock import Mock
 import datetime
+import gzip
+import io
+import json
+import shutil
+import sys
+import tarfile
+import threading
 
 import pytest  # debdeps: python3-pytest
+import ujson
 
 import fastpath.core as core
 import fastpath.db
+import fastpath.lazyjson
 from test_unit import loadj
 
 
@@ -37,6 +47,7 @@ def setup_conf():
 @pytest.fixture(autouse=True)
 def mockdb():
     fastpath.db.click_client = Mock()
+    fastpath.db.insert_buffers.clear()
     yield
     fastpath.db.click_client = None
 
@@ -114,6 +125,7 @@ def test_fetch_fingerprints(fprints):
 def test_score_web_connectivity_bug_610_2(fprints):
     msm = loadj("web_connectivity_null2")
     core.process_measurement((None, msm, "bogus_uid"))
+    fastpath.db.flush_inserts()
 
     exe = fastpath.db.click_client.execute
     assert exe.called_once
@@ -155,13 +167,400 @@ def test_score_web_connectivity_bug_610_2(fprints):
     ]
 
 
+def test_buffered_inserts():
+    msm = loadj("web_connectivity_null2")
+    core.process_measurement((None, msm, "bogus_uid_1"))
+    core.process_measurement((None, msm, "bogus_uid_2"))
+    exe = fastpath.db.click_client.execute
+    assert exe.call_count == 0
+    fastpath.db.flush_inserts_if_needed()
+    assert exe.call_count == 0
+
+    fastpath.db.flush_inserts()
+    assert exe.call_count == 1
+    query, qparams = exe.call_args[0]
+    assert [r["measurement_uid"] for r in qparams] == ["bogus_uid_1", "bogus_uid_2"]
+
+    # nothing left to flush
+    fastpath.db.flush_inserts()
+    assert exe.call_count == 1
+
+
+def test_buffered_inserts_thresholds(monkeypatch):
+    monkeypatch.setattr(fastpath.db, "INSERT_BATCH_MAX_ROWS", 2)
+    msm = loadj("web_connectivity_null2")
+    exe = fastpath.db.click_client.execute
+    core.process_measurement((None, msm, "bogus_uid_1"))
+    assert exe.call_count == 0
+    core.process_measurement((None, msm, "bogus_uid_2"))
+    assert exe.call_count == 1
+
+    core.process_measurement((None, msm, "bogus_uid_3"))
+    monkeypatch.setattr(fastpath.db, "INSERT_BATCH_MAX_AGE_S", 0)
+    fastpath.db.flush_inserts_if_needed()
+    assert exe.call_count == 2
+    query, qparams = exe.call_args[0]
+    assert [r["measurement_uid"] for r in qparams] == ["bogus_uid_3"]
+
+
+def test_buffered_inserts_drop_only_bad_rows(monkeypatch):
+    msm = loadj("web_connectivity_null2")
+    for n in range(5):
+        core.process_measurement((None, msm, f"bogus_uid_{n}"))
+
+    inserted = []
+
+    def execute(sql, rows, settings=None):
+        if any(r["measurement_uid"] == "bogus_uid_3" for r in rows):
+            raise ValueError("cannot serialize")
+        inserted.extend(r["measurement_uid"] for r in rows)
+
+    exe = fastpath.db.click_client.execute
+    exe.side_effect = execute
+    incr = Mock()
+    monkeypatch.setattr(fastpath.db.metrics, "incr", incr)
+    fastpath.db.flush_inserts()
+
+    assert sorted(inserted) == [f"bogus_uid_{n}" for n in (0, 1, 2, 4)]
+    incr.assert_called_once_with("dropped_rows")
+
+
+def test_no_write_to_db():
+    core.conf.no_write_to_db = True
+    try:
+        core.process_measurement((None, loadj("web_connectivity_null2"), "bogus_uid"))
+    finally:
+        core.conf.no_write_to_db = False
+    fastpath.db.flush_inserts()
+    assert fastpath.db.click_client.execute.call_count == 0
+
+
+def _fetch_test_fingerprints():
+    return loadj("fingerprints_dns"), loadj("fingerprints_http")
+
+
+def test_publish_fingerprints(monkeypatch):
+    import multiprocessing as mp
+
+    monkeypatch.setattr(core, "fingerprints", core.fingerprints)  # restored later
+    monkeypatch.setattr(fastpath.db, "fetch_fingerprints", _fetch_test_fingerprints)
+    monkeypatch.setattr(fastpath.db, "setup_clickhouse", lambda conf: None)
+    closed = []
+    monkeypatch.setattr(fastpath.db, "close_clickhouse", lambda: closed.append(1))
+    core.setup_fingerprints_snapshot()
+    assert core.fingerprints_snapshot.version == 1
+    assert closed == [1]  # not inherited by the workers
+    assert len(core.fingerprints["http"]) > 1000
+
+    def worker(go, out):
+        # the fingerprints are inherited on fork, no reload needed
+        assert core.fingerprints_snapshot.load_if_changed() is None
+        go.wait()
+        core.load_published_fingerprints()
+        out.put(len(core.fingerprints["dns"]))
+
+    go = mp.Event()
+    out = mp.Queue()
+    p = mp.Process(target=worker, args=(go, out))
+    p.start()
+    # publish an update with a single DNS fingerprint
+    dns_fp = loadj("fingerprints_dns")[:1]
+    monkeypatch.setattr(fastpath.db, "fetch_fingerprints", lambda: (dns_fp, []))
+    core.publish_fingerprints()
+    assert core.fingerprints_snapshot.version == 2
+    go.set()
+    assert out.get(timeout=10) == 1
+    p.join()
+    assert p.exitcode == 0
+
+
+@pytest.mark.skipif(fastpath.lazyjson.simdjson is None, reason="needs simdjson")
+def test_lazy_parsing_scores():
+    # Scoring with the test_keys fields declared by the scorers gives the
+    # same results as scoring the fully decoded measurement
+    from pathlib import Path
+
+    n = 0
+    for f in sorted(Path("fastpath/tests/data").glob("*.json")):
+        raw = f.read_bytes()
+        msm = ujson.loads(raw)
+        if not isinstance(msm, dict) or msm.get("test_name") not in core.scorers:
+            continue
+        lazy, load_test_keys = fastpath.lazyjson.load_envelope(raw)
+        load_test_keys(core.scorers[msm["test_name"]].test_keys)
+        assert core.score_measurement(lazy) == core.score_measurement(msm), f
+        n += 1
+    assert n > 20
+
+
+def test_lazy_parsing(monkeypatch):
+    raw = ujson.dumps(dict(report_id="r", test_keys=dict(a=[1], b=2, c=None)))
+    for simdjson in (fastpath.lazyjson.simdjson, None):
+        monkeypatch.setattr(fastpath.lazyjson, "simdjson", simdjson)
+        msm, load_test_keys = fastpath.lazyjson.load_envelope(raw)
+        assert msm["report_id"] == "r"
+        load_test_keys(("a", "c", "missing"))
+        if simdjson:
+            assert msm["test_keys"] == dict(a=[1], c=None)
+        else:
+            assert msm["test_keys"] == dict(a=[1], b=2, c=None)
+
+        msm, load_test_keys = fastpath.lazyjson.load_envelope(raw)
+        load_test_keys(None)
+        assert msm == ujson.loads(raw)
+
+        # wrapped post
+        post = ujson.dumps(dict(format="json", content=ujson.loads(raw)))
+        msm, load_test_keys = fastpath.lazyjson.load_envelope(post)
+        load_test_keys(None)
+        if simdjson is None:
+            msm = core.unwrap_msmt(msm)  # as done by process_measurement
+        assert msm == ujson.loads(raw)
+
+
+def test_profile_process_measurement(monkeypatch):
+    from fastpath.profiler import profiler
+
+    monkeypatch.setattr(profiler, "enabled", True)
+    monkeypatch.setattr(profiler, "stats", {})
+    msm = loadj("web_connectivity_null2")
+    core.process_measurement((ujson.dumps(msm), None, "bogus_uid"))
+    fastpath.db.flush_inserts()
+    stages = sorted("/".join(k) for k in profiler.stats)
+    assert stages == [
+        "-/db_flush",
+        "web_connectivity/process_measurement",
+        "web_connectivity/process_measurement/db_insert",
+        "web_connectivity/process_measurement/parse",
+        "web_connectivity/process_measurement/parse_test_keys",
+        "web_connectivity/process_measurement/score",
+        "web_connectivity/process_measurement/score/match_fingerprints",
+    ]
+
+
+# # S3 backfill
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    """Fake S3 with 2 days of 3 cans, each holding 4 measurements.
+    Returns a queue receiving the uids of processed measurements
+    """
+    import multiprocessing as mp
+    from pathlib import Path
+
+    def list_cans_by_day(s3, conf, start_day, stop_day):
+        day = start_day
+        while day < stop_day:
+            yield day, [(f"raw/{day}_{n}.tar.gz", 1) for n in range(3)]
+            day += datetime.timedelta(days=1)
+
+    def fetch_cans(s3, conf, files):
+        for fn, size in files:
+            yield Path(fn)
+
+    def load_multiple(fn, fileobj=None, flt=None, ycache=None, size=None):
+        for n in range(4):
+            yield (None, {}, f"{fn}_{n}")
+
+    processed = mp.Queue()
+    s3f = core.s3feeder
+    monkeypatch.setattr(s3f, "create_s3_client", lambda: None)
+    monkeypatch.setattr(s3f, "list_cans_by_day", list_cans_by_day)
+    monkeypatch.setattr(s3f, "fetch_cans", fetch_cans)
+    monkeypatch.setattr(s3f, "load_multiple", load_multiple)
+    monkeypatch.setattr(s3f, "discard_can", lambda conf, can_f: None)
+    monkeypatch.setattr(fastpath.db, "setup_clickhouse", lambda conf: None)
+    monkeypatch.setattr(core, "start_fingerprints_publisher", lambda: None)
+    monkeypatch.setattr(core, "fingerprints", core.fingerprints)
+    monkeypatch.setattr(fastpath.db, "fetch_fingerprints", _fetch_test_fingerprints)
+    monkeypatch.setattr(core, "process_measurement", lambda t: processed.put(t[2]))
+    monkeypatch.setattr(core.conf, "start_day", datetime.date(2021, 1, 1), False)
+    monkeypatch.setattr(core.conf, "end_day", datetime.date(2021, 1, 3), False)
+    monkeypatch.setattr(core.conf, "s3_workers", 3, False)
+    monkeypatch.setattr(core.conf, "stop_after", None, False)
+    monkeypatch.setattr(core.conf, "s3_stream", False, False)
+    monkeypatch.setattr(core.conf, "ccs", None, False)
+    monkeypatch.setattr(core.conf, "testnames", None, False)
+    monkeypatch.setattr(core.conf, "yaml_cache", False, False)
+    return processed
+
+
+def _drain(q) -> list:
+    out = []
+    while not q.empty():
+        out.append(q.get(timeout=1))
+    return out
+
+
+def test_process_measurements_from_s3_parallel(fake_s3):
+    core.process_measurements_from_s3_parallel()
+    uids = _drain(fake_s3)
+    assert len(uids) == 2 * 3 * 4
+    assert len(set(uids)) == len(uids)
+    assert "raw/2021-01-02_2.tar.gz_3" in uids
+
+
+def test_process_measurements_from_s3_parallel_stop_after(fake_s3):
+    core.conf.stop_after = 5
+    core.process_measurements_from_s3_parallel()
+    assert len(_drain(fake_s3)) == 5
+
+
+def test_process_measurements_from_s3_parallel_worker_died(fake_s3, monkeypatch):
+    import os
+
+    def process_measurement(t):
+        if t[2] == "raw/2021-01-02_1.tar.gz_2":
+            os._exit(9)  # as if killed by the OOM killer
+        fake_s3.put(t[2])
+
+    monkeypatch.setattr(core, "process_measurement", process_measurement)
+    monkeypatch.setattr(core, "S3_WORKER_CHECK_INTERVAL_S", 0.1)
+    with pytest.raises(RuntimeError, match="S3 workers died"):
+        core.process_measurements_from_s3_parallel()
+    assert len(_drain(fake_s3)) < 2 * 3 * 4
+
+
 # # observations
 
 
+@pytest.fixture
+def fake_reprocessor(tmp_path, monkeypatch):
+    """Runs the reprocessor on fake cans. Returns a function running it with
+    the given number of workers and returning the uploaded jsonl files and
+    the jsonl table rows"""
+    import lz4.frame
+    import fastpath.reprocessor as rp
+    import fastpath.s3feeder as s3f
+
+    def msmt(n, cc, tn):
+        return dict(
+            report_id=f"r{n % 7}",
+            test_name=tn,
+            input=f"https://example{n}.org/",
+            probe_cc=cc,
+            probe_asn="AS1",
+            measurement_start_time="2020-01-01 00:00:00",
+            test_keys={"n": n, "pad": "x" * 200},
+        )
+
+    cans = []
+    for c in range(6):
+        lines = []
+        for n in range(c * 100, c * 100 + 100):
+            cc = ("IT", "DE", "ZZ", "US")[n % 4]
+            tn = ("web_connectivity", "telegram")[n % 3 == 0]
+            lines.append(json.dumps(msmt(n, cc, tn)))
+        lines.append(lines[5])  # duplicate
+        lines.append(json.dumps(msmt(1, "IT", "web_connectivity")))  # across cans
+        lines.append(json.dumps(dict(test_name=None)))  # broken
+        # YAML entries with the same uid under different report headers
+        lines.append(json.dumps(msmt(-1, ("DE", "IT")[c % 2], "telegram")))
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tf:
+            data = "\n".join(lines).encode()
+            ti = tarfile.TarInfo(f"2020-01-01/can{c}.json")
+            ti.size = len(data)
+            tf.addfile(ti, io.BytesIO(data))
+        can = f"canned/2020-01-01/web_connectivity.{c}.tar.lz4"
+        (tmp_path / "s3" / can).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / "s3" / can).write_bytes(lz4.frame.compress(buf.getvalue()))
+        cans.append((can, (tmp_path / "s3" / can).stat().st_size))
+
+    class S3:
+        def download_file(self, bucket, key, dest):
+            Path(dest).write_bytes((tmp_path / "s3" / key).read_bytes())
+
+    def upload_to_s3(s3, bucket_name, tarf, s3path):
+        out = tmp_path / "out" / s3path
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_bytes(gzip.decompress(tarf.read_bytes()))
+
+    rows_lock = threading.Lock()  # called by the upload threads
+
+    def update_jsonl_table(conn, lookup_list, jsonl_mode):
+        with rows_lock, (tmp_path / "out" / "rows").open("a") as f:
+            for row in lookup_list:
+                f.write(json.dumps(row, default=str) + "\n")
+
+    load_multiple = s3f.load_multiple
+
+    def load_multiple_same_uid(*a):
+        for msm_jstr, msm, uid in load_multiple(*a):
+            if msm.get("input") == "https://example-1.org/":
+                uid = "same_uid"
+            yield msm_jstr, msm, uid
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(s3f, "load_multiple", load_multiple_same_uid)
+    monkeypatch.setattr(s3f, "create_s3_client", lambda: S3())
+    monkeypatch.setattr(s3f, "list_cans_on_s3_for_a_day", lambda s3, day: cans)
+    monkeypatch.setattr(rp, "create_s3_client", lambda conf: None)
+    monkeypatch.setattr(rp, "update_fingerprints_if_needed", lambda: None)
+    monkeypatch.setattr(rp, "upload_to_s3", upload_to_s3)
+    monkeypatch.setattr(rp, "update_jsonl_clickhouse_table", update_jsonl_table)
+    monkeypatch.setattr(rp, "JSONL_THRESHOLD", 20_000)
+
+    def run(workers: int, *args: str):
+        argv = ["reprocessor", "src", "dst", "--day", "2020-01-01", "--s3mode"]
+        argv += ["create", "--jsonlmode", "insert", "--workers", str(workers)]
+        argv += args
+        monkeypatch.setattr(sys, "argv", argv)
+        monkeypatch.setattr(rp, "stats", dict(rp.stats, dedup_duplicates=0))
+        rp.main()
+        out = tmp_path / "out"
+        files = {
+            f.relative_to(out).as_posix(): f.read_bytes()
+            for f in out.rglob("*.jsonl.gz")
+        }
+        rows = sorted((out / "rows").read_text().splitlines())
+        assert not list(tmp_path.glob("*.jsonl.gz"))
+        assert not list(tmp_path.glob("canned/*/*"))
+        assert not list(tmp_path.glob("reprocessor_*"))
+        shutil.rmtree(out)
+        return files, rows, rp.stats["dedup_duplicates"]
+
+    return run
+
+
+def test_reprocessor_parallel_deterministic(fake_reprocessor):
+    serial = fake_reprocessor(1)
+    files, rows, dups = serial
+    assert len(files) > 6  # multiple jsonl files for some cc/testname
+    assert not any("/ZZ/" in fn for fn in files)
+    assert len(rows) == 452  # no ZZ, duplicates and broken msmts
+    assert sum('"same_uid"' in r for r in rows) == 1
+    assert dups > 0
+    assert fake_reprocessor(3) == serial
+
+
+def test_reprocessor_pipeline_deterministic(fake_reprocessor):
+    inline = fake_reprocessor(1, "--upload-workers", "0", "--prefetch", "1")
+    assert len(inline[1]) == 452
+    assert fake_reprocessor(1, "--upload-workers", "8", "--prefetch", "4") == inline
+    assert fake_reprocessor(2, "--upload-workers", "3") == inline
+
+
+def test_reprocessor_cleanup_on_error(fake_reprocessor, tmp_path, monkeypatch):
+    import time
+    import fastpath.reprocessor as rp
+
+    def process_measurement(*a):
+        time.sleep(0.3)  # let the downloader fill the queue
+        raise RuntimeError("processing failed")
+
+    monkeypatch.setattr(rp, "process_measurement", process_measurement)
+    with pytest.raises(RuntimeError, match="processing failed"):
+        fake_reprocessor(1, "--prefetch", "4")
+    assert not list(tmp_path.glob("canned/*/*"))
+
+
 def test_score_openvpn():
     msm = loadj("openvpn")
     msm_tup = (None, msm, "bogus_uid")
     core.process_measurement(msm_tup)
+    fastpath.db.flush_inserts()
 
     exe = fastpath.db.click_client.execute
     assert exe.call_count == 2
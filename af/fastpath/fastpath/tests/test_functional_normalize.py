@@ -307,3 +307,24 @@ def benchmark_simhash(benchmark):
     # debdeps: python3-pytest-benchmark
     for x in range(400):
         norm.gen_simhash(str(x))
+
+
+def _bodies():
+    p = Path("fastpath/tests/data")
+    return [f.read_text() for f in sorted(p.glob("*.json"))] * 5
+
+
+def benchmark_simhash_bodies_python(benchmark):
+    bodies = _bodies()
+    benchmark(lambda: [norm._gen_simhash_py(b) for b in bodies])
+
+
+def benchmark_simhash_bodies(benchmark):
+    bodies = _bodies()
+    benchmark(lambda: [norm.gen_simhash(b) for b in bodies])
+
+
+def benchmark_simhash_bodies_bulk(benchmark):
+    bodies = _bodies()
+    assert norm.gen_simhashes(bodies) == [norm._gen_simhash_py(b) for b in bodies]
+    benchmark(norm.gen_simhashes, bodies)
@@ -4,6 +4,14 @@
 
 from pathlib import Path
 from datetime import date
+from unittest.mock import patch
+import io
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import queue
+import time
 
 import pytest
 import json
@@ -14,6 +22,9 @@ import fastpath.core as fp
 import fastpath.core as core
 import fastpath.s3feeder as s3feeder
 from fastpath.normalize import iter_yaml_msmt_normalized
+from fastpath.portable_queue import RingQueue
+
+log = logging.getLogger()
 
 
 scores_failed = {
@@ -147,6 +158,52 @@ def test_match_dns_fingerprints_match_country(fprints):
     ]
 
 
+def _match_dns_loop(msm):
+    # Reference implementation: scan all DNS fingerprints for each answer
+    matches = []
+    for q in fp.g_or(msm["test_keys"], "queries", ()):
+        for answer in fp.g_or(q, "answers", ()):
+            for f in fp.fingerprints["dns"]:
+                addr = ""
+                if "ipv4" in answer:
+                    addr = answer["ipv4"]
+                elif "hostname" in answer:
+                    addr = answer["hostname"]
+                elif "ipv6" in answer:
+                    addr = answer["ipv6"]
+                if addr == f["pattern"]:
+                    matches.append(f)
+    return matches
+
+
+def test_match_dns_fingerprints_index(fprints):
+    answers = [{"answer_type": "A", "ipv4": f["pattern"]} for f in fp.fingerprints["dns"]]
+    answers += [
+        {"answer_type": "CNAME", "hostname": f["pattern"]} for f in fp.fingerprints["dns"][::7]
+    ]
+    answers += [
+        {"answer_type": "AAAA", "ipv6": "::1"},
+        {"answer_type": "A", "ipv4": "127.0.0.1"},
+        {"answer_type": "A"},
+    ]
+    msm = {"probe_cc": "IT", "test_keys": {"queries": [{"answers": answers}, {"answers": None}]}}
+    matches = fp.match_fingerprints(msm)
+    assert len(matches) >= len(answers) - 3
+    assert matches == _match_dns_loop(msm)
+
+    msm = loadj("web_connectivity_ir_fp")
+    assert fp.match_fingerprints(msm) == _match_dns_loop(msm)
+
+
+def test_build_dns_index():
+    fps = [
+        dict(name="a", pattern="1.1.1.1"),
+        dict(name="b", pattern="2.2.2.2"),
+        dict(name="c", pattern="1.1.1.1"),
+    ]
+    assert fp.build_dns_index(fps) == {"1.1.1.1": [fps[0], fps[2]], "2.2.2.2": [fps[1]]}
+
+
 def test_match_fingerprints_dict_body(fprints):
     # from 20200108T054856Z-web_connectivity-20200109T102441Z_AS42610_613KNyjuQqiuloY1a391dhZccSDz9M1MD30P6EpUIWSByjcq4T-AS42610-RU-probe-0.2.0.json
     msm = {
@@ -167,6 +224,149 @@ def test_match_fingerprints_dict_body(fprints):
     assert fp.match_fingerprints(msm) == []
 
 
+def _match_body_loop(body, http_fps):
+    # Reference implementation: one find() for each fingerprint
+    out = []
+    for fp in http_fps:
+        if fp["location_found"] != "body":
+            continue
+        bm = fp["pattern"]
+        idx = body.find(bm.encode()) if isinstance(body, bytes) else body.find(bm)
+        if idx != -1:
+            out.append((fp, idx))
+    return out
+
+
+def _body_fp(name, pattern):
+    return dict(name=name, location_found="body", pattern=pattern)
+
+
+body_fps = [
+    _body_fp("a", "Access denied"),
+    _body_fp("b", "denied"),
+    _body_fp("c", "Доступ ограничен"),
+    _body_fp("d", "denied"),
+    _body_fp("e", ""),
+    _body_fp("f", "nomatch"),
+    dict(name="h", location_found="header.location", pattern="denied"),
+]
+bodies = [
+    "",
+    "Access denied ... denied",
+    "<p>Доступ ограничен</p> Access denied",
+    "Доступ ограничен".encode() + b"\xff Access denied",
+    b"\x00\xffdenied",
+]
+
+
+@pytest.mark.parametrize("body", bodies)
+def test_body_matcher(body):
+    bm = fp.BodyMatcher(body_fps)
+    assert bm.find_all(body) == _match_body_loop(body, body_fps)
+
+
+@pytest.mark.parametrize("body", bodies)
+def test_body_matcher_no_ahocorasick(body, monkeypatch):
+    monkeypatch.setattr(fp, "ahocorasick", None)
+    bm = fp.BodyMatcher(body_fps)
+    assert bm.find_all(body) == _match_body_loop(body, body_fps)
+
+
+def test_body_matcher_real_fingerprints(fprints):
+    http_fps = fp.fingerprints["http"]
+    bm = fp.fingerprints["http_body"]
+    for f in http_fps:
+        if f["location_found"] == "body" and f["pattern"]:
+            body = "xx " + f["pattern"] + " yy"
+            assert bm.find_all(body) == _match_body_loop(body, http_fps)
+            body = body.encode()
+            assert bm.find_all(body) == _match_body_loop(body, http_fps)
+
+
+def _hdr_fp(name, hname, pattern_type, pattern):
+    return dict(
+        name=name,
+        scope="isp",
+        location_found=f"header.{hname}",
+        pattern_type=pattern_type,
+        pattern=pattern,
+        confidence_no_fp=5,
+        expected_countries=[],
+    )
+
+
+def test_header_matcher():
+    fps = [
+        _hdr_fp("a", "location", "prefix", "http://blocked.example/"),
+        _hdr_fp("b", "server", "full", "BlockServer"),
+        _hdr_fp("c", "location", "prefix", "http://blocked"),
+        _hdr_fp("d", "location", "full", "http://blocked.example/"),
+        _hdr_fp("e", "location", "contains", "blocked"),
+        _body_fp("f", "blocked"),
+        _hdr_fp("g", "server", "prefix", "Block"),
+    ]
+    hm = fp.HeaderMatcher(fps)
+    assert hm.find_all({}) == []
+    assert hm.find_all({"server": "Apache"}) == []
+    headers = {"server": "BlockServer", "location": "http://blocked.example/"}
+    assert hm.find_all(headers) == [fps[0], fps[1], fps[2], fps[3], fps[6]]
+    # base64 values are decoded only for prefix matching
+    b64 = {"format": "base64", "data": "aHR0cDovL2Jsb2NrZWQuZXhhbXBsZS8="}
+    assert hm.find_all({"location": b64}) == [fps[0], fps[2]]
+    assert hm.find_all({"location": None, "server": ["BlockServer"]}) == []
+
+
+def test_match_http_headers_fingerprints(fprints):
+    resp = {"headers": {"Location": "https://internet.mts.by/blocked/foo"}}
+    matches = []
+    fp.match_http_fingerprints(resp, matches)
+    assert [m["name"] for m in matches] == ["ooni.by_2"]
+
+
+def test_match_http_fingerprints_cache(fprints, monkeypatch):
+    resp = {
+        "body": "foo ... Makluman/Notification ... foo",
+        "headers": {"Location": "https://internet.mts.by/blocked/foo", "Date": "x"},
+    }
+    fp.match_cache.check_fingerprints(None)  # empty cache
+    expected = []
+    fp.match_http_fingerprints(resp, expected)
+    assert [m["name"] for m in expected] == ["ooni.my_0", "ooni.by_2"]
+    assert len(fp.match_cache) == 1
+
+    for hits in range(3):
+        matches = []
+        fp.match_http_fingerprints(resp, matches)
+        assert matches == expected
+        assert len(fp.match_cache) == 1
+
+    # Headers without fingerprints are not part of the key
+    resp["headers"]["Date"] = "y"
+    fp.match_http_fingerprints(resp, [])
+    assert len(fp.match_cache) == 1
+    resp["headers"]["Location"] = "http://example.com"
+    fp.match_http_fingerprints(resp, [])
+    assert len(fp.match_cache) == 2
+
+    # New fingerprints invalidate the cache
+    monkeypatch.setattr(fp, "fingerprints", fp.prepare_fingerprints([], []))
+    matches = []
+    fp.match_http_fingerprints(resp, matches)
+    assert matches == []
+    assert len(fp.match_cache) == 1
+
+
+def test_match_cache_lru():
+    c = fp.MatchCache(2)
+    c.put(b"a", 1)
+    c.put(b"b", 2)
+    assert c.get(b"a") == 1
+    c.put(b"c", 3)
+    assert c.get(b"b") is None
+    assert c.get(b"a") == 1
+    assert c.get(b"c") == 3
+
+
 def test_match_fingerprints_b64_hdr(fprints):
     msm = loadj("web_connectivity_b64_hdr.json")
     assert fp.match_fingerprints(msm) == []
@@ -230,6 +430,207 @@ def test_yaml_normalization_binary_city():
     json.dumps(msm)  # should not raise
 
 
+def _multi_entry_yaml(n):
+    # Report where only some entries have their own test_start_time
+    header = b"---\nprobe_cc: IT\nprobe_asn: AS1\ntest_name: dns_consistency\n"
+    header += b"start_time: 1441319842.0\ntest_start_time: 1441319850.0\n...\n"
+    out = [header]
+    for i in range(n):
+        tst = b"test_start_time: 1441319900.0\n" if i == n // 2 else b""
+        out.append(b"---\ninput: example%d.org\n%s...\n" % (i, tst))
+        if i == 3:
+            out.append(b"---\nnull\n...\n")
+    return io.BytesIO(b"".join(out))
+
+
+def test_yaml_normalization_pool():
+    rfn = "2015-09-03/bogus_fname.yaml"
+    fd = _multi_entry_yaml(40)
+    expected = tuple(iter_yaml_msmt_normalized(fd, "2015-09-03", rfn))
+    assert len(expected) == 40
+    mst = [msm["measurement_start_time"][-2:] for msm in expected]
+    assert (mst[0], mst[20], mst[-1]) == ("30", "20", "22")
+    with patch("fastpath.normalize.YAML_BATCH_SIZE", 7), mp.Pool(3) as pool:
+        for fn in ("binary_city", "dns_n_http_bin_body", "http_invalid_request_line"):
+            serial = tuple(iter_yaml_msmt_normalized(load_yaml(fn), "2015-11-05", rfn))
+            par = iter_yaml_msmt_normalized(load_yaml(fn), "2015-11-05", rfn, pool)
+            assert tuple(par) == serial
+
+        fd = _multi_entry_yaml(40)
+        par = tuple(iter_yaml_msmt_normalized(fd, "2015-09-03", rfn, pool))
+        assert par == expected
+
+
+def test_yaml_pool_created_lazily(tmp_path, monkeypatch):
+    import fastpath.normalize as normalize
+
+    monkeypatch.setattr(normalize, "yaml_workers", 2)
+    monkeypatch.setattr(normalize, "_yaml_pool", None)
+    msm = json.dumps(dict(test_name="web_connectivity", report_id="r", input="i"))
+    can = tmp_path / "2020-01-01/web_connectivity.0.tar.lz4"
+    _write_tar(can, {"a.json": msm.encode()}, "lz4")
+    assert len(list(s3feeder.load_multiple(can.as_posix()))) == 1
+    assert normalize._yaml_pool is None  # no YAML: no pool
+
+    can = tmp_path / "2015-09-03/dns_consistency.0.tar.lz4"
+    _write_tar(can, {"r.yaml": _multi_entry_yaml(10).read()}, "lz4")
+    assert len(list(s3feeder.load_multiple(can.as_posix()))) == 10
+    pool = normalize._yaml_pool
+    assert pool is not None
+    assert normalize._pool_size(pool) == 2
+    pool.terminate()
+
+
+def _reference_simhash(s):
+    # gen_simhash before vectorization
+    import hashlib
+    import re
+    from itertools import groupby
+
+    content = s.lower()
+    content = "".join(re.findall(r"[\w\u4e00-\u9fcc]+", content))
+    mx = max(len(content) - 4 + 1, 1)
+    features = [content[i : i + 4] for i in range(mx)]
+    features = ((k, sum(1 for _ in g)) for k, g in groupby(sorted(features)))
+    v = [0] * 64
+    masks = [1 << i for i in range(64)]
+    for h, w in features:
+        h = h.encode("utf-8")
+        h = int(hashlib.md5(h).hexdigest(), 16)
+        for i in range(64):
+            v[i] += w if h & masks[i] else -w
+    ans = 0
+    for i in range(64):
+        if v[i] > 0:
+            ans |= masks[i]
+    return ans
+
+
+def _simhash_corpus():
+    import random
+
+    rnd = random.Random(3)
+    alphabet = "abcde ABC<>/=\"0123456789_\u4e00\u4e8c\u00e9\u0416\n"
+    corpus = ["", "a", "abc", "abcd", "hello", "aaaaaaaa", "\u4e00\u4e8c\u4e09\u56db"]
+    corpus.append("".join(str(x) for x in range(1000)))
+    corpus.extend(str(x) for x in range(50))
+    for n in range(100):
+        size = rnd.choice((3, 10, 100, 1000, 5000))
+        corpus.append("".join(rnd.choice(alphabet) for _ in range(size)))
+    for fn in ("report1.json", "meek.json", "tor.json", "http_requests_1.json"):
+        corpus.append((Path("fastpath/tests/data") / fn).read_text())
+    return corpus
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_simhash_bit_identical(use_numpy):
+    import fastpath.normalize as norm
+
+    if use_numpy and norm.np is None:
+        pytest.skip("NumPy not available")
+    corpus = _simhash_corpus()
+    expected = [_reference_simhash(s) for s in corpus]
+    with patch("fastpath.normalize.np", norm.np if use_numpy else None):
+        assert [norm.gen_simhash(s) for s in corpus] == expected
+        assert norm.gen_simhashes(corpus) == expected
+        assert norm.gen_simhashes([]) == []
+    assert norm.gen_simhash("") == 16_825_458_760_271_544_958
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"---\na: 1\n...\n",
+        b"---\na: 1\n...\n...\n# comment\n---\nb: 2\n...\n",
+        b"---\na: 1\n...\n---\nb: 2\n",  # truncated
+        b"---\na: 1\n...\n--",  # truncated
+        b"---\na: 1\n...\n# comment",  # truncated
+        b"---\na: 1\n...\nbroken\n---\nb: 2\n...\n",
+        b"".join(b"---\nk: %d\n...\n" % n for n in range(200000)),  # > 1 MiB
+    ],
+    ids=lambda d: f"{len(d)}B",
+)
+def test_slice_yaml_blobs(data):
+    import fastpath.normalize as norm
+
+    # stream_yaml_blobs offsets are wrong after the first 1 MiB
+    expected = [blob for off, blob in norm.stream_yaml_blobs(io.BytesIO(data))]
+    sliced = [(off, bytes(mv)) for off, mv in norm.slice_yaml_blobs(data)]
+    assert len(sliced) == len(expected)
+    assert [blob for off, blob in sliced] == expected
+    assert all(data[off : off + len(blob)] == blob for off, blob in sliced)
+
+
+def test_map_yaml_report(tmp_path):
+    import lz4.frame
+    import fastpath.normalize as norm
+
+    rfn = "2015-09-03/bogus_fname.yaml"
+    data = load_yaml("dns_n_http_bin_body").read()
+    expected = tuple(iter_yaml_msmt_normalized(data, "2015-09-03", rfn))
+    assert len(expected) == 1
+    with load_yaml("dns_n_http_bin_body") as f:
+        with norm.map_yaml_report(f) as (buf, base):
+            assert isinstance(buf, mmap.mmap)
+            assert buf[:] == data
+    for f in (io.BytesIO(data), load_yaml("dns_n_http_bin_body")):
+        assert tuple(iter_yaml_msmt_normalized(f, "2015-09-03", rfn)) == expected
+
+    can = tmp_path / "r.yaml.lz4"
+    can.write_bytes(lz4.frame.compress(data))
+    with lz4.frame.open(can) as f:
+        assert tuple(iter_yaml_msmt_normalized(f, "2015-09-03", rfn)) == expected
+
+
+def test_scorers_registry():
+    assert sorted(fp.scorers) == [
+        "dash",
+        "dns_consistency",
+        "facebook_messenger",
+        "http_header_field_manipulation",
+        "http_invalid_request_line",
+        "http_requests",
+        "meek_fronted_requests_test",
+        "ndt",
+        "openvpn",
+        "psiphon",
+        "riseupvpn",
+        "signal",
+        "stunreachability",
+        "tcp_connect",
+        "telegram",
+        "tor",
+        "torsf",
+        "vanilla_tor",
+        "web_connectivity",
+        "whatsapp",
+    ]
+    assert fp.scorers["ndt"].test_keys == ()
+    assert fp.scorers["web_connectivity"].test_keys is None
+    # Metric names used before the registry
+    assert fp.scorers["telegram"].metric == "score_measurement_telegram"
+    assert fp.scorers["vanilla_tor"].metric == "score_vanilla_tor"
+    assert fp.scorers["web_connectivity"].metric == "score_web_connectivity"
+
+
+def test_register_scorer(monkeypatch):
+    monkeypatch.setattr(fp, "scorers", {})
+
+    @fp.register_scorer("foo", test_keys=("bar",))
+    def score_foo(msm):
+        return {"foo": msm["test_keys"]["bar"]}
+
+    assert fp.scorers["foo"].test_keys == ("bar",)
+    msm = {"test_name": "foo", "test_keys": {"bar": 1}}
+    assert fp.score_measurement(msm) == {"foo": 1}
+    with pytest.raises(AssertionError):
+        fp.register_scorer("foo")(score_foo)
+
+    scores = fp.score_measurement({"test_name": "unknown"})
+    assert scores["accuracy"] == 0.0
+
+
 # Follow the order in score_measurement
 
 # # test_name: telegram
@@ -748,6 +1149,313 @@ def test_s3feeder_eta():
     assert etr / 3600 == 1.0
 
 
+class FakeS3:
+    """Records concurrent downloads"""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.lock = mp.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.max_on_disk = 0
+
+    def download_fileobj(self, bucket, s3fname, f, Callback):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        size = int(s3fname.rsplit("_", 1)[1])
+        f.write(b"x" * size)
+        Callback(size)
+        with self.lock:
+            self.active -= 1
+            on_disk = 0
+            for p in self.conf.s3cachedir.rglob("can*"):
+                if p.name == "can3_100":
+                    continue
+                try:
+                    on_disk += p.stat().st_size
+                except FileNotFoundError:
+                    pass  # renamed by another download thread
+            self.max_on_disk = max(self.max_on_disk, on_disk)
+
+
+def test_s3feeder_fetch_cans_prefetch(tmp_path):
+    from types import SimpleNamespace
+
+    conf = SimpleNamespace(s3cachedir=tmp_path, s3_cache_quota=10**6)
+    s3 = FakeS3(conf)
+    files = [(f"raw/2021/can{n}_100", 100) for n in range(10)]
+    # can3 is already in the local cache
+    (tmp_path / "2021").mkdir()
+    (tmp_path / "2021/can3_100").write_bytes(b"x" * 100)
+    out = []
+    for can_f in s3feeder.fetch_cans(s3, conf, files, prefetch=3, disk_budget=250):
+        out.append(can_f.name)
+        can_f.unlink()  # consume the can as stream_cans does
+    assert out == [f"can{n}_100" for n in range(10)]
+    assert s3.max_active == 2  # limited by the disk budget
+    assert s3.max_on_disk <= 250
+
+    # a can larger than the budget is still downloaded
+    files = [("raw/2021/big_500", 500)]
+    out = list(s3feeder.fetch_cans(s3, conf, files, prefetch=3, disk_budget=250))
+    assert out == [tmp_path / "2021/big_500"]
+
+
+def test_s3feeder_stream_cans_order_with_yaml_cache(monkeypatch):
+    from types import SimpleNamespace
+
+    conf = SimpleNamespace(
+        ccs=None, testnames=None, s3_stream=False, s3_prefetch=2,
+        s3_prefetch_budget=1000, keep_s3_cache=True,
+    )
+    files = [(f"canned/2020-01-01/can{n}", 100) for n in (3, 1, 4, 0, 2)]
+    cached = {"canned/2020-01-01/can1", "canned/2020-01-01/can3"}
+    ycache = SimpleNamespace(has=lambda fn, size: fn in cached)
+    fetched = []
+
+    def fetch_cans(s3, conf, files, prefetch, budget):
+        for fn, size in files:
+            fetched.append(fn)
+            yield Path(fn)
+
+    def load_multiple(fn, fileobj, flt, ycache, size=None):
+        yield (None, {}, fn.rsplit("/", 1)[1])
+
+    day = date(2020, 1, 1)
+    monkeypatch.setattr(s3feeder, "create_s3_client", lambda: None)
+    monkeypatch.setattr(s3feeder, "get_yaml_cache", lambda conf: ycache)
+    monkeypatch.setattr(s3feeder, "list_cans_by_day", lambda *a: [(day, files)])
+    monkeypatch.setattr(s3feeder, "fetch_cans", fetch_cans)
+    monkeypatch.setattr(s3feeder, "load_multiple", load_multiple)
+    out = [uid for _, _, uid in s3feeder.stream_cans(conf, day, date(2020, 1, 2))]
+    assert out == [f"can{n}" for n in range(5)]  # same order with or without cache
+    assert fetched == [f"canned/2020-01-01/can{n}" for n in (0, 2, 4)]
+
+
+def test_can_cache(tmp_path):
+    from fastpath.cancache import CanCache
+
+    def mkfile(name, size):
+        f = tmp_path / "2021" / name
+        f.parent.mkdir(exist_ok=True)
+        f.write_bytes(b"x" * size)
+        return f
+
+    # files cached before the index existed are imported
+    old = mkfile("old", 100)
+    cache = CanCache(tmp_path, quota=300)
+    assert cache.total_size() == 100
+    assert cache.lookup(old, 100)
+    assert not cache.lookup(old, 99)  # size mismatch
+    assert not cache.lookup(tmp_path / "2021/missing", 100)
+    assert cache.total_size() == 0
+
+    cans = [mkfile(f"can{n}", 100) for n in range(4)]
+    for f in cans[:3]:
+        cache.add(f, 100)
+    assert cache.lookup(cans[0], 100)  # can1 is now the least recently used
+    assert (cache.hits, cache.misses) == (2, 2)
+    cache.add(cans[3], 100)
+    assert not cans[1].exists()
+    assert [f.exists() for f in cans] == [True, False, True, True]
+    assert cache.total_size() == 300
+
+    # the index is shared with other processes
+    cache2 = CanCache(tmp_path, quota=100)
+    assert cache2.total_size() == 300
+    assert cache2.evict() == 200
+    assert cache.total_size() == 100
+    assert cans[3].exists()
+
+
+def test_s3feeder_fetch_cans_pins_queued_cans(tmp_path):
+    from types import SimpleNamespace
+    from fastpath.cancache import get_can_cache
+
+    conf = SimpleNamespace(s3cachedir=tmp_path, s3_cache_quota=200)
+    s3 = FakeS3(conf)
+    files = [(f"raw/2021/can{n}_100", 100) for n in range(8)]
+    # Even cans are cache hits, looked up before any download
+    cache = get_can_cache(tmp_path, 10**6)
+    for n in range(0, 8, 2):
+        f = tmp_path / f"2021/can{n}_100"
+        f.parent.mkdir(exist_ok=True)
+        f.write_bytes(b"x" * 100)
+        cache.add(f, 100)
+
+    out = []
+    for can_f in s3feeder.fetch_cans(s3, conf, files, prefetch=3, disk_budget=250):
+        assert can_f.read_bytes() == b"x" * 100, can_f
+        out.append(can_f.name)
+        # another process pins nothing, but evicts under quota pressure
+        cache.evict()
+    assert out == [f"can{n}_100" for n in range(8)]
+    assert cache.pinned() == set()
+    cache.evict()
+    assert cache.total_size() <= 200
+
+
+def _write_tar(path, members: dict, compress=None):
+    import io
+    import tarfile
+    import lz4.frame
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz" if compress == "gz" else "w") as tf:
+        for name, data in members.items():
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tf.addfile(ti, io.BytesIO(data))
+    data = buf.getvalue()
+    if compress == "lz4":
+        data = lz4.frame.compress(data)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def test_s3feeder_stream_can(tmp_path):
+    from types import SimpleNamespace
+
+    uid = "20210614004521.999962_JO_signal_68eb19b439326d60"
+    post = json.dumps(dict(format="json", content={"test_name": "signal"}))
+    mc = "raw/20210614/00/JO/signal/2021061400_JO_signal.n0.0.tar.gz"
+    _write_tar(tmp_path / "s3" / mc, {f"x/{uid}.post": post.encode()}, "gz")
+    msm = json.dumps(dict(test_name="web_connectivity", report_id="r", input="i"))
+    can = "canned/2020-01-01/web_connectivity.0.tar.lz4"
+    _write_tar(tmp_path / "s3" / can, {"a.json": (msm + "\n" + msm).encode()}, "lz4")
+
+    class S3:
+        def get_object(self, Bucket, Key):
+            return dict(Body=(tmp_path / "s3" / Key).open("rb"))
+
+    conf = SimpleNamespace(
+        s3cachedir=tmp_path / "cache",
+        s3_cache_quota=10**6,
+        ccs=None,
+        testnames=None,
+        yaml_cache=False,
+    )
+    for s3fname in (mc, can):
+        fn = (tmp_path / "s3" / s3fname).as_posix()
+        size = (tmp_path / "s3" / s3fname).stat().st_size
+        streamed = list(s3feeder.stream_can(S3(), conf, s3fname, size))
+        assert streamed == list(s3feeder.load_multiple(fn))
+        assert streamed
+        assert not list(conf.s3cachedir.glob("*/*"))
+
+    assert streamed[0][1]["test_name"] == "web_connectivity"
+
+
+def test_yaml_cache(tmp_path):
+    from fastpath.yamlcache import YamlCache
+    import lz4.frame
+
+    ycache = YamlCache(tmp_path / "yaml")
+    can = tmp_path / "s3/canned/2015-11-05/binary_city.yaml.lz4"
+    can.parent.mkdir(parents=True)
+    can.write_bytes(lz4.frame.compress(load_yaml("dns_n_http_bin_body").read()))
+    size = can.stat().st_size
+    fn = can.as_posix()
+
+    # Filtered loads do not populate the cache
+    flt = s3feeder.MsmtFilter({"IT"}, None)
+    assert list(s3feeder.load_multiple(fn, None, flt, ycache)) == []
+    assert not ycache.has(fn, size)
+
+    expected = list(s3feeder.load_multiple(fn))
+    assert len(expected) == 1
+    assert list(s3feeder.load_multiple(fn, None, None, ycache)) == expected
+    assert ycache.has(fn, size)
+    assert not ycache.has(fn, size + 1)
+    assert [p.name for p in tmp_path.glob("yaml/v1/2015-11-05/*")] == [
+        f"binary_city.yaml.lz4.{size}.jsonl.lz4"
+    ]
+
+    # Loaded from the cache without reading the can
+    can.unlink()
+    cached = list(s3feeder.load_multiple(fn, None, None, ycache, size))
+    assert cached == [tuple(t) for t in json.loads(json.dumps(expected))]
+    flt = s3feeder.MsmtFilter({"TR"}, None)
+    assert list(s3feeder.load_multiple(fn, None, flt, ycache, size)) == cached
+
+    # Legacy cans without YAML reports are not cached
+    msm = json.dumps(dict(test_name="web_connectivity", report_id="r", input="i"))
+    can = tmp_path / "s3/canned/2020-01-01/web_connectivity.0.tar.lz4"
+    _write_tar(can, {"a.json": msm.encode()}, "lz4")
+    assert len(list(s3feeder.load_multiple(can.as_posix(), None, None, ycache))) == 1
+    assert not ycache.has(can.as_posix(), can.stat().st_size)
+    assert not list(tmp_path.glob("yaml/v1/2020-01-01/*"))
+
+
+def test_s3feeder_msmt_filter():
+    flt = s3feeder.MsmtFilter({"IT"}, {"webconnectivity"})
+    assert flt.accept_filename("canned/2019-10-30/web_connectivity.00.tar.lz4", "can")
+    assert not flt.accept_filename("canned/2019-08-29/telegram.0.tar.lz4", "can")
+    fn = "2018-05-07/20180501T071932Z-IT-AS198471-web_connectivity-20180506T090836Z_AS198471_gK-0.2.0-probe.json.lz4"
+    assert flt.accept_filename(fn, "can")
+    assert not flt.accept_filename(fn.replace("-IT-", "-CN-"), "can")
+    assert flt.accept_filename("x/20210614004521.999962_IT_webconnectivity_68e.post", "tar_member")
+    assert not flt.accept_filename("x/20210614004521.999962_JO_signal_68e.post", "tar_member")
+    assert flt.accept_filename("unknown_format", "can")
+    assert flt.accept_raw(b'{"probe_cc": "IT", "test_name": "web_connectivity"}')
+    assert not flt.accept_raw(b'{"probe_cc":"CN","test_name":"web_connectivity"}')
+    assert flt.accept_raw(b"{}")  # unknown: decided after parsing
+    assert not flt.accept_msm({"probe_cc": "IT", "test_name": "telegram"})
+
+    flt = s3feeder.MsmtFilter(None, {"telegram"})
+    assert flt.accept_filename(fn.replace("web_connectivity", "telegram"), "can")
+    assert flt.accept_raw(b'{"probe_cc": "CN", "test_name": "telegram"}')
+
+
+def test_s3feeder_msmt_filter_raw_ambiguous():
+    flt = s3feeder.MsmtFilter({"IT"}, {"webconnectivity"})
+    # test_keys serialized before the top level test_name
+    raw = b'{"test_keys": {"test_name": "x"}, "probe_cc": "IT", '
+    assert flt.accept_raw(raw + b'"test_name": "web_connectivity"}')
+    assert flt.accept_raw(raw + b'"test_name": "telegram"}')  # decided later
+    # invalid UTF-8 does not abort the can
+    assert not flt.accept_raw(b'{"probe_cc": "\xff", "test_name": "telegram"}')
+
+
+def test_s3feeder_msmt_filter_legacy_test_names():
+    # Legacy names are normalized to the requested test_name
+    flt = s3feeder.MsmtFilter(None, {"http_requests"})
+    can = "canned/2016-01-01/http_requests_test.0.tar.lz4"
+    assert flt.accept_filename(can, "can")
+    fn = "2016-01-01/20160101T000000Z-IT-AS3269-http_requests_test-v1-probe.yaml"
+    assert flt.accept_filename(fn, "tar_member")
+    assert flt.accept_raw(b'{"test_name": "http_requests_test"}')
+    assert flt.accept_msm({"test_name": "HTTP Requests Test"})
+    assert not flt.accept_filename("canned/2016-01-01/dnstamper.0.tar.lz4", "can")
+
+    flt = s3feeder.MsmtFilter(None, {"dns_consistency"})
+    assert flt.accept_filename("canned/2014-01-01/dnstamper.0.tar.lz4", "can")
+    fn = "2014-01-01/20140101T000000Z-IT-AS3269-dnstamper-v1-probe.yaml"
+    assert flt.accept_filename(fn, "tar_member")
+    assert not flt.accept_filename("canned/2016-01-01/http_requests_test.0.tar.lz4", "can")
+
+
+def test_s3feeder_load_multiple_filter(tmp_path):
+    def msm(cc, tn):
+        d = dict(probe_cc=cc, test_name=tn, report_id=f"r_{cc}", input="i")
+        return json.dumps(d).encode()
+
+    it = "20180501T071932Z-IT-AS1-web_connectivity-r-0.2.0-probe.json"
+    cn = "20180501T071932Z-CN-AS1-web_connectivity-r-0.2.0-probe.json"
+    members = {
+        it: msm("IT", "web_connectivity") + b"\n" + msm("CN", "web_connectivity"),
+        cn: msm("CN", "web_connectivity"),
+    }
+    can = tmp_path / "2018-05-07/web_connectivity.0.tar.lz4"
+    _write_tar(can, members, "lz4")
+    flt = s3feeder.MsmtFilter({"IT"}, None)
+    out = list(s3feeder.load_multiple(can.as_posix(), flt=flt))
+    assert [m[1]["probe_cc"] for m in out] == ["IT"]
+    assert len(list(s3feeder.load_multiple(can.as_posix()))) == 3
+
+
 @pytest.mark.skip(reason="Broken")
 def test_get_http_header():
     h = {
@@ -795,6 +1503,12 @@ def test_prepare_fingerprints():
         }
     ]
     fps = fp.prepare_fingerprints(dns_fp, [])
+    assert fps["http_body"] == fp.BodyMatcher([])
+    assert fps["dns_index"] == {"134.17.0.7": fps["dns"]}
+    assert fps["http_headers"] == fp.HeaderMatcher([])
+    del fps["http_body"]
+    del fps["dns_index"]
+    del fps["http_headers"]
     assert fps == {
         "dns": [
             {
@@ -810,3 +1524,410 @@ def test_prepare_fingerprints():
         ],
         "http": [],
     }
+
+
+# # portable_queue
+
+
+def test_ring_queue():
+    q = RingQueue(capacity=500)
+    items = [(f"msmt {n}".encode() * 10, None, f"uid_{n}") for n in range(6)]
+    q.put_many(items[:4])
+    assert q.qsize() == 4
+    assert q.get_many(3) == items[:3]
+    # wraps around the end of the ring
+    q.put_many(items[4:] + [None, {"a": [1]}, None])
+    assert q.qsize() == 6
+    assert q.get_many(10) == items[3:] + [None]  # stops at the sentinel
+    assert q.get() == {"a": [1]}
+    assert q.get() is None
+    assert q.qsize() == 0
+    assert q.nbytes() == 0
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+
+
+def test_ring_queue_full():
+    q = RingQueue(capacity=100)
+    q.put((b"x" * 60, None, "uid"))
+    with pytest.raises(queue.Full):
+        q.put((b"x" * 60, None, "uid"), block=False)
+    with pytest.raises(ValueError):
+        q.put_many([(b"x" * 200, None, "uid")])
+    q.get()
+    q.put((b"x" * 60, None, "uid"), block=False)
+
+
+@pytest.mark.parametrize("get_batch", [1, 8])
+def test_ring_queue_qsize(get_batch):
+    q = RingQueue(capacity=10_000, get_batch=get_batch)
+    q.put_many(list(range(5)))
+    assert q.get() == 0
+    assert q.get() == 1
+    # in batch mode the other items are in the local buffer of the consumer
+    assert q.qsize() == (3 if get_batch == 1 else 0)
+    assert [q.get() for _ in range(3)] == [2, 3, 4]
+
+
+def test_portable_queue_setup():
+    import fastpath.portable_queue as pq
+
+    assert pq._q is None  # not created on import
+    pq.setup(capacity=1000)
+    try:
+        pq.put_many([1, None])
+        assert pq.qsize() == 2
+        assert pq.get() == 1
+        assert pq.qsize() == 1
+    finally:
+        pq._q = None
+
+
+class LegacyQueue:
+    """The mp.Queue based portable_queue, used as benchmark baseline"""
+
+    def __init__(self):
+        self._q = mp.Queue()
+        self._size = mp.Value("i", 0)
+
+    def put(self, val):
+        with self._size.get_lock():
+            self._size.value += 1
+            self._q.put(val)
+
+    def get(self):
+        v = self._q.get()
+        with self._size.get_lock():
+            self._size.value -= 1
+        return v
+
+
+def _bench_consumer(q):
+    while q.get() is not None:
+        pass
+
+
+@pytest.mark.skipif(not os.getenv("BENCHMARK"), reason="benchmark")
+@pytest.mark.parametrize("workers", [1, 4, 16])
+@pytest.mark.parametrize(
+    "qclass,batch", [(LegacyQueue, 1), (RingQueue, 1), (RingQueue, 64)]
+)
+def test_benchmark_queue(qclass, batch, workers):
+    # Run with: make local_benchmark_queue
+    msm = (b"x" * 2000, None, "20210614004521.999962_JO_signal_68eb19b439326d60")
+    msg_cnt = 50_000
+    q = qclass(get_batch=batch) if qclass is RingQueue else qclass()
+    procs = [mp.Process(target=_bench_consumer, args=(q,)) for n in range(workers)]
+    [p.start() for p in procs]
+    t0 = time.perf_counter()
+    if batch == 1:
+        for n in range(msg_cnt):
+            q.put(msm)
+    else:
+        for n in range(0, msg_cnt, batch):
+            q.put_many([msm] * batch)
+    [q.put(None) for p in procs]
+    [p.join() for p in procs]
+    delta = time.perf_counter() - t0
+    name = qclass.__name__
+    log.info(f"{name} batch {batch} {workers} workers: {msg_cnt / delta:.0f} msg/s")
+
+
+# # localhttpfeeder
+
+
+def test_localhttpfeeder_handle_post():
+    from fastpath.localhttpfeeder import handle_post
+
+    q = RingQueue(capacity=200)
+    uid = "20210614004521.999962_JO_signal_68eb19b439326d60"
+    assert handle_post(q, 2, f"/{uid}", b"{}", time.time()) == 200
+    assert q.get() == (b"{}", None, uid)
+    assert handle_post(q, 2, "/foo", b"{}", time.time()) == 404
+    # backlog limit
+    assert handle_post(q, 1, f"/{uid}", b"{}", time.time()) == 200
+    assert handle_post(q, 1, f"/{uid}", b"{}", time.time()) == 429
+    # ring full
+    assert handle_post(q, 10, f"/{uid}", b"x" * 120, time.time()) == 503
+    assert handle_post(q, 10, f"/{uid}", b"x" * 300, time.time()) == 413
+    assert q.qsize() == 1
+
+
+def test_localhttpfeeder_parse_batch():
+    from fastpath.localhttpfeeder import parse_batch
+
+    assert parse_batch(b"") == []
+    data = b"2021_a 3\n{}\n2021_b 0\n"
+    assert parse_batch(data) == [("2021_a", b"{}\n"), ("2021_b", b"")]
+    for bad in (b"2021_a 5\n{}", b"2021_a\n{}", b"2021_a -2\n{}", b"2021_a 2"):
+        with pytest.raises(ValueError):
+            parse_batch(bad)
+
+
+def test_localhttpfeeder_handle_batch_post():
+    from fastpath.localhttpfeeder import handle_batch_post
+
+    q = RingQueue(capacity=200)
+    data = b"2021_a 2\n{}bogus 2\n{}2021_b 2\n{}2021_c 2\n{}"
+    out = handle_batch_post(q, 2, data, time.time())
+    assert json.loads(out) == [200, 400, 200, 429]
+    assert q.get_many(10) == [(b"{}", None, "2021_a"), (b"{}", None, "2021_b")]
+    # all or nothing when the ring is full
+    q.put((b"x" * 60, None, "2021_a"))
+    data = b"2021_a 60\n" + b"x" * 60 + b"2021_b 60\n" + b"x" * 60
+    out = handle_batch_post(q, 10, data, time.time())
+    assert json.loads(out) == [503, 503]
+    assert q.qsize() == 1
+
+
+def test_localhttpfeeder_serve():
+    import asyncio
+    from fastpath.localhttpfeeder import make_connection_handler
+
+    q = RingQueue(capacity=10_000)
+
+    async def run():
+        handler = make_connection_handler(q, 1)
+        server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        statuses = []
+        for body in (b'{"a": 1}', b'{"a": 2}'):
+            req = f"POST /20210614_uid HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n"
+            writer.write(req.encode() + body)
+            await writer.drain()
+            status = await reader.readuntil(b"\r\n\r\n")
+            statuses.append(status.split(b"\r\n")[0])
+
+        q.get()
+        batch = b"2021_a 2\n{}2021_b 2\n{}"
+        req = f"POST /batch HTTP/1.1\r\nContent-Length: {len(batch)}\r\n\r\n"
+        writer.write(req.encode() + batch)
+        await writer.drain()
+        hdrs = await reader.readuntil(b"\r\n\r\n")
+        statuses.append(hdrs.split(b"\r\n")[0])
+        statuses.append(await reader.readexactly(len(b"[200,429]")))
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return statuses
+
+    statuses = asyncio.run(run())
+    assert statuses == [
+        b"HTTP/1.1 200 OK",
+        b"HTTP/1.1 429 Too Many Requests",
+        b"HTTP/1.1 200 OK",
+        b"[200,429]",
+    ]
+    assert q.get() == (b"{}", None, "2021_a")
+
+
+def test_localhttpfeeder_serve_bad_content_length():
+    import asyncio
+    from fastpath.localhttpfeeder import make_connection_handler
+
+    q = RingQueue(capacity=10_000)
+
+    async def run():
+        handler = make_connection_handler(q, 1)
+        server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST /20210614_uid HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+        await writer.drain()
+        status = await reader.readuntil(b"\r\n\r\n")
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return status.split(b"\r\n")[0]
+
+    assert asyncio.run(run()) == b"HTTP/1.1 400 Bad Request"
+    assert q.qsize() == 0
+
+
+# # metrics
+
+
+def test_aggregating_metrics():
+    import socket
+    from fastpath.metrics import AggregatingStatsClient, MAX_TIMER_SAMPLES
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+    port = sock.getsockname()[1]
+    m = AggregatingStatsClient("127.0.0.1", port, "t", 3600)
+
+    m.incr("c")
+    m.incr("c", 2)
+    m.gauge("g", 1)
+    m.gauge("g", 5)
+    m.gauge("gd", 3, delta=True)
+    m.gauge("gd", -5, delta=True)
+    m.gauge("gd2", 1.5, delta=True)
+    m.gauge("ga", 7)
+    m.gauge("ga", 1, delta=True)
+    for n in range(1000):
+        m.timing("tm", 3)
+
+    @m.timer("deco")
+    def f():
+        return 42
+
+    assert f() == 42
+    with m.timer("ctx"):
+        pass
+
+    m.set_sample_rate("hot", 0.5)
+    for n in range(1000):
+        m.timing("hot", 1)
+
+    m.flush()
+    lines = []
+    while True:
+        try:
+            packet = sock.recv(65536)
+        except socket.timeout:
+            break
+        assert len(packet) <= 512
+        lines.extend(packet.decode().splitlines())
+    sock.close()
+
+    assert "t.c:3|c" in lines
+    assert "t.g:5|g" in lines
+    assert "t.gd:-2|g" in lines  # delta gauges keep the sign
+    assert "t.gd2:+1.5|g" in lines
+    assert "t.ga:8|g" in lines
+    tm = [li for li in lines if li.startswith("t.tm:")]
+    assert len(tm) == MAX_TIMER_SAMPLES
+    # statsd scales the count back using the sample rate
+    assert tm[0] == "t.tm:3.000000|ms|@0.256000"
+    assert len([li for li in lines if li.startswith("t.deco:")]) == 1
+    assert len([li for li in lines if li.startswith("t.ctx:")]) == 1
+    hot = [li for li in lines if li.startswith("t.hot:")]
+    rate = float(hot[0].split("@")[1])
+    assert 200 < MAX_TIMER_SAMPLES / rate < 1800  # ~1000
+
+    # nothing left to send
+    m.flush()
+
+
+def test_aggregating_metrics_idle_flush(monkeypatch):
+    import socket
+    import fastpath.metrics as metrics
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    port = sock.getsockname()[1]
+    m = metrics.AggregatingStatsClient("127.0.0.1", port, "t", 0.5)
+    monkeypatch.setattr(metrics, "_clients", [m])
+    m.incr("c")
+    m.gauge("g", -2)
+    # no more metric calls: the flushing thread sends them
+    lines = sock.recv(65536).decode().splitlines()
+    sock.close()
+    assert lines == ["t.c:1|c", "t.g:0|g", "t.g:-2|g"]
+
+
+def test_yaml_pool_task_flushes_metrics():
+    import fastpath.normalize as normalize
+
+    with patch("fastpath.normalize.flush_metrics") as flush:
+        assert normalize._run_in_pool(lambda x: x + 1, 1) == 2
+    flush.assert_called_once_with()
+
+
+# # profiler
+
+
+def test_profiler(tmp_path):
+    from fastpath.profiler import Profiler
+
+    p = Profiler()
+    with p.stage("a"):  # disabled
+        pass
+    assert p.stats == {}
+
+    p.enabled = True
+
+    @p.profile("outer")
+    def f(tn):
+        with p.stage("parse"):
+            time.sleep(0.01)
+        p.set_test_name(tn)
+        with p.stage("score"):
+            time.sleep(0.02)
+
+    f("web_connectivity")
+    f("web_connectivity")
+    f(None)
+    assert sorted(p.stats) == [
+        ("-", "outer"),
+        ("-", "outer", "parse"),
+        ("-", "outer", "score"),
+        ("web_connectivity", "outer"),
+        ("web_connectivity", "outer", "parse"),
+        ("web_connectivity", "outer", "score"),
+    ]
+    count, wall, cpu, self_wall = p.stats[("web_connectivity", "outer")]
+    assert count == 2
+    assert wall >= 0.06
+    assert self_wall < 0.01  # the time is spent in the nested stages
+    assert cpu < wall
+
+    p.dump(tmp_path)
+    folded = (tmp_path / f"{os.getpid()}.folded").read_text().splitlines()
+    assert any(li.startswith("fastpath;web_connectivity;outer;score ") for li in folded)
+    summary = (tmp_path / f"{os.getpid()}.txt").read_text().splitlines()
+    assert summary[0].split() == [
+        "test_name", "stage", "count", "wall_s", "cpu_s", "self_s", "avg_ms"
+    ]
+    assert summary[1].split()[:3] == ["web_connectivity", "outer", "2"]
+
+
+def _check_uidset(s, uids) -> int:
+    """Returns the number of duplicates"""
+    seen: set = set()
+    duplicates = 0
+    for uid in uids:
+        assert (uid in s) == (uid in seen), uid
+        assert (uid in s) == (uid in seen), "lookups must not change the set"
+        duplicates += uid in seen
+        s.add(uid)
+        seen.add(uid)
+    assert len(s) == len(seen)
+    return duplicates
+
+
+@pytest.mark.parametrize("exact", [False, True])
+def test_uidset(exact):
+    import random
+    from fastpath.uidset import UidSet
+
+    rnd = random.Random(3)
+    uids = [f"20210601{rnd.getrandbits(64):032x}" for _ in range(5000)]
+    uids += rnd.choices(uids, k=2000)
+    rnd.shuffle(uids)
+    s = UidSet(exact, slots=8)  # grows many times
+    assert _check_uidset(s, uids) == 2000
+    st = s.stats()
+    assert st["dedup_exact"] == exact
+    assert st["dedup_uids"] == 5000
+    assert st["dedup_false_positives"] == 0
+    per_uid = st["dedup_memory_bytes"] / 5000
+    # 8192 slots of 8 bytes, plus offsets and 41 bytes each in the arena
+    assert per_uid < (80 if exact else 16)
+
+
+def test_uidset_fingerprint_collisions(monkeypatch):
+    import fastpath.uidset as uidset
+
+    # Only 4 fingerprints: most uids collide
+    monkeypatch.setattr(uidset, "fingerprint", lambda uid: hash(uid) % 4 + 1)
+    uids = [f"uid{n % 30}" for n in range(100)]
+    s = uidset.UidSet()
+    assert s.exact
+    assert _check_uidset(s, uids) == 70
+    assert 0 < s.false_positives < 30
+    assert len(s) == 30
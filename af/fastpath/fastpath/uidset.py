@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Compact set of measurement_uid strings for duplicate detection
+
+Stores a 64-bit fingerprint of each uid in an open-addressed hash table
+backed by array("Q"): about 12 bytes per uid instead of more than 100 for a
+set of str.
+
+Two different uids can have the same fingerprint: the probability is about
+n^2 / 2^65, e.g. 1e-4 for 50 million uids. By default the uids are also
+stored, as bytes in an arena, and on a fingerprint match the uid is
+compared: colliding uids are counted as false positives and tracked in a
+small exact set instead. This is still far smaller than a set of str.
+With exact=False a collision makes a new uid look like a duplicate.
+"""
+
+from array import array
+from typing import Dict, Set
+import hashlib
+
+INITIAL_SLOTS = 1 << 16
+MAX_LOAD = 0.7
+
+
+def fingerprint(uid: str) -> int:
+    h = hashlib.blake2b(uid.encode(), digest_size=8).digest()
+    return int.from_bytes(h, "little") or 1  # 0 marks empty slots
+
+
+class UidSet:
+    def __init__(self, exact: bool = True, slots: int = INITIAL_SLOTS) -> None:
+        assert slots & (slots - 1) == 0, "slots must be a power of 2"
+        self.exact = exact
+        self.false_positives = 0
+        self._count = 0
+        self._table = array("Q", bytes(8 * slots))
+        # exact mode: offset + 1 of each uid in the arena, for each slot
+        self._offsets = array("Q", bytes(8 * slots)) if exact else array("Q")
+        self._arena = bytearray()
+        self._overflow: Set[str] = set()  # uids with a fingerprint collision
+
+    def __len__(self) -> int:
+        return self._count + len(self._overflow)
+
+    def _find(self, fp: int) -> int:
+        """Returns the slot holding fp or the empty slot where it goes"""
+        mask = len(self._table) - 1
+        i = fp & mask
+        table = self._table
+        while True:
+            v = table[i]
+            if v == fp or v == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _stored_uid(self, slot: int) -> str:
+        off = self._offsets[slot] - 1
+        size = self._arena[off]
+        return self._arena[off + 1 : off + 1 + size].decode()
+
+    def __contains__(self, uid: str) -> bool:
+        slot = self._find(fingerprint(uid))
+        if self._table[slot] == 0:
+            return False
+        if not self.exact or self._stored_uid(slot) == uid:
+            return True
+        return uid in self._overflow
+
+    def add(self, uid: str) -> None:
+        fp = fingerprint(uid)
+        slot = self._find(fp)
+        if self._table[slot] != 0:
+            if self.exact and self._stored_uid(slot) != uid:
+                if uid not in self._overflow:
+                    self.false_positives += 1
+                    self._overflow.add(uid)
+            return
+
+        self._table[slot] = fp
+        if self.exact:
+            b = uid.encode()
+            assert len(b) < 256
+            self._offsets[slot] = len(self._arena) + 1
+            self._arena.append(len(b))
+            self._arena += b
+        self._count += 1
+        if self._count > len(self._table) * MAX_LOAD:
+            self._grow()
+
+    def _grow(self) -> None:
+        old_table, old_offsets = self._table, self._offsets
+        slots = len(old_table) * 2
+        self._table = array("Q", bytes(8 * slots))
+        if self.exact:
+            self._offsets = array("Q", bytes(8 * slots))
+        for n, fp in enumerate(old_table):
+            if fp == 0:
+                continue
+            slot = self._find(fp)
+            self._table[slot] = fp
+            if self.exact:
+                self._offsets[slot] = old_offsets[n]
+
+    def memory_bytes(self) -> int:
+        """Approximate memory used"""
+        size = self._table.buffer_info()[1] * self._table.itemsize
+        size += self._offsets.buffer_info()[1] * self._offsets.itemsize
+        size += len(self._arena)
+        size += sum(len(u) + 50 for u in self._overflow)
+        return size
+
+    def stats(self) -> Dict[str, int]:
+        """False positives are detected only in exact mode"""
+        return dict(
+            dedup_exact=int(self.exact),
+            dedup_uids=len(self),
+            dedup_false_positives=self.false_positives,
+            dedup_memory_bytes=self.memory_bytes(),
+        )
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of normalized measurements from legacy YAML cans
+
+Legacy cans never change: the output of the YAML normalizer is stored as
+lz4-compressed JSONL, one file for each can, keyed by the can filename,
+its size and NORMALIZER_VERSION. Later runs read the cached measurements
+and skip downloading, decompressing and parsing the can.
+
+Only cans containing YAML reports are cached: legacy JSON cans are as fast
+to parse as the cache itself.
+"""
+
+from pathlib import Path
+from typing import Generator, Optional
+import logging
+import os
+
+import lz4.frame as lz4frame  # debdeps: python3-lz4
+import ujson  # debdeps: python3-ujson
+
+from fastpath.metrics import setup_metrics
+
+# Bump when the output of the normalizer changes to invalidate the cache
+NORMALIZER_VERSION = 1
+
+log = logging.getLogger("fastpath.yamlcache")
+metrics = setup_metrics(name="fastpath.yamlcache")
+
+
+def is_cacheable(can_fn: str) -> bool:
+    """Legacy cans that can contain YAML reports"""
+    return can_fn.endswith((".tar.lz4", ".yaml.lz4"))
+
+
+class CacheWriter:
+    """Writes normalized measurements to a temporary file. The file is
+    moved in place by commit() only if the can contained YAML reports."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.has_yaml = False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmpf = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        self._fd = lz4frame.open(self._tmpf, "wb")
+
+    def mark_yaml(self) -> None:
+        self.has_yaml = True
+
+    def write(self, msm: dict) -> None:
+        self._fd.write(ujson.dumps(msm).encode())
+        self._fd.write(b"\n")
+
+    def commit(self) -> None:
+        self._fd.close()
+        if not self.has_yaml:
+            self._tmpf.unlink()
+            return
+        self._tmpf.rename(self.path)
+        metrics.incr("written_bytes", self.path.stat().st_size)
+        log.debug(f"Cached {self.path}")
+
+    def discard(self) -> None:
+        """Drop incomplete output. No-op after commit()"""
+        if self._fd.closed:
+            return
+        self._fd.close()
+        self._tmpf.unlink()
+
+
+class YamlCache:
+    def __init__(self, cachedir: Path) -> None:
+        self.cachedir = cachedir
+
+    def path(self, can_fn: str, size: int) -> Path:
+        # can_fn can be an S3 key or a local path: use <day>/<filename>
+        day, name = can_fn.split("/")[-2:]
+        fname = f"{name}.{size}.jsonl.lz4"
+        return self.cachedir / f"v{NORMALIZER_VERSION}" / day / fname
+
+    def has(self, can_fn: str, size: int) -> bool:
+        return is_cacheable(can_fn) and self.path(can_fn, size).is_file()
+
+    def load(self, can_fn: str, size: int) -> Optional[Generator[dict, None, None]]:
+        """Returns a generator of normalized measurements or None on miss"""
+        if not is_cacheable(can_fn):
+            return None
+        p = self.path(can_fn, size)
+        if not p.is_file():
+            metrics.incr("miss")
+            return None
+        metrics.incr("hit")
+        return self._iter(p)
+
+    def _iter(self, p: Path) -> Generator[dict, None, None]:
+        with lz4frame.open(p) as f:
+            for line in f:
+                yield ujson.loads(line)
+
+    def writer(self, can_fn: str, size: int) -> CacheWriter:
+        return CacheWriter(self.path(can_fn, size))
+
+
+def get_yaml_cache(conf) -> Optional[YamlCache]:
+    """Returns the cache if enabled with --yaml-cache"""
+    if not conf.yaml_cache:
+        return None
+    return YamlCache(conf.yamlcachedir)
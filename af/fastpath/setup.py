@@ -16,6 +16,7 @@ setup(
         "fastpath=fastpath.core:main",
         "reprocessor=fastpath.reprocessor:main",
         "domain_input_updater=fastpath.domain_input:main",
+        "prewarm_yaml_cache=fastpath.prewarm_yaml_cache:main",
     ]},
     install_requires=REQUIRED,
     include_package_data=True,